@@ -1,10 +1,6 @@
-import multiprocessing
-import os
-import tensorflow as tf
+from backend.machine_learning.training_resources import available_cpus, configure_threads
+from backend.machine_learning.training_scheduler import training_slots
 
-count = max(int(multiprocessing.cpu_count() / 5), 1)
-tf.config.threading.set_intra_op_parallelism_threads(count)
-tf.config.threading.set_inter_op_parallelism_threads(count)
-
-os.environ['TF_NUM_INTEROP_THREADS'] = f'{count}'
-os.environ['TF_NUM_INTRAOP_THREADS'] = f'{count}'
\ No newline at end of file
+# Training worker processes size their thread pools to their own budget, see training_resources.
+# Predictions and trainings not isolated in worker processes get the share of one training slot
+configure_threads(max(len(available_cpus()) // training_slots(), 1))
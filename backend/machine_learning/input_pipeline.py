@@ -0,0 +1,81 @@
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+import tensorflow as tf
+
+"""
+Input pipeline stage between the datasets of the creation functions and model.fit
+
+Creation functions return unbatched datasets of (input, output) examples. After splitting, every split is cached during
+its first epoch, so neither the split nor the inputs are computed again in later epochs. Training sets are shuffled at
+example level every epoch, all splits are batched by the model type's batch function and prefetched while the model
+trains.
+"""
+
+# how splits are cached during their first epoch: 'memory', 'disk' or None. Streaming datasets do not fit into memory,
+# they are cached on disk in 'memory' mode
+_cache_mode = 'memory'
+# upper limit of examples in the shuffle buffer of training sets, smaller training sets are shuffled completely
+_shuffle_buffer_size = 16384
+
+
+def batch_examples(ds, batch_size):
+    """
+    Batch function for inputs of a fixed shape which are used as they are, see ml_dicts.batch_functions
+    :param ds: unbatched tf.data.Dataset
+    :param batch_size: int size of data batches
+    :return: batched tf.data.Dataset
+    """
+    return ds.batch(batch_size, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+class InputPipeline:
+    """
+    Turns the unbatched splits of a dataset into the datasets passed to model.fit and model.evaluate, see module
+    docstring. Splits cached on disk are deleted with the pipeline, keep it as long as its datasets are used
+    """
+
+    def __init__(self, batch_function, batch_size, streaming=False, cache_mode=_cache_mode,
+                 shuffle_buffer_size=_shuffle_buffer_size):
+        """
+        :param batch_function: function(dataset, batch_size) batching examples into model inputs
+        :param batch_size: int size of data batches
+        :param streaming: whether the dataset is streamed from disk, see ShardedDataset
+        :param cache_mode: 'memory', 'disk' or None, see _cache_mode
+        :param shuffle_buffer_size: upper limit of examples in the shuffle buffer of training sets
+        """
+        self.batch_function = batch_function
+        self.batch_size = int(batch_size)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.cache_mode = cache_mode
+        self.cache_path = None
+        if cache_mode == 'disk' or (cache_mode == 'memory' and streaming):
+            self.cache_path = Path(tempfile.mkdtemp(prefix='input_cache_'))
+            weakref.finalize(self, shutil.rmtree, self.cache_path, True)
+
+    def training(self, split):
+        """
+        :param split: unbatched training examples
+        :return: dataset of batches, reshuffled every epoch
+        """
+        size = split.cardinality().numpy()
+        buffer_size = min(size, self.shuffle_buffer_size) if size > 0 else self.shuffle_buffer_size
+        ds = self.__cache(split, 'training').shuffle(buffer_size)
+        return self.batch_function(ds, self.batch_size).prefetch(tf.data.AUTOTUNE)
+
+    def evaluation(self, split, name):
+        """
+        :param split: unbatched validation or test examples
+        :param name: name of the split, unique within this pipeline
+        :return: dataset of batches in a fixed order
+        """
+        return self.batch_function(self.__cache(split, name), self.batch_size).prefetch(tf.data.AUTOTUNE)
+
+    def __cache(self, split, name):
+        if self.cache_path is not None:
+            return split.cache(str(self.cache_path / name))
+        if self.cache_mode == 'memory':
+            return split.cache()
+        return split
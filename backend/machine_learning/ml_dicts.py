@@ -2,8 +2,8 @@ import tensorflow as tf
 import tensorflow_addons as tfa
 # tensorflow-addons has been deprecated, but this is the only way to get R2
 # until https://www.tensorflow.org/api_docs/python/tf/keras/metrics/R2Score is in stable
-from backend.machine_learning.ml_gnns import create_schnet_with_dataset, smiles_to_schnet_input
-from backend.machine_learning.ml_fnns import create_fnn_with_dataset, smiles_to_fnn_input
+from backend.machine_learning.ml_gnns import batch_schnet_input, create_schnet_with_dataset, smiles_to_schnet_input
+from backend.machine_learning.ml_fnns import batch_fnn_input, create_fnn_with_dataset, smiles_to_fnn_input
 
 """
 map of available optimizer names to their keras equivalent
@@ -47,6 +47,15 @@ creation_functions = {
     'sequential': create_fnn_with_dataset,
 }
 
+"""
+map of available model types to their respective batch functions, turning the unbatched datasets of the creation
+functions into model inputs. Model types missing here use input_pipeline.batch_examples
+"""
+batch_functions = {
+    'schnet': batch_schnet_input,
+    'sequential': batch_fnn_input,
+}
+
 """
 map of available model types to their respective molecule conversion functions
 """
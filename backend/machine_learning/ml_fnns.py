@@ -1,33 +1,35 @@
-from backend.utils.molecule_formats import smiles_to_fingerprint
+from backend.utils.molecule_formats import smiles_list_to_fingerprints
+from backend.utils import featurization_cache as fc
+from backend.machine_learning import tensor_cache as tc
 import tensorflow as tf
 from keras import layers
 
 
 # parameters right now needs to contain fields for 'optimizer', 'units_per_layer', 'activationFunction', 'metrics'
 _fingerprint_size = 512
+# bit of each position in a packed byte, most significant first like numpy.packbits
+_bit_masks = [128, 64, 32, 16, 8, 4, 2, 1]
 
 
-def create_fnn_with_dataset(parameters, dataset, labels, loss, optimizer, metrics, batch_size):
+def create_fnn_with_dataset(parameters, dataset, labels, loss, optimizer, metrics):
     """
-    creates a keras FNN and a tensorflow dataset from given parameters
+    creates a keras FNN and an unbatched tensorflow dataset from given parameters, see batch_fnn_input
     :param parameters: model parameters
-    :param dataset: dataset to use
+    :param dataset: ColumnarDataset or ShardedDataset to use
     :param labels: strings of labels to train on
     :param loss: keras loss function
     :param optimizer: keras optimizer
     :param metrics: array of keras metrics for training
-    :param batch_size: integer, size of data batches
     :return: created model and dataset
     """
     layers_param = parameters.get('layers')
 
-    # Get input/output for dataset
-    x, y = zip(*[(mol.get("x").get("fingerprints").get(str(_fingerprint_size)),
-                  list(mol.get("y").get(k) for k in labels)) for mol in dataset])
-    x, y = tf.constant(x), tf.constant(y)
-
-    # Builds the dataset for our model
-    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(int(batch_size))
+    # Builds the dataset for our model, streams it if it does not fit into memory or gets it from the tensor cache
+    if dataset.streaming:
+        ds = dataset.stream([f'fingerprints_{_fingerprint_size}'], labels)
+    else:
+        ds = tc.get_tensor_dataset(dataset, f'fingerprints_{_fingerprint_size}', labels,
+                                   lambda: fnn_tensor_dataset(dataset, labels))
 
     # model creation
     model = tf.keras.models.Sequential()
@@ -44,15 +46,54 @@ def create_fnn_with_dataset(parameters, dataset, labels, loss, optimizer, metric
                   loss=loss,
                   metrics=metrics)
 
-    model.build(input_shape=x.get_shape())
+    model.build(input_shape=(None, _fingerprint_size))
 
     return model, ds
 
 
-def smiles_to_fnn_input(smiles):
-    # Converts our molecule to a fingerprint vector
-    converted_molecule = smiles_to_fingerprint(smiles, fingerprint_size=_fingerprint_size)
-    # Converts the fingerprint vector to tensorflow input
+def fnn_tensor_dataset(dataset, labels):
+    """
+    Builds the unbatched FNN input of bit-packed fingerprints and labels from a dataset
+    :param dataset: ColumnarDataset to use
+    :param labels: strings of labels to train on
+    :return: tf.data.Dataset of (packed fingerprint, labels) pairs
+    """
+    x, y = tf.constant(dataset.get_fingerprints(_fingerprint_size)), tf.constant(dataset.get_labels(labels))
+    return tf.data.Dataset.from_tensor_slices((x, y))
+
+
+def batch_fnn_input(ds, batch_size):
+    """
+    Batches FNN examples, fingerprints stay bit-packed until here, they are unpacked one batch at a time
+    :param ds: unbatched tf.data.Dataset of (packed fingerprint, labels) pairs
+    :param batch_size: integer, size of data batches
+    :return: tf.data.Dataset of (fingerprints, labels) batches
+    """
+    return ds.batch(int(batch_size), num_parallel_calls=tf.data.AUTOTUNE) \
+        .map(lambda x, y: (unpack_fingerprints(x), y), num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def unpack_fingerprints(packed):
+    """
+    Unpacks bit-packed fingerprints as stored in datasets (numpy.packbits, most significant bit first)
+    :param packed: uint8 tensor of shape (batch, bits / 8)
+    :return: float32 tensor of shape (batch, bits)
+    """
+    bits = tf.bitwise.bitwise_and(tf.expand_dims(packed, -1), tf.constant(_bit_masks, dtype=tf.uint8))
+    return tf.reshape(tf.cast(bits > 0, tf.float32), [-1, packed.shape[-1] * 8])
+
+
+def smiles_to_fnn_input(smiles, dataset=None, parameters=None):
+    # Converts our molecule to a bit-packed fingerprint, sharing cache entries with dataset creation
+    converted_molecule = fc.get_or_create('packed_fingerprint', {'size': _fingerprint_size, 'radius': 2}, smiles,
+                                          lambda: _smiles_to_packed_fingerprint(smiles))
+    # Unpacks the fingerprint like the datasets are unpacked, so inference gets exactly the input the model was
+    # trained on
     if converted_molecule is not None:
-        converted_molecule = tf.constant(converted_molecule, shape=(1, _fingerprint_size))
+        converted_molecule = unpack_fingerprints(tf.constant(converted_molecule[None]))
     return converted_molecule
+
+
+def _smiles_to_packed_fingerprint(smiles):
+    fingerprints, valid = smiles_list_to_fingerprints([smiles], [_fingerprint_size], packed=True)
+    return fingerprints[_fingerprint_size][0] if valid[0] else None
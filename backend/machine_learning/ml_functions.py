@@ -1,3 +1,4 @@
+import functools
 import threading
 
 import keras.callbacks
@@ -5,20 +6,57 @@ import keras.callbacks
 import backend.utils.api as api
 from backend.machine_learning import ml_dicts as mld
 from backend.utils import storage_handler as sh
+from backend.utils.molecule_formats import ConversionError
+from backend.machine_learning.training_scheduler import TrainingScheduler
+from backend.machine_learning.training_workers import SavedModel, TrainingRun, TrainingWorkerPool
+
+# Whether trainings run in worker processes, so they do not compete with the API for the GIL.
+# Set to False to run them in the scheduler's threads, e.g. for debugging
+_isolated_trainings = True
 
 # Dictionary containing all current active training sessions
 live_trainings = dict()
 lock = threading.RLock()
+# Runs a bounded number of trainings at once, further trainings wait in a queue and are told their position
+scheduler = TrainingScheduler(notify_position=lambda user_id, position: api.notify_training_queued(user_id, position))
+# Worker processes running the trainings, one per scheduler slot, the CPUs are divided between them
+workers = TrainingWorkerPool(scheduler.slots,
+                             notify_allocation=lambda user_id, allocation: api.notify_training_resources(user_id,
+                                                                                                         allocation))
 
 
-class Training:
+class Training(TrainingRun):
     """
-        Class for an active Training process.
+        Class for an active Training process running in the calling thread.
         Holds all the information required to train a model and later save it in the storage_handler.
     """
     def __init__(self, user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id=None):
         model_summary = sh.get_model_summary(user_id, model_id)
         base_model = sh.get_base_model(model_summary.get('baseModelID'))
+        fitting_summary = sh.get_fitting_summary(user_id, fitting_id) if fitting_id else None
+        super().__init__(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size,
+                         base_model.get('type'),
+                         model_summary.get('parameters'),
+                         sh.get_dataset(dataset_id),
+                         base_model.get('metrics'),
+                         fitting_id,
+                         sh.get_fitting(user_id, fitting_id) if fitting_summary else None,
+                         fitting_summary.get('epochs') if fitting_summary else 0)
+
+    def start_training(self):
+        super().start_training([LiveStats(self.user_id)])
+
+
+class WorkerTraining:
+    """
+        Class for an active Training process running in a process of the training worker pool.
+        Resolves the model, dataset and fitting to continue from the storage_handler and passes on the worker's progress.
+    """
+    def __init__(self, user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id=None):
+        model_summary = sh.get_model_summary(user_id, model_id)
+        base_model = sh.get_base_model(model_summary.get('baseModelID'))
+        dataset = sh.get_dataset(dataset_id)
+        fitting_summary = sh.get_fitting_summary(user_id, fitting_id) if fitting_id else None
 
         self.user_id = user_id
         self.dataset_id = dataset_id
@@ -26,87 +64,82 @@ class Training:
         self.batch_size = int(batch_size)
         self.learning_rate = learning_rate
         self.labels = labels
-        self.model, ds = self.create_model_and_set(
-            base_model.get('type'),
-            model_summary.get('parameters'),
-            sh.get_dataset(dataset_id),
-            labels,
-            base_model.get('metrics')
-        )
-        self.training_set, self.validation_set, self.test_set = self.split_dataset(ds)
-        self.initial_epoch = 0
+        self.initial_epoch = fitting_summary.get('epochs') if fitting_summary else 0
         self.fitting_id = fitting_id
-        if fitting_id and sh.get_fitting_summary(user_id, fitting_id):
-            self.model = sh.get_fitting(user_id, fitting_id)
-            self.initial_epoch = sh.get_fitting_summary(user_id, fitting_id).get('epochs')
         self.epochs = int(epochs) + self.initial_epoch
-
-    def create_model_and_set(self, model_type, parameters, dataset, labels, metrics):
-        # decode loss, optimizer and metrics from strings
-        optimizer = mld.optimizers.get(parameters.get('optimizer'))(learning_rate=self.learning_rate)
-        return mld.creation_functions.get(model_type)(parameters,
-                                                      dataset,
-                                                      labels,
-                                                      mld.losses.get(parameters.get('lossFunction'))(),
-                                                      optimizer,
-                                                      [mld.metrics.get(metric)() for metric in metrics],
-                                                      self.batch_size)
-
-    def split_dataset(self, dataset):
-        """"
-        shuffles and splits dataset into training (70%), validation(20%) and test (10%) data
-        :param dataset: dataset to split
-        """
-        ds_length = dataset.cardinality().numpy()
-        dataset_seed = hash(self.user_id) ^ hash(self.dataset_id) ^ hash(self.model_id) ^ hash(self.batch_size)
-        ds = dataset.shuffle(max(int(ds_length * 0.1), 1), seed=dataset_seed)
-
-        train_size = int(0.7 * ds_length)
-        validation_size = int(0.2 * ds_length)
-
-        return ds.take(train_size), ds.skip(train_size).take(validation_size), ds.skip(train_size + validation_size)
+        # Arguments of the TrainingRun in the worker, which opens the dataset and loads the fitting from their paths
+        self.arguments = {'user_id': user_id,
+                          'dataset_id': dataset_id,
+                          'model_id': model_id,
+                          'labels': labels,
+                          'epochs': int(epochs),
+                          'learning_rate': learning_rate,
+                          'batch_size': self.batch_size,
+                          'model_type': base_model.get('type'),
+                          'parameters': model_summary.get('parameters'),
+                          'dataset_path': str(dataset.path),
+                          'metrics': base_model.get('metrics'),
+                          'fitting_id': fitting_id,
+                          'fitting_path': fitting_summary.get('fittingPath') if fitting_summary else None,
+                          'initial_epoch': self.initial_epoch}
 
     def start_training(self):
-        # Trains the model
-        self.model.fit(self.training_set, validation_data=self.validation_set,
-                       epochs=self.epochs,
-                       batch_size=self.batch_size,
-                       callbacks=[LiveStats(self.user_id)],
-                       initial_epoch=self.initial_epoch,
-                       verbose=0)
-
-    def evaluate_model(self):
-        results = self.model.evaluate(self.test_set, verbose=0)
-        names = self.model.metrics_names
-
-        # Evaluates the model, saves result with metric names
-        evaluation = dict(zip(names, results))
-
-        # R2 is our replacement for accuracy
-        # Thus every model needs to have R2 as a metric
-        accuracy = round(evaluation.get('r_square') * 100, 2)
-        return accuracy
+        # Blocks until the worker is done, its events are handled in this thread meanwhile
+        workers.run(self.user_id, self.arguments, self.handle_event, scheduler.get_stats().get('waiting'))
+
+    def handle_event(self, event, payload):
+        if event == 'started':
+            api.notify_training_start(self.user_id, payload)
+            # notifying the start clears earlier messages
+            api.notify_training_resources(self.user_id, workers.allocation(self.user_id))
+        elif event == 'update':
+            api.update_training_logs(self.user_id, payload)
+        elif event == 'done':
+            with lock:
+                live_trainings.pop(self.user_id, None)
+            epochs_trained, accuracy, path = payload
+            model = SavedModel(path)
+            try:
+                finish_training(self.user_id, self, epochs_trained, accuracy, model)
+            finally:
+                model.discard()
+        elif event == 'error':
+            with lock:
+                live_trainings.pop(self.user_id, None)
+            print(payload)
+            api.notify_training_error(self.user_id)
 
     def stop_training(self):
-        self.model.stop_training = True
-        return self.model.stop_training
+        return workers.stop(self.user_id)
 
 
 def train(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id=None):
+    """
+    Queues a training, it starts as soon as the scheduler has a free slot and it is the user's turn
+    :return: True if the training was queued, False if the user already has a training queued or running
+    """
     with lock:
         if is_training_running(user_id):  # Change this to allow for more than one training at the same time
             return False
-        # Placeholder here to ensure no other training can be started while we're initializing, as this takes a while
-        live_trainings[user_id] = {'Placeholder'}
+        return scheduler.submit(user_id, functools.partial(run_training, user_id, dataset_id, model_id, labels, epochs,
+                                                           learning_rate, batch_size, fitting_id))
+
+
+def run_training(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id=None):
+    """
+    Creates and runs a training in the calling thread, see train
+    :return: True if the training ran, False if it could not be created
+    """
     try:
-        new_training = Training(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id)
+        training_type = WorkerTraining if _isolated_trainings else Training
+        new_training = training_type(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, fitting_id)
         with lock:
             live_trainings[user_id] = new_training
         new_training.start_training()
 
     except (TypeError, AttributeError, ValueError) as e:
         with lock:
-            del live_trainings[user_id]
+            live_trainings.pop(user_id, None)
         print(e)
         api.notify_training_error(user_id)
         return False
@@ -115,14 +148,21 @@ def train(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_si
 
 
 def continue_training(user_id, fitting_id, epochs):
+    """
+    Queues a training continuing an existing fitting, see train
+    :return: True if the training was queued
+    """
     summary = sh.get_fitting_summary(user_id, fitting_id)
     if summary:
-        train(user_id, summary.get('datasetID'), summary.get('modelID'), summary.get('labels'), epochs,
-              summary.get('learningRate'), summary.get('batchSize'), fitting_id)
+        return train(user_id, summary.get('datasetID'), summary.get('modelID'), summary.get('labels'), epochs,
+                     summary.get('learningRate'), summary.get('batchSize'), fitting_id)
     return False
 
 
 def stop_training(user_id):
+    # Trainings which have not started yet are removed from the queue
+    if scheduler.cancel(user_id):
+        return True
     with lock:
         training = live_trainings.get(user_id, None)
     if training:
@@ -133,7 +173,7 @@ def stop_training(user_id):
 def is_training_running(user_id):
     # Change this & live_trainings dict to allow for more than one training at the same time
     with lock:
-        return user_id in live_trainings and (live_trainings[user_id] is not None)
+        return scheduler.is_scheduled(user_id) or (user_id in live_trainings and (live_trainings[user_id] is not None))
 
 
 def analyze(user_id, fitting_id, smiles):
@@ -142,7 +182,8 @@ def analyze(user_id, fitting_id, smiles):
     :param user_id: id of calling user, required for user data storage access
     :param fitting_id: id of used fitting
     :param smiles: molecule encoded in SMILES formatted string
-    :return: dictionary of molecules properties for each label of fitting
+    :return: dictionary of molecules properties for each label of fitting,
+    or None and 422 if the molecule cannot be converted, 503 if converting it timed out
     """
     # Gets required objects
     fitting = sh.get_fitting(user_id, fitting_id)
@@ -152,8 +193,17 @@ def analyze(user_id, fitting_id, smiles):
     model_summary = sh.get_model_summary(user_id, fitting_summary.get('modelID'))
     base_model = sh.get_base_model(model_summary.get('baseModelID'))
 
-    # Converts the molecule to the needed format
-    converted_molecule = mld.molecule_conversion_functions.get(base_model.get('type'))(smiles)
+    # Converts the molecule to the needed format, like the molecules of the dataset the fitting was trained on
+    dataset = sh.get_dataset(fitting_summary.get('datasetID'))
+    try:
+        converted_molecule = mld.molecule_conversion_functions.get(base_model.get('type'))(
+            smiles, dataset, model_summary.get('parameters'))
+    except TimeoutError:
+        return None, 503
+    except ConversionError:
+        converted_molecule = None
+    if converted_molecule is None:
+        return None, 422
 
     # Analyses the molecule
     analysis_results = fitting.predict(converted_molecule, verbose=0).flatten().tolist()
@@ -197,21 +247,28 @@ class LiveStats(keras.callbacks.Callback):
             finished_training = live_trainings.pop(self.user_id, None)
         if finished_training:
             accuracy = finished_training.evaluate_model()
-            fitting_id = finished_training.fitting_id
-            # Saves the trained model
-            # if we're continuing training on an existing fitting, just update accuracy, epochs and the model itself
-            if sh.get_user_handler(self.user_id):
-                if finished_training.fitting_id:
-                    fitting_id = sh.update_fitting(self.user_id, finished_training.fitting_id, self.epochs_trained,
-                                                   accuracy, self.model)
-                else:
-                    fitting_id = sh.add_fitting(self.user_id,
-                                                finished_training.dataset_id,
-                                                finished_training.labels,
-                                                self.epochs_trained,
-                                                finished_training.learning_rate,
-                                                accuracy,
-                                                finished_training.batch_size,
-                                                finished_training.model_id,
-                                                self.model)
-            api.notify_training_done(self.user_id, fitting_id, self.epochs_trained, accuracy)
+            finish_training(self.user_id, finished_training, self.epochs_trained, accuracy, self.model)
+
+
+def finish_training(user_id, finished_training, epochs_trained, accuracy, model):
+    """
+    Saves the model of a finished training as a fitting and notifies the user
+    if we're continuing training on an existing fitting, just updates accuracy, epochs and the model itself
+    :param finished_training: Training or WorkerTraining that finished
+    :param model: trained model or SavedModel
+    """
+    fitting_id = finished_training.fitting_id
+    if sh.get_user_handler(user_id):
+        if finished_training.fitting_id:
+            fitting_id = sh.update_fitting(user_id, finished_training.fitting_id, epochs_trained, accuracy, model)
+        else:
+            fitting_id = sh.add_fitting(user_id,
+                                        finished_training.dataset_id,
+                                        finished_training.labels,
+                                        epochs_trained,
+                                        finished_training.learning_rate,
+                                        accuracy,
+                                        finished_training.batch_size,
+                                        finished_training.model_id,
+                                        model)
+    api.notify_training_done(user_id, fitting_id, epochs_trained, accuracy)
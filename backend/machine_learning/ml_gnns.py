@@ -1,38 +1,47 @@
+import numpy as np
 import tensorflow as tf
-from backend.utils.molecule_formats import smiles_to_mol_graph
+from backend.utils import molecule_formats as mf
+from backend.utils.molecule_formats import smiles_to_mol_graph, smiles_to_topology_graph, mol_graph_parameters
+from backend.utils import featurization_cache as fc
 from backend.machine_learning.models.schnet import make_schnet
+from backend.machine_learning import tensor_cache as tc
 
+# input types of SchNet models, see create_schnet_with_dataset
+_input_types = ['3D', 'topology']
 
-def create_schnet_with_dataset(parameters, dataset, labels, loss, optimizer, metrics, batch_size):
+
+def create_schnet_with_dataset(parameters, dataset, labels, loss, optimizer, metrics):
     """
-    Creates a Schrödinger Network and a dataset for it to train on using tensorflow
-    :param parameters: dict containing keys depth, readoutSize and embeddingDimension
-    :param dataset: dataset to use
+    Creates a Schrödinger Network and an unbatched dataset for it to train on using tensorflow, see batch_schnet_input
+    :param parameters: dict containing keys depth, readoutSize, embeddingDimension and optionally inputType,
+    '3D' (default) for the dataset's mol graphs or 'topology' for topology graphs built from its SMILES codes
+    :param dataset: ColumnarDataset or ShardedDataset to use
     :param labels: array of string labels to train on. Currently, only one label is supported.
     :param loss: keras loss function
     :param optimizer: keras optimizer
     :param metrics: array of keras metrics
-    :param batch_size: int size of data batches
     :return: the tf model and created dataset
     """
     label = labels[0]  # SchNets do not support multiple labels
-    # Gets Data for the first label from the dataset
-    x, y = zip(*[(mol["x"]['mol_graph'], mol["y"][label]) for mol in dataset])
-    # Splits the Data into its 3 parts
-    nodes, edges, edges_i = zip(*x)
-
-    # Needed to properly set dimension of model input
-    node_dim = nodes[0].shape[-1]
-    edge_dim = edges[0].shape[-1]
 
-    # Converts dataset data to model input
-    nodes = tf.ragged.constant(nodes, dtype="float32", ragged_rank=1, inner_shape=(node_dim,))
-    edges = tf.ragged.constant(edges, dtype="float32", ragged_rank=1, inner_shape=(edge_dim,))
-    edges_i = tf.ragged.constant(edges_i, dtype="int32", ragged_rank=1, inner_shape=(2,))
-    y = tf.constant(y)
+    # Creates the actual Dataset, streams it if it does not fit into memory or gets it from the tensor cache
+    input_type = parameters.get('inputType', '3D')
+    if input_type not in _input_types:
+        raise ValueError(f'Unknown SchNet input type {input_type}')
+    if input_type == 'topology':
+        if dataset.streaming:
+            raise ValueError('Topology graphs are built from SMILES codes, which sharded datasets do not contain')
+        ds = tc.get_tensor_dataset(dataset, 'topology_graph', [label], lambda: topology_tensor_dataset(dataset, label))
+    elif dataset.streaming:
+        ds = dataset.stream(['mol_graph_nodes', 'mol_graph_edges', 'mol_graph_edge_indices'], [label]) \
+            .map(lambda x, y: (x, y[0]))
+    else:
+        ds = tc.get_tensor_dataset(dataset, 'mol_graph', [label], lambda: schnet_tensor_dataset(dataset, label))
 
-    # Creates the actual Dataset
-    ds = tf.data.Dataset.from_tensor_slices(((nodes, edges, edges_i), y)).batch(batch_size)
+    # Needed to properly set dimension of model input
+    (nodes_spec, edges_spec, _), _ = ds.element_spec
+    node_dim = nodes_spec.shape[-1]
+    edge_dim = edges_spec.shape[-1]
 
     # Creates a new SchNet Model
     model = make_schnet(
@@ -47,9 +56,86 @@ def create_schnet_with_dataset(parameters, dataset, labels, loss, optimizer, met
     return model, ds
 
 
-def smiles_to_schnet_input(smiles):
-    # Converts our molecule to a mol graph
-    (nodes, edges, edges_i) = smiles_to_mol_graph(smiles)
+def schnet_tensor_dataset(dataset, label):
+    """
+    Builds the unbatched SchNet input of mol graphs and a label from a dataset.
+    Graphs keep the compact dtypes they are stored with, see cast_schnet_input.
+    :param dataset: ColumnarDataset to use
+    :param label: string label to train on
+    :return: tf.data.Dataset of ((nodes, edges, edge_indices), label) pairs
+    """
+    # Gets the concatenated mol graphs and the data for the label from the dataset
+    nodes, node_splits, edges, edges_i, edge_splits = dataset.get_mol_graphs()
+    y = tf.constant(dataset.get_labels([label])[:, 0])
+    return graphs_tensor_dataset(nodes, node_splits, edges, edges_i, edge_splits, y)
+
+
+def topology_tensor_dataset(dataset, label):
+    """
+    Builds the unbatched SchNet input of topology graphs and a label from a dataset. No molecule is embedded in 3D,
+    the graphs are built from the dataset's SMILES codes
+    :param dataset: ColumnarDataset with SMILES codes, see ColumnarDataset.get_smiles
+    :param label: string label to train on
+    :return: tf.data.Dataset of ((nodes, edges, edge_indices), label) pairs
+    """
+    smiles_list = dataset.get_smiles()
+    if smiles_list is None:
+        raise ValueError(f'{dataset.name} has no SMILES column, create it anew to train on topology graphs')
+    graphs = [smiles_to_topology_graph(smiles) for smiles in smiles_list]
+    if any(nodes is None for nodes, _, _ in graphs):
+        raise ValueError(f'{dataset.name} contains molecules without topology graphs')
+    node_splits = np.cumsum([0] + [len(nodes) for nodes, _, _ in graphs])
+    edge_splits = np.cumsum([0] + [len(edges) for _, edges, _ in graphs])
+    nodes, edges, edges_i = (np.concatenate(column) for column in zip(*graphs))
+    y = tf.constant(dataset.get_labels([label])[:, 0])
+    return graphs_tensor_dataset(nodes, node_splits, edges, edges_i, edge_splits, y)
+
+
+def graphs_tensor_dataset(nodes, node_splits, edges, edges_i, edge_splits, y):
+    """
+    Builds an unbatched tf.data.Dataset of ((nodes, edges, edge_indices), label) pairs from concatenated graphs
+    and their row splits
+    """
+    # Splits the dataset columns into one row per molecule without copying or converting them
+    nodes = tf.RaggedTensor.from_row_splits(tf.convert_to_tensor(nodes), node_splits, validate=False)
+    edges = tf.RaggedTensor.from_row_splits(tf.convert_to_tensor(edges), edge_splits, validate=False)
+    edges_i = tf.RaggedTensor.from_row_splits(tf.convert_to_tensor(edges_i), edge_splits, validate=False)
+
+    return tf.data.Dataset.from_tensor_slices(((nodes, edges, edges_i), y))
+
+
+def batch_schnet_input(ds, batch_size):
+    """
+    Batches graphs of different sizes as ragged tensors, only batches are converted to the model's dtypes
+    :param ds: unbatched tf.data.Dataset of ((nodes, edges, edge_indices), label) pairs
+    :param batch_size: int size of data batches
+    :return: tf.data.Dataset of batches as expected by the SchNet model
+    """
+    return ds.ragged_batch(int(batch_size)).map(cast_schnet_input, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def cast_schnet_input(x, y):
+    """
+    Converts (batches of) stored mol graphs to the dtypes expected by the SchNet model
+    """
+    nodes, edges, edges_i = x
+    return (tf.cast(nodes, "float32"), tf.cast(edges, "float32"), tf.cast(edges_i, "int32")), y
+
+
+def smiles_to_schnet_input(smiles, dataset=None, parameters=None):
+    if (parameters or {}).get('inputType', '3D') == 'topology':
+        # Topology graphs take less than a millisecond, they are neither embedded in a worker process nor cached
+        (nodes, edges, edges_i) = smiles_to_topology_graph(smiles)
+    else:
+        # Converts our molecule to a mol graph like the ones of the dataset the model was trained on,
+        # embedding it in a worker process of the chemistry service
+        graph = (dataset.descriptor.get('mol_graph') if dataset is not None else None) or {}
+        cutoff, max_neighbors = graph.get('cutoff'), graph.get('maxNeighbors')
+        (nodes, edges, edges_i) = fc.get_or_create('mol_graph', mol_graph_parameters(cutoff, max_neighbors), smiles,
+                                                   lambda: mf.chemistry_service.submit(smiles_to_mol_graph, smiles,
+                                                                                       cutoff, max_neighbors).result())
+    if nodes is None:
+        return None
     node_dim = nodes.shape[-1]
     edge_dim = edges.shape[-1]
 
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import tensorflow as tf
+
+from backend.utils.lru_cache import LRUCache
+
+"""
+Content-addressed cache of built training inputs
+
+Maps (dataset content hash, input representation, labels) to an unbatched tf.data.Dataset of (input, output) pairs.
+Built datasets are kept in memory and saved to disk, so repeated trainings with the same dataset and labels neither
+rebuild their tensors in this process nor after a restart.
+Each key is built by one thread at a time without blocking lookups of other keys. Training workers keep no entries in
+memory, they load them from disk, see configure_tensor_cache.
+Entries on disk are stored per cache version. Entries of other versions and entries not used for a while, e.g. of
+deleted datasets, are removed once per process.
+"""
+
+_tensor_cache_path = Path(__file__.replace('tensor_cache.py', '')) / '..' / 'storage' / 'tensor_cache'
+# raise when altering the structure of cached tensors, invalidates all cached entries
+_tensor_cache_version = 3
+# number of built datasets kept in memory
+_memory_cache_size = 4
+# seconds after which entries not used on disk are removed
+_max_entry_age = 30 * 24 * 60 * 60
+
+_memory_cache = LRUCache(_memory_cache_size)
+# key -> [lock, number of threads holding or waiting for it], so a build only blocks lookups of the same key
+_build_locks = dict()
+_build_locks_lock = threading.Lock()
+_cleaned = False
+
+
+def tensor_cache_key(dataset_hash, representation, labels):
+    """
+    Creates the cache key for a built dataset
+    :param dataset_hash: content hash of the source dataset
+    :param representation: string describing the input, e.g. 'fingerprints_512' or 'mol_graph'
+    :param labels: list of labels in the order they are used as output
+    :return: hex digest
+    """
+    content = json.dumps([_tensor_cache_version, dataset_hash, representation, list(labels)])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_tensor_dataset(dataset, representation, labels, build):
+    """
+    Gets the built tf.data source for a dataset from the in-memory or the on-disk cache.
+    On a miss it is built with build(), saved to disk and kept in memory.
+    :param dataset: ColumnarDataset the tensors are built from
+    :param representation: string describing the input, e.g. 'fingerprints_512' or 'mol_graph'
+    :param labels: list of labels in the order they are used as output
+    :param build: function without arguments returning an unbatched tf.data.Dataset
+    :return: unbatched tf.data.Dataset of (input, output) pairs
+    """
+    key = tensor_cache_key(dataset.content_hash, representation, labels)
+    with _build_lock(key):
+        if _memory_cache is None:
+            return _load_or_build(key, build, keep_built=False)
+        built = _memory_cache.get(key)
+        if built is None:
+            built = _load_or_build(key, build)
+            _memory_cache.put(key, built)
+        return built
+
+
+def configure_tensor_cache(path, memory_cache_size=_memory_cache_size):
+    """
+    Configures the cache of this process, e.g. of a training worker
+    :param path: directory holding the entries on disk
+    :param memory_cache_size: number of built datasets kept in memory. With 0, every lookup loads its entry from disk
+    lazily, so processes share its pages through the OS page cache instead of each holding a copy of its tensors
+    """
+    global _tensor_cache_path, _memory_cache
+    _tensor_cache_path = Path(path)
+    _memory_cache = LRUCache(memory_cache_size) if memory_cache_size else None
+
+
+def get_tensor_cache_path():
+    return _tensor_cache_path
+
+
+def get_tensor_cache_stats():
+    return _memory_cache.stats() if _memory_cache is not None else dict()
+
+
+def clean_tensor_cache(max_age=_max_entry_age):
+    """
+    Removes the entries of other cache versions and entries not used for max_age seconds from disk
+    :param max_age: seconds since an entry was last used
+    """
+    if not _tensor_cache_path.exists():
+        return
+    version_path = _entry_path('')
+    for path in _tensor_cache_path.iterdir():
+        if path != version_path:
+            shutil.rmtree(path, ignore_errors=True)
+    if not version_path.exists():
+        return
+    deadline = time.time() - max_age
+    for path in version_path.iterdir():
+        try:
+            if path.stat().st_mtime < deadline:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # removed by another process meanwhile
+            pass
+
+
+def _entry_path(key):
+    return _tensor_cache_path / f'v{_tensor_cache_version}' / key
+
+
+@contextmanager
+def _build_lock(key):
+    # holds the lock of key, the lock is dropped once no thread holds or waits for it
+    global _cleaned
+    with _build_locks_lock:
+        if not _cleaned:
+            _cleaned = True
+            # sweeps in the background, so neither this build nor lookups of other keys wait for the disk
+            threading.Thread(target=clean_tensor_cache, daemon=True).start()
+        build_lock = _build_locks.setdefault(key, [threading.Lock(), 0])
+        build_lock[1] += 1
+    try:
+        with build_lock[0]:
+            yield
+    finally:
+        with _build_locks_lock:
+            build_lock[1] -= 1
+            if not build_lock[1]:
+                del _build_locks[key]
+
+
+def _load_or_build(key, build, keep_built=True):
+    # keep_built returns the built dataset, holding its tensors in memory, instead of loading it from disk lazily
+    path = _entry_path(key)
+    if path.exists():
+        try:
+            # marks the entry as used, see clean_tensor_cache
+            os.utime(path)
+        except OSError:
+            pass
+        try:
+            return tf.data.Dataset.load(str(path))
+        except (tf.errors.OpError, ValueError) as e:
+            print(f'Error loading cached tensors {key}, rebuilding them')
+            print(e)
+            shutil.rmtree(path, ignore_errors=True)
+
+    built = build()
+    # Saves to a temporary directory of this process first, so an interrupted save never leaves a broken cache entry
+    # and processes building the same entry do not interfere
+    temporary_path = path.with_name(f'{key}.{os.getpid()}.tmp')
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        built.save(str(temporary_path))
+        temporary_path.rename(path)
+    except (tf.errors.OpError, OSError) as e:
+        # another process may have saved the entry meanwhile
+        if not path.exists():
+            print(f'Error saving cached tensors {key}')
+            print(e)
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    if not keep_built and path.exists():
+        return tf.data.Dataset.load(str(path))
+    return built
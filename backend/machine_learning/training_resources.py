@@ -0,0 +1,105 @@
+import os
+
+import tensorflow as tf
+
+"""
+Division of the machine's CPUs between trainings
+
+TensorFlow sizes its thread pools once per process, before the first operation runs. Every training worker process
+sizes them to the thread budget of its first training: the share of the CPUs it gets at the expected load, derived
+from the number of running and waiting trainings. Running trainings are pinned to sets of CPUs, which are
+rebalanced whenever a training starts or finishes, so a lone training uses the whole machine and many trainings do
+not oversubscribe it.
+Only the CPU sets follow the rebalancing. The thread budget of a running training stays fixed, so a training started
+alongside others keeps its smaller thread pools after they finish. A training started alone keeps its larger pools
+once others start, it is never pinned to fewer CPUs than it has threads and shares the CPUs beyond its even share with
+the trainings pinned next to it, see allocate_cpus. Idle workers are reused only by trainings whose even share of the
+CPUs fits their thread pools.
+"""
+
+
+def available_cpus():
+    """
+    :return: sorted list of the IDs of the CPUs this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def thread_budget(cpus, running, waiting, slots):
+    """
+    Computes the number of threads of a starting training
+    :param cpus: number of CPUs shared by all trainings
+    :param running: number of trainings running already
+    :param waiting: number of trainings waiting for a slot, they keep the machine busy once started
+    :param slots: maximum number of trainings running at once
+    :return: number of threads, at least 1
+    """
+    expected = max(min(running + 1 + waiting, slots), 1)
+    return max(cpus // expected, 1)
+
+
+def split_cpus(cpus, jobs):
+    """
+    Splits CPUs into contiguous sets of (almost) equal size
+    :param cpus: list of CPU IDs
+    :param jobs: number of sets
+    :return: list of jobs lists of CPU IDs, CPUs are shared round-robin if there are more jobs than CPUs
+    """
+    if not jobs:
+        return []
+    share, remainder = divmod(len(cpus), jobs)
+    sets = list()
+    start = 0
+    for job in range(jobs):
+        size = share + (job < remainder)
+        sets.append(cpus[start:start + size] if size else [cpus[job % len(cpus)]])
+        start += size
+    return sets
+
+
+def allocate_cpus(cpus, budgets):
+    """
+    Assigns CPUs to running trainings, split like split_cpus, but a training never gets fewer CPUs than its thread
+    budget. Its set is extended by the CPUs following it, which it shares with the trainings they are assigned to
+    :param cpus: list of CPU IDs
+    :param budgets: thread budgets of the running trainings, in the order they started
+    :return: list of lists of CPU IDs, one per training
+    """
+    sets = list()
+    for cpu_set, budget in zip(split_cpus(cpus, len(budgets)), budgets):
+        if len(cpu_set) < budget:
+            start = cpus.index(cpu_set[0])
+            cpu_set = sorted(cpus[(start + offset) % len(cpus)] for offset in range(min(budget, len(cpus))))
+        sets.append(cpu_set)
+    return sets
+
+
+def configure_threads(threads):
+    """
+    Sizes TensorFlow's thread pools of this process, only has an effect before its first operation
+    :param threads: number of threads per pool
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def pin_process(cpus):
+    """
+    Restricts all threads of this process to the given CPUs, threads started later inherit the restriction of the
+    thread starting them. Does nothing on platforms without CPU affinity
+    :param cpus: list of CPU IDs
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        thread_ids = os.listdir('/proc/self/task')
+    except OSError:
+        thread_ids = [0]
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(int(thread_id), cpus)
+        except OSError:
+            # the thread exited meanwhile
+            pass
@@ -0,0 +1,187 @@
+import multiprocessing
+import threading
+import traceback
+from collections import OrderedDict, deque
+
+"""
+Scheduler running trainings on a bounded number of worker threads
+
+Jobs wait in one FIFO queue per user. Users take turns in the order they joined the queue (round robin), so a user
+submitting many jobs cannot delay the jobs of others. Waiting jobs are told their position whenever it changes and
+can be cancelled until they start.
+"""
+
+# number of trainings running at the same time
+_training_slots = max(multiprocessing.cpu_count() // 4, 1)
+
+
+def training_slots():
+    """
+    :return: default number of trainings running at the same time
+    """
+    return _training_slots
+
+
+class _Job:
+    def __init__(self, user_id, function):
+        self.user_id = user_id
+        self.function = function
+
+
+class TrainingScheduler:
+    """
+    Runs submitted jobs on at most slots worker threads at once, see module docstring.
+    Worker threads are started on the first submission.
+    """
+
+    def __init__(self, slots=_training_slots, max_jobs_per_user=1, notify_position=None):
+        """
+        :param slots: number of jobs running at the same time
+        :param max_jobs_per_user: number of jobs a user may have waiting or running at once
+        :param notify_position: optional function(user_id, position) called for every waiting job whose position
+        changed, positions start at 1
+        """
+        self.slots = slots
+        self.max_jobs_per_user = max_jobs_per_user
+        self.notify_position = notify_position
+        self.condition = threading.Condition()
+        # user_id: deque of waiting jobs, users in the order of their next turn
+        self.queues = OrderedDict()
+        # user_id: number of running jobs
+        self.running = dict()
+        # job: last notified position
+        self.positions = dict()
+        self.workers = list()
+        self.closed = False
+
+    def submit(self, user_id, function):
+        """
+        Queues a job, it runs as soon as a slot is free and it is the user's turn
+        :param user_id: ID of the user the job belongs to
+        :param function: function without arguments running the job, exceptions are printed and ignored
+        :return: True if the job was queued, False if the user has max_jobs_per_user jobs already or the scheduler
+        is closed
+        """
+        with self.condition:
+            if self.closed or self.__jobs_of(user_id) >= self.max_jobs_per_user:
+                return False
+            self.queues.setdefault(user_id, deque()).append(_Job(user_id, function))
+            while len(self.workers) < self.slots:
+                worker = threading.Thread(target=self.__work, name=f'training-worker-{len(self.workers)}',
+                                          daemon=True)
+                self.workers.append(worker)
+                worker.start()
+            self.condition.notify()
+            changed = self.__update_positions()
+        self.__notify(changed)
+        return True
+
+    def cancel(self, user_id):
+        """
+        Removes all waiting jobs of a user, running jobs are not affected
+        :param user_id: ID of the user whose jobs to cancel
+        :return: True if a waiting job was removed
+        """
+        with self.condition:
+            jobs = self.queues.pop(user_id, None)
+            if not jobs:
+                return False
+            for job in jobs:
+                self.positions.pop(job, None)
+            changed = self.__update_positions()
+        self.__notify(changed)
+        return True
+
+    def is_scheduled(self, user_id):
+        """
+        :return: True if the user has a waiting or running job
+        """
+        with self.condition:
+            return self.__jobs_of(user_id) > 0
+
+    def position(self, user_id):
+        """
+        :return: position of the user's next waiting job, starting at 1, or 0 if the user has no waiting job
+        """
+        with self.condition:
+            for position, job in enumerate(self.__waiting(), start=1):
+                if job.user_id == user_id:
+                    return position
+            return 0
+
+    def get_stats(self):
+        """
+        :return: dictionary with the number of slots and of running and waiting jobs
+        """
+        with self.condition:
+            return {'slots': self.slots,
+                    'running': sum(self.running.values()),
+                    'waiting': sum(len(jobs) for jobs in self.queues.values())}
+
+    def close(self):
+        """
+        Drops all waiting jobs and stops the worker threads once their running jobs are done
+        """
+        with self.condition:
+            self.closed = True
+            self.queues.clear()
+            self.positions.clear()
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while not self.queues and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                job = self.__next_job()
+                self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+                changed = self.__update_positions()
+            self.__notify(changed)
+
+            try:
+                job.function()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.running[job.user_id] -= 1
+                    if not self.running[job.user_id]:
+                        del self.running[job.user_id]
+
+    def __next_job(self):
+        # the user whose turn it is takes their oldest job and, if they have more, queues up again at the end
+        user_id, jobs = next(iter(self.queues.items()))
+        job = jobs.popleft()
+        self.positions.pop(job, None)
+        if jobs:
+            self.queues.move_to_end(user_id)
+        else:
+            del self.queues[user_id]
+        return job
+
+    def __waiting(self):
+        # waiting jobs in the order they will start, every user gets one job per round
+        queues = list(self.queues.values())
+        rounds = max((len(jobs) for jobs in queues), default=0)
+        return [jobs[idx] for idx in range(rounds) for jobs in queues if idx < len(jobs)]
+
+    def __update_positions(self):
+        changed = list()
+        for position, job in enumerate(self.__waiting(), start=1):
+            if self.positions.get(job) != position:
+                self.positions[job] = position
+                changed.append((job.user_id, position))
+        return changed
+
+    def __notify(self, changed):
+        # outside the lock, notifying may be slow
+        if self.notify_position:
+            for user_id, position in changed:
+                self.notify_position(user_id, position)
+
+    def __jobs_of(self, user_id):
+        return len(self.queues.get(user_id, ())) + self.running.get(user_id, 0)
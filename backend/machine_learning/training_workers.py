@@ -0,0 +1,420 @@
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
+from pathlib import Path
+
+import keras.callbacks
+import numpy as np
+import tensorflow as tf
+
+from backend.machine_learning import ml_dicts as mld
+from backend.machine_learning import tensor_cache as tc
+from backend.machine_learning.input_pipeline import InputPipeline, batch_examples
+from backend.machine_learning.training_resources import allocate_cpus, available_cpus, configure_threads, \
+    pin_process, thread_budget
+from backend.utils.dataset_storage import open_dataset
+
+"""
+Trainings independent of the storage handler and a pool of worker processes running them
+
+Every worker process runs one training at a time, so Keras' Python overhead neither holds the GIL of the API process
+nor competes with other trainings for it. A training is sent to a worker as a dictionary of picklable arguments, the
+dataset is opened from its path (columns are memory-mapped) and built inputs come from the tensor cache on disk.
+Progress is sent back as events, the trained model is saved to a temporary directory from which the storage handler
+moves it into place, see SavedModel.
+Workers are persistent, so TensorFlow is imported only once per process. They use the tensor cache directory of the
+process starting them, but keep no built inputs in memory: every training loads them from disk lazily, so memory does
+not grow with the number of workers. Its split caches are the only copy of its inputs a training holds, see
+InputPipeline.
+Each worker sizes its thread pools to its thread budget and runs on the CPUs assigned to it, see training_resources.
+"""
+
+# a forked child of a process running TensorFlow's thread pools may deadlock, workers start from a fresh interpreter
+_context = multiprocessing.get_context('spawn')
+# seconds a worker may take to exit before it is terminated
+_shutdown_timeout = 5
+
+
+class TrainingRun:
+    """
+    Holds all the information required to train a model on a dataset.
+    Knows nothing about users and storage, so it runs in the API process as well as in worker processes
+    """
+
+    def __init__(self, user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size, model_type,
+                 parameters, dataset, metrics, fitting_id=None, initial_model=None, initial_epoch=0):
+        """
+        :param model_type: type of the base model, key of ml_dicts.creation_functions
+        :param parameters: model parameters
+        :param dataset: ColumnarDataset or ShardedDataset to train on
+        :param metrics: names of the base model's metrics
+        :param fitting_id: ID of the fitting to continue or None
+        :param initial_model: trained model of that fitting, replaces the newly created model
+        :param initial_epoch: number of epochs the initial model was trained for
+        """
+        self.user_id = user_id
+        self.dataset_id = dataset_id
+        self.model_id = model_id
+        self.batch_size = int(batch_size)
+        self.learning_rate = learning_rate
+        self.labels = labels
+        self.model, ds = self.create_model_and_set(model_type, parameters, dataset, labels, metrics)
+        self.input_pipeline = InputPipeline(mld.batch_functions.get(model_type, batch_examples), self.batch_size,
+                                            dataset.streaming)
+        self.training_set, self.validation_set, self.test_set = self.split_dataset(ds, dataset.get_split_indices())
+        self.initial_epoch = initial_epoch
+        self.fitting_id = fitting_id
+        if initial_model is not None:
+            self.model = initial_model
+        self.epochs = int(epochs) + self.initial_epoch
+
+    def create_model_and_set(self, model_type, parameters, dataset, labels, metrics):
+        # decode loss, optimizer and metrics from strings
+        optimizer = mld.optimizers.get(parameters.get('optimizer'))(learning_rate=self.learning_rate)
+        return mld.creation_functions.get(model_type)(parameters,
+                                                      dataset,
+                                                      labels,
+                                                      mld.losses.get(parameters.get('lossFunction'))(),
+                                                      optimizer,
+                                                      [mld.metrics.get(metric)() for metric in metrics])
+
+    def split_dataset(self, dataset, split_indices):
+        """"
+        splits unbatched dataset into training (70%), validation(20%) and test (10%) examples
+        the splits are stored alongside the dataset, so they are the same in every epoch, training and process
+        :param dataset: dataset to split
+        :param split_indices: training, validation and test indices, see ColumnarDataset.get_split_indices
+        :return: batched training, validation and test sets, see InputPipeline
+        """
+        membership = np.zeros(sum(len(indices) for indices in split_indices), dtype=np.uint8)
+        for split, indices in enumerate(split_indices):
+            membership[indices] = split
+        membership = tf.constant(membership)
+        ds = dataset.enumerate()
+
+        def select(split):
+            return ds.filter(lambda index, example: tf.gather(membership, index) == split) \
+                .map(lambda index, example: example) \
+                .apply(tf.data.experimental.assert_cardinality(len(split_indices[split])))
+
+        return (self.input_pipeline.training(select(0)),
+                self.input_pipeline.evaluation(select(1), 'validation'),
+                self.input_pipeline.evaluation(select(2), 'test'))
+
+    def start_training(self, callbacks):
+        # Trains the model
+        self.model.fit(self.training_set, validation_data=self.validation_set,
+                       epochs=self.epochs,
+                       batch_size=self.batch_size,
+                       callbacks=callbacks,
+                       initial_epoch=self.initial_epoch,
+                       verbose=0)
+
+    def evaluate_model(self):
+        results = self.model.evaluate(self.test_set, verbose=0)
+        names = self.model.metrics_names
+
+        # Evaluates the model, saves result with metric names
+        evaluation = dict(zip(names, results))
+
+        # R2 is our replacement for accuracy
+        # Thus every model needs to have R2 as a metric
+        accuracy = round(evaluation.get('r_square') * 100, 2)
+        return accuracy
+
+    def stop_training(self):
+        self.model.stop_training = True
+        return self.model.stop_training
+
+
+class SavedModel:
+    """
+    Model saved by a worker process. Stands in for the model when saving fittings: save() moves the saved files
+    instead of serializing the model again
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory the model was saved to, None if it could not be saved
+        """
+        self.path = Path(path) if path else None
+
+    def save(self, path):
+        if self.path is None:
+            raise NotImplementedError('Model could not be saved by its worker')
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.move(self.path, path)
+        self.path = None
+
+    def discard(self):
+        """
+        Deletes the saved files unless they were moved by save()
+        """
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+
+class TrainingWorkerPool:
+    """
+    Persistent pool of worker processes running one training each, see module docstring.
+    Processes are started when needed and reused by later trainings whose share of the CPUs fits their thread budget.
+    The number of trainings running at once is bounded by the caller, e.g. by the TrainingScheduler.
+    The CPUs are divided between the running trainings, see training_resources
+    """
+
+    def __init__(self, processes, cpus=None, notify_allocation=None):
+        """
+        Creates a new TrainingWorkerPool, no processes are started yet
+        :param processes: maximum number of trainings running at once, as many idle processes are kept for later
+        trainings
+        :param cpus: list of IDs of the CPUs to divide between trainings, defaults to all CPUs available
+        :param notify_allocation: optional function(user_id, allocation) called whenever the allocation of a running
+        training changed, see allocation()
+        """
+        self.processes = processes
+        self.cpus = cpus or available_cpus()
+        self.notify_allocation = notify_allocation
+        self.lock = threading.Lock()
+        self.idle = list()
+        # user_id: worker running the user's training, in the order the trainings started
+        self.busy = dict()
+        self.closed = False
+
+    def run(self, user_id, arguments, on_event, waiting=0):
+        """
+        Runs a training in a worker process, blocks until it is done
+        :param user_id: ID of the user the training belongs to, a user may run one training at a time
+        :param arguments: picklable keyword arguments of TrainingRun, with dataset_path and fitting_path instead of
+        dataset and initial_model
+        :param on_event: function(event, payload) called in the calling thread for every event of the training:
+        ('started', epochs), ('update', logs), ('done', (epochs_trained, accuracy, path of the saved model)) or
+        ('error', reason), the last event is always 'done' or 'error'
+        :param waiting: number of trainings waiting to start, a training started on a busy server gets fewer threads
+        :return: True if the training is done, False if it failed
+        """
+        replaced = None
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('TrainingWorkerPool is closed')
+            threads = thread_budget(len(self.cpus), len(self.busy), waiting, self.processes)
+            # reuses the idle worker with the most threads that still fit the CPUs the training gets once started
+            share = max(len(self.cpus) // (len(self.busy) + 1), 1)
+            fitting = [worker for worker in self.idle if worker.threads <= share]
+            worker = max(fitting, key=lambda idle: idle.threads, default=None)
+            if worker is not None:
+                self.idle.remove(worker)
+            else:
+                # thread pools cannot be resized, the idle worker with the most threads is replaced by a new one
+                if self.idle:
+                    replaced = max(self.idle, key=lambda idle: idle.threads)
+                    self.idle.remove(replaced)
+                worker = _TrainingWorker(threads)
+            self.busy[user_id] = worker
+            changed = self.__rebalance()
+            # sent while holding the lock, so stop requests always arrive after the training
+            worker.send(('train', arguments))
+        if replaced is not None:
+            replaced.close()
+        self.__notify(changed)
+
+        finished = False
+        event = None
+        try:
+            while not finished:
+                try:
+                    event, payload = worker.connection.recv()
+                except (EOFError, OSError):
+                    event, payload = 'error', 'training worker crashed'
+                finished = event in ('done', 'error')
+                on_event(event, payload)
+        finally:
+            with self.lock:
+                self.busy.pop(user_id, None)
+                changed = self.__rebalance()
+                # a worker whose events were not all received cannot run another training
+                keep = finished and worker.is_alive() and not self.closed and len(self.idle) < self.processes
+                if keep:
+                    self.idle.append(worker)
+            if not keep:
+                worker.close()
+            self.__notify(changed)
+        return event == 'done'
+
+    def stop(self, user_id):
+        """
+        Stops the running training of a user after its current batch, the training ends as if it was done
+        :return: True if the user has a running training
+        """
+        with self.lock:
+            worker = self.busy.get(user_id)
+            return worker is not None and worker.send(('stop', None))
+
+    def allocation(self, user_id):
+        """
+        :return: dictionary with the number of threads of the user's running training and the IDs of the CPUs it
+        runs on, None if the user has no running training
+        """
+        with self.lock:
+            worker = self.busy.get(user_id)
+            return worker.allocation() if worker is not None else None
+
+    def close(self):
+        """
+        Stops the idle worker processes, busy ones exit once their training is done
+        """
+        with self.lock:
+            self.closed = True
+            workers, self.idle = self.idle, list()
+        for worker in workers:
+            worker.close()
+
+    def __rebalance(self):
+        # Pins the running trainings to CPUs in the order they started, returns the changed allocations.
+        # Thread pools are sized once per process, so no training is pinned to fewer CPUs than it has threads
+        changed = list()
+        budgets = [worker.threads for worker in self.busy.values()]
+        for (user_id, worker), cpus in zip(self.busy.items(), allocate_cpus(self.cpus, budgets)):
+            if cpus != worker.cpus:
+                worker.cpus = cpus
+                worker.send(('cpus', cpus))
+                changed.append((user_id, worker.allocation()))
+        return changed
+
+    def __notify(self, changed):
+        # outside the lock, notifying may be slow
+        if self.notify_allocation:
+            for user_id, allocation in changed:
+                self.notify_allocation(user_id, allocation)
+
+
+class _TrainingWorker:
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.cpus = None
+        self.connection, worker_connection = _context.Pipe()
+        self.process = _context.Process(target=_serve,
+                                        args=(worker_connection, threads, str(tc.get_tensor_cache_path())),
+                                        name='training-worker', daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def allocation(self):
+        return {'threads': self.threads, 'cpus': self.cpus}
+
+    def send(self, message):
+        try:
+            self.connection.send(message)
+            return True
+        except OSError:
+            return False
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        self.send(('close', None))
+        self.process.join(_shutdown_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+class _StopSignal:
+    # Stop requests for the training running in a worker process, may arrive before its model exists
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.model = None
+        self.requested = False
+
+    def reset(self):
+        with self.lock:
+            self.model = None
+            self.requested = False
+
+    def attach(self, model):
+        with self.lock:
+            self.model = model
+            if self.requested:
+                model.stop_training = True
+
+    def request(self):
+        with self.lock:
+            self.requested = True
+            if self.model is not None:
+                self.model.stop_training = True
+
+
+class _ProgressReporter(keras.callbacks.Callback):
+    # Sends the progress of a training to the API process, the worker's counterpart of ml_functions.LiveStats
+
+    def __init__(self, connection, epochs, stop_signal):
+        super().__init__()
+        self.connection = connection
+        self.epochs = epochs
+        self.stop_signal = stop_signal
+        self.epochs_trained = 0
+
+    def on_train_begin(self, logs=None):
+        # fit() resets stop_training, so stop requests are applied from here on
+        self.stop_signal.attach(self.model)
+        self.connection.send(('started', self.epochs))
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs_trained = epoch + 1
+        self.connection.send(('update', dict(logs or {}) | {'epoch': epoch}))
+
+
+def _serve(connection, threads, tensor_cache_path):
+    # Main function of a worker process, messages are received in a thread, so stop requests arrive while training
+    configure_threads(threads)
+    tc.configure_tensor_cache(tensor_cache_path, memory_cache_size=0)
+    jobs = queue.SimpleQueue()
+    stop_signal = _StopSignal()
+
+    def receive():
+        while True:
+            try:
+                message, payload = connection.recv()
+            except (EOFError, OSError):
+                message, payload = 'close', None
+            if message == 'stop':
+                stop_signal.request()
+            elif message == 'cpus':
+                pin_process(payload)
+            elif message == 'train':
+                stop_signal.reset()
+                jobs.put(payload)
+            else:
+                jobs.put(None)
+                return
+
+    threading.Thread(target=receive, daemon=True).start()
+    while (arguments := jobs.get()) is not None:
+        try:
+            _train(connection, stop_signal, **arguments)
+        except Exception as e:
+            traceback.print_exc()
+            connection.send(('error', f'{e!r}'))
+
+
+def _train(connection, stop_signal, dataset_path, fitting_path=None, **arguments):
+    initial_model = tf.keras.models.load_model(fitting_path) if fitting_path else None
+    training = TrainingRun(dataset=open_dataset(Path(dataset_path)), initial_model=initial_model, **arguments)
+    reporter = _ProgressReporter(connection, training.epochs, stop_signal)
+    training.start_training([reporter])
+    accuracy = training.evaluate_model()
+
+    path = tempfile.mkdtemp(prefix='fitting_')
+    try:
+        training.model.save(path)
+    except NotImplementedError:
+        shutil.rmtree(path, ignore_errors=True)
+        path = None
+    connection.send(('done', (reporter.epochs_trained, accuracy, path)))
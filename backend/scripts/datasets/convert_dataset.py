@@ -0,0 +1,109 @@
+from pathlib import Path
+import pickle
+import sys
+import numpy as np
+from backend.utils.dataset_storage import ColumnarDataset, write_dataset, write_sharded_dataset, pack_fingerprints, \
+    hash_columns, read_descriptor, write_descriptor
+from backend.scripts.datasets.create_dataset import create_sketches, dataset_version
+
+"""
+version of the pickled datasets this script can convert
+"""
+_pickle_version = 5
+"""
+version of the columnar datasets with unpacked fingerprints this script can upgrade
+"""
+_unpacked_version = 6
+
+
+def convert_dataset(path, output_path=None):
+    """
+    Converts a dataset in the old pickle format (version 5) to the columnar format without featurizing it again
+    :param path: string path to dataset pickle (pkl) file
+    :param output_path: path of the dataset directory to create, defaults to the pickle path without suffix
+    :return: path of the converted dataset or None if the pickle could not be converted
+    """
+    path = (Path.cwd() / path)
+    output_path = path.with_suffix('') if output_path is None else Path(output_path)
+    with path.open('rb') as file:
+        old_set = pickle.load(file)
+
+    if old_set.get('version') != _pickle_version:
+        print(f'Cannot convert {path.name}: expected version {_pickle_version}, got {old_set.get("version")}')
+        return None
+
+    old_set['version'] = dataset_version
+    output_path = write_dataset(output_path, old_set)
+    add_sketches(output_path)
+    return output_path
+
+
+def upgrade_dataset(path):
+    """
+    Upgrades a columnar dataset of version 6 in place by bit-packing its fingerprint columns
+    :param path: string path to the columnar dataset directory
+    :return: path of the upgraded dataset or None if the dataset could not be upgraded
+    """
+    path = (Path.cwd() / path)
+    descriptor = read_descriptor(path)
+    if descriptor.get('version') != _unpacked_version:
+        print(f'Cannot upgrade {path.name}: expected version {_unpacked_version}, got {descriptor.get("version")}')
+        return None
+
+    for size in descriptor.get('fingerprint_sizes'):
+        column_path = path / f'fingerprints_{size}.npy'
+        packed = pack_fingerprints(np.load(column_path))
+        temporary_path = column_path.with_suffix('.tmp.npy')
+        np.save(temporary_path, packed)
+        temporary_path.replace(column_path)
+
+    descriptor['version'] = dataset_version
+    descriptor['hash'] = hash_columns(path)
+    write_descriptor(path, descriptor)
+    return path
+
+
+def add_sketches(path):
+    """
+    Adds quantile sketches of all labels to the descriptor of a columnar dataset which has none, e.g. one created
+    before sketches were introduced. Its columns, and therefore its hash, are not changed.
+    :param path: string path to the columnar dataset directory
+    :return: path of the dataset or None if it already had sketches
+    """
+    path = (Path.cwd() / path)
+    descriptor = read_descriptor(path)
+    if 'sketches' in descriptor:
+        return None
+    descriptor['sketches'] = create_sketches(path, descriptor.get('labels'))
+    write_descriptor(path, descriptor)
+    return path
+
+
+def shard_dataset(path, output_path, shard_size=None):
+    """
+    Converts a columnar dataset to TFRecord shards, which are streamed during training instead of being loaded into
+    memory. Use this for datasets larger than the memory available for training.
+    :param path: string path to the columnar dataset directory
+    :param output_path: path of the sharded dataset directory to create
+    :param shard_size: number of molecules per shard, see write_sharded_dataset
+    :return: path of the sharded dataset
+    """
+    return write_sharded_dataset(output_path, ColumnarDataset(Path.cwd() / path), shard_size)
+
+
+# HOW TO USE:
+# python -m backend.scripts.datasets.convert_dataset backend/storage/data/some_set.pkl [...]
+# The converted dataset is written next to the pickle, which can be deleted afterwards
+# Columnar datasets of version 6 given as directories are upgraded in place, datasets without sketches get them added
+# To shard a converted dataset for streaming, call shard_dataset('some_set', 'some_set_sharded')
+if __name__ == '__main__':
+    for dataset_path in sys.argv[1:]:
+        if Path(dataset_path).is_dir():
+            if upgrade_dataset(dataset_path):
+                print(f'upgraded {dataset_path}')
+            if add_sketches(dataset_path):
+                print(f'added sketches to {dataset_path}')
+        else:
+            converted_path = convert_dataset(dataset_path)
+            if converted_path:
+                print(f'converted {dataset_path} to {converted_path}')
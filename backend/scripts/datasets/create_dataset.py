@@ -1,112 +1,252 @@
+import json
 import math
-from multiprocessing import Pool, cpu_count
+import shutil
+from multiprocessing import cpu_count
 import pandas as pd
 from pathlib import Path
-import pickle
 from backend.utils.molecule_formats import *
+from backend.utils.molecule_formats import mol_graph_parameters
+from backend.utils.dataset_storage import ColumnarDataset, DatasetWriter, dataset_id, read_descriptor
+from backend.utils import featurization_cache as fc
+from backend.utils.quantile_sketch import create_sketch, merge_sketches
+from backend.utils.featurization_pool import FeaturizationPool, TaskFailure, default_task_timeout
 import numpy as np
 
 """
 current dataset version, raise when altering dataset content
 keep in sync with storage_handler dataset_version
 """
-_version = 5
+dataset_version = 7
+# number of csv rows read and featurized at once, bounds the memory used while creating a dataset
+_chunk_size = 10000
+# number of molecules whose fingerprints are computed by one task, see featurize_chunk
+_fingerprint_batch_size = 1000
+# report of the rows skipped while creating a dataset, written to the dataset directory
+_skipped_report_file = 'skipped.json'
 
 
-def smiles_to_fingerprints(smiles, sizes, radius=2):
-    result_dict = dict()
-    for size in sizes:
-        result_dict[str(size)] = smiles_to_fingerprint(smiles, size, radius)
-        if not result_dict[str(size)]:
-            return None
-    return result_dict
-
-
-def smiles_list_to_fingerprint_input(smiles_list, sizes, radius=2):
-    result = list()
-    for smiles in smiles_list:
-        result.append((smiles, sizes, radius))
-    return result
+def read_column_names(path):
+    """
+    Reads the column names of a .csv or .parquet file without reading its rows
+    :param path: path to the .csv or .parquet file
+    :return: list of column names
+    """
+    if Path(path).suffix == '.parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).schema_arrow.names
+    return list(pd.read_csv(path, nrows=0).columns)
 
 
-def make_data_label_pairs(data, label):
-    result_list = list()
-    for x in data:
-        result_list.append({str(label): x})
-    return result_list
+def read_chunks(path, columns, max_size, data_offset, chunk_size=_chunk_size):
+    """
+    Reads rows of a .csv or .parquet file chunk by chunk, only the given columns are read
+    :param path: path to the .csv or .parquet file
+    :param columns: list of column names to read
+    :param max_size: maximum number of rows to read
+    :param data_offset: number of rows to skip
+    :param chunk_size: maximum number of rows per chunk
+    :return: generator of pandas DataFrames
+    """
+    if Path(path).suffix == '.parquet':
+        # pyarrow is only needed for parquet input
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size,
+                                                                                 columns=columns))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+
+    position = 0
+    for chunk in chunks:
+        start = max(data_offset - position, 0)
+        end = min(data_offset + max_size - position, len(chunk))
+        position += len(chunk)
+        if start < end:
+            yield chunk[start:end]
+        if position >= data_offset + max_size:
+            break
+
+
+def featurize_chunk(pool, smiles_list, sizes, radius, canonical_list=None, graph=None):
+    """
+    Featurizes SMILES codes to bit-packed fingerprints of all sizes and mol graphs, taking them from the featurization
+    cache where possible. Missing fingerprints are computed for batches of molecules at once, see
+    smiles_list_to_fingerprints. Missing mol graphs are computed by one task per molecule, so a molecule whose embedding
+    times out only skips itself.
+    :param pool: FeaturizationPool computing the missing representations
+    :param smiles_list: list of SMILES codes
+    :param sizes: Array of fingerprint sizes
+    :param radius: fingerprint radius
+    :param canonical_list: canonical SMILES codes of smiles_list if already known, see featurization_cache
+    :param graph: dictionary with 'cutoff' and 'maxNeighbors' of the mol graphs, see create_complete_dataset
+    :return: list of dictionaries with 'fingerprints' (size string: bit-packed uint8 fingerprint) and 'mol_graph', None
+    for molecules that could not be featurized, and a dictionary of index: reason for all molecules that could not be
+    featurized
+    """
+    featurizers = {str(size): ('packed_fingerprint', {'size': size, 'radius': radius}) for size in sizes}
+    graph = graph or {}
+    featurizers['mol_graph'] = ('mol_graph', mol_graph_parameters(graph.get('cutoff'), graph.get('maxNeighbors')))
+
+    if canonical_list is None:
+        canonical_list = [fc.canonical_smiles(smiles) for smiles in smiles_list]
+    keys = list()
+    for canonical in canonical_list:
+        keys.append({name: fc.featurization_key(featurizer, parameters, canonical)
+                     for name, (featurizer, parameters) in featurizers.items()} if canonical else None)
+    cached = fc.get_many([key for entry in keys if entry for key in entry.values()])
+
+    missing = {idx: [name for name, key in entry.items() if key not in cached]
+               for idx, entry in enumerate(keys) if entry}
+    fingerprint_rows = [idx for idx, names in missing.items() if set(names) - {'mol_graph'}]
+    missing_sizes = sorted({int(name) for idx in fingerprint_rows for name in missing[idx] if name != 'mol_graph'})
+    batches = [fingerprint_rows[start:start + _fingerprint_batch_size]
+               for start in range(0, len(fingerprint_rows), _fingerprint_batch_size)]
+    computed = dict()
+    for batch, result in zip(batches, pool.starmap(smiles_list_to_fingerprints, [
+            ([smiles_list[idx] for idx in batch], missing_sizes, radius, True) for batch in batches])):
+        for position, idx in enumerate(batch):
+            if isinstance(result, TaskFailure):
+                computed[idx] = result
+            else:
+                fingerprints, valid = result
+                computed[idx] = {str(size): fingerprints[size][position] if valid[position] else None
+                                 for size in missing_sizes}
+    graph_rows = [idx for idx, names in missing.items() if 'mol_graph' in names]
+    for idx, result in zip(graph_rows, pool.starmap(smiles_to_mol_graph, [
+            (smiles_list[idx], graph.get('cutoff'), graph.get('maxNeighbors')) for idx in graph_rows])):
+        if isinstance(computed.get(idx), TaskFailure):
+            continue
+        # a failed task replaces the molecule's fingerprints, it is skipped anyway
+        computed[idx] = result if isinstance(result, TaskFailure) else computed.get(idx, dict()) | {'mol_graph': result}
+
+    features = list()
+    reasons = dict()
+    new_entries = dict()
+    for idx, entry in enumerate(keys):
+        if entry is None:
+            features.append(None)
+            reasons[idx] = 'invalid SMILES'
+            continue
+        if isinstance(computed.get(idx), TaskFailure):
+            # timeouts and crashes are not cached, they may succeed on a less loaded machine
+            features.append(None)
+            reasons[idx] = computed[idx].reason
+            continue
+        values = dict()
+        for name, key in entry.items():
+            if key in cached:
+                values[name] = cached[key]
+            else:
+                values[name] = computed[idx][name]
+                new_entries[key] = values[name]
+        x = {'fingerprints': {name: values[name] for name in featurizers if name != 'mol_graph'},
+             'mol_graph': values['mol_graph']}
+        if x['mol_graph'][0] is None:
+            reasons[idx] = 'embedding failed'
+        elif any(fingerprint is None for fingerprint in x['fingerprints'].values()):
+            reasons[idx] = 'fingerprint failed'
+        features.append(None if idx in reasons else x)
+    fc.put_many(new_entries)
+    return features, reasons
 
 
 def create_dataset(path: str,
+                   output_path,
                    max_size: int,
                    data_offset: int,
                    labels: list,
                    smiles_fingerprint_sizes: list,
-                   smiles_fingerprint_radius: int):
+                   smiles_fingerprint_radius: int,
+                   chunk_size: int = _chunk_size,
+                   timeout: float = default_task_timeout,
+                   graph: dict = None):
     """
-    Creates a new Dataset with a given csv file path, a given size, starting at a certain point, with specific labels
-    and fingerprint sizes.
+    Creates a new Dataset with a given .csv or .parquet file path, a given size, starting at a certain point,
+    with specific labels and fingerprint sizes.
+    Rows are read, featurized and written chunk by chunk, so memory use is bounded by the chunk size.
+    Featurizations are taken from the featurization cache where possible, rebuilding a dataset mostly reuses them.
 
-    :param path: Path to the .csv file, from this file
+    :param path: Path to the .csv or .parquet file, from this file
+    :param output_path: Path of the dataset directory to create
     :param max_size: How many entries the dataset should have at most (sometimes it has fewer actual entries)
     :param data_offset: At what point to start taking data from the .csv file (ex: 5 means starting at the 6th entry)
     :param labels: List of strings of labels included in the dataset
     :param smiles_fingerprint_sizes: Array of integers (usually powers of 2)
     :param smiles_fingerprint_radius: numeric value, usually left at 2
-    :return: A list of dictionaries containing inputs and outputs. Pickle & save or add a descriptor
+    :param chunk_size: number of rows read and featurized at once
+    :param timeout: seconds the featurization of a single molecule may take before it is skipped
+    :param graph: dictionary with 'cutoff' and 'maxNeighbors' of the mol graphs, see create_complete_dataset
+    :return: DatasetWriter holding the written columns, add histograms & a descriptor with write_descriptor,
+    and a list of the skipped rows as dictionaries with 'row' (in the source file), 'smiles' and 'reason'
     """
-    csv = pd.read_csv(path)
-    data = csv[min(data_offset, len(csv)):min(max_size + data_offset, len(csv))]
-    data_smiles = data["SMILES"].tolist()
-    print(f'creating set with {min(max_size, len(csv))} entries, starting at entry {data_offset}')
+    columns = read_column_names(path)
+    print(f'creating set with at most {max_size} entries, starting at entry {data_offset}')
+    print(f'loaded set with labels: {labels} of {columns}')
 
-    print(f'loaded set with labels: {labels} of {list(csv.columns)}')
+    if not labels or not set(labels).issubset(set(columns)):
+        raise ValueError(f'Error with label selection, available columns: {columns}')
+
+    writer = DatasetWriter(output_path, labels)
+    skipped = append_rows(writer, path, max_size, data_offset, smiles_fingerprint_sizes, smiles_fingerprint_radius,
+                          chunk_size, timeout, graph=graph)
+    writer.close()
+    print('done')
+    return writer, skipped
 
-    if not labels or not set(labels).issubset(set(csv.columns)):
-        labels = list(csv.columns)
-        raise 'Error with label selection'
 
+def append_rows(writer, path, max_size, data_offset, sizes, radius, chunk_size=_chunk_size, timeout=default_task_timeout,
+                known_smiles=None, graph=None):
+    """
+    Reads, featurizes and appends the rows of a .csv or .parquet file to a DatasetWriter chunk by chunk
+    :param writer: DatasetWriter, its labels are read from the file
+    :param path: path to the .csv or .parquet file
+    :param max_size: maximum number of rows to read
+    :param data_offset: number of rows to skip
+    :param sizes: Array of fingerprint sizes
+    :param radius: fingerprint radius
+    :param chunk_size: number of rows read and featurized at once
+    :param timeout: seconds the featurization of a single molecule may take before it is skipped
+    :param known_smiles: optional set of canonical SMILES codes, rows of molecules in it are skipped as duplicates
+    and the appended molecules are added to it
+    :param graph: dictionary with 'cutoff' and 'maxNeighbors' of the mol graphs, see create_complete_dataset
+    :return: list of the skipped rows as dictionaries with 'row' (in the source file), 'smiles' and 'reason'
+    """
     num_workers = max(cpu_count() - 2, 1)
+    skipped = list()
+    row = data_offset
 
     print(f'using {num_workers} threads')
-    with Pool(num_workers) as p:
-        fingerprints_input = smiles_list_to_fingerprint_input(data_smiles, smiles_fingerprint_sizes,
-                                                              smiles_fingerprint_radius)
-        fingerprints = p.starmap(smiles_to_fingerprints, fingerprints_input)
-        data_mol_graphs = p.map(smiles_to_mol_graph, data_smiles)
-
-    print('converted smiles to input')
-    label_result_list = []
-    for label in labels:
-        label_result_list.append(make_data_label_pairs(data=data[label].tolist(), label=label))
-
-    # creates list of dictionaries with label: data pairs for data  ex [{'homo': 0.0552, 'lumo': 15.2},...]
-    print('created output-label-pairs')
-    y_list = []
-    for pairing in zip(*label_result_list):
-        new_pairing = dict()
-        for entry in pairing:
-            new_pairing |= entry
-        y_list.append(new_pairing)
-    print('created output dictionary')
-
-    # creates dictionary with labels for all different input types
-    # Current input types are SMILES fingerprints & mol_graphs (v3)
-    x_list = []
-    for fingerprint, mol_graph in zip(fingerprints, data_mol_graphs):
-        if mol_graph[0] is not None and fingerprint:
-            x_list.append({'fingerprints': fingerprint, 'mol_graph': mol_graph})
-        else:
-            x_list.append(None)
-    print('created input dictionary')
-
-    # pairs each entry of our input with an entry of our output lists
-    data_zip = zip(x_list, y_list)
-    dataset = list()
-    for input_dict, output_dict in data_zip:
-        if input_dict:
-            dataset.append({'x': input_dict, 'y': output_dict})
-    print('done')
-    return dataset
+    with FeaturizationPool(num_workers, timeout) as p:
+        for chunk in read_chunks(path, ['SMILES'] + writer.labels, max_size, data_offset, chunk_size):
+            data_smiles = chunk['SMILES'].tolist()
+            canonical = [fc.canonical_smiles(smiles) for smiles in data_smiles]
+            duplicates = set()
+            if known_smiles is not None:
+                seen = set()
+                for idx, smiles in enumerate(canonical):
+                    if smiles is not None and (smiles in known_smiles or smiles in seen):
+                        duplicates.add(idx)
+                    seen.add(smiles)
+            selected = [idx for idx in range(len(chunk)) if idx not in duplicates]
+            features, reasons = featurize_chunk(p, [data_smiles[idx] for idx in selected], sizes, radius,
+                                                [canonical[idx] for idx in selected], graph)
+            features = dict(zip(selected, features))
+            reasons = {selected[idx]: reason for idx, reason in reasons.items()} | \
+                      {idx: 'duplicate' for idx in duplicates}
+
+            # pairs each input with its label: value dictionary, ex {'homo': 0.0552, 'lumo': 15.2}
+            # Current input types are SMILES fingerprints & mol_graphs (v3)
+            molecules = list()
+            for idx, y in enumerate(chunk[writer.labels].to_dict('records')):
+                if features.get(idx):
+                    molecules.append({'x': features[idx], 'y': y, 'smiles': canonical[idx]})
+                    if known_smiles is not None:
+                        known_smiles.add(canonical[idx])
+                else:
+                    skipped.append({'row': row + idx, 'smiles': data_smiles[idx], 'reason': reasons.get(idx)})
+            writer.append(molecules)
+            row += len(chunk)
+            print(f'converted {writer.size} entries, skipped {len(skipped)}')
+    return skipped
 
 
 def add_dataset_descriptor(dataset, name, histograms, parameters):
@@ -123,85 +263,192 @@ def add_dataset_descriptor(dataset, name, histograms, parameters):
     labels = list(dataset[0].get('y').keys())
     print(f'adding descriptor with size {size}, labels {labels}')
     return {'name': name, 'size': size, 'labels': labels, 'dataset': dataset,
-            'version': _version, 'histograms': histograms, 'parameters': parameters}
+            'version': dataset_version, 'histograms': histograms, 'parameters': parameters}
 
 
 def create_complete_dataset(path, max_size, data_offset, smiles_fingerprint_sizes, smiles_fingerprint_radius, labels,
-                            name):
+                            name, output_path=None, chunk_size=_chunk_size, timeout=default_task_timeout,
+                            mol_graph_cutoff=None, mol_graph_max_neighbors=None):
     """
-    Creates dataset, histograms and descriptor according to given parameters
-    :param path: path string to csv file
+    Creates dataset, histograms and descriptor according to given parameters and writes them to a dataset directory
+    :param path: path string to .csv or .parquet file
     :param max_size: int, maximum size of dataset
     :param data_offset: offset from which to start taking data from the .csv file
     :param smiles_fingerprint_sizes: Array of integers (usually powers of 2)
     :param smiles_fingerprint_radius: numeric value, usually left at 2
     :param labels: List of strings of labels included in the dataset
     :param name: string name of dataset
-    :return: the dataset descriptor
-    """
-    raw_dataset = create_dataset(path,
-                                 max_size,
-                                 data_offset,
-                                 labels,
-                                 smiles_fingerprint_sizes,
-                                 smiles_fingerprint_radius)
-    histograms = create_histograms(raw_dataset, labels)
-    return add_dataset_descriptor(raw_dataset,
-                                  name,
-                                  histograms,
-                                  [path, max_size, data_offset, smiles_fingerprint_sizes, smiles_fingerprint_radius,
-                                   labels, name])
+    :param output_path: path of the dataset directory to create, defaults to 'output' in the working directory
+    :param chunk_size: number of rows read and featurized at once
+    :param timeout: seconds the featurization of a single molecule may take before it is skipped
+    :param mol_graph_cutoff: if given, mol graphs connect all atoms within this many Ångström instead of bonded atoms
+    :param mol_graph_max_neighbors: maximum number of neighbors per atom if mol_graph_cutoff is given, the nearest
+    are kept, None for all within the cutoff
+    :return: path of the written dataset
+    """
+    graph = {'cutoff': mol_graph_cutoff, 'maxNeighbors': mol_graph_max_neighbors}
+    output_path = Path.cwd() / 'output' if output_path is None else Path(output_path)
+    writer, skipped = create_dataset(path,
+                                     output_path,
+                                     max_size,
+                                     data_offset,
+                                     labels,
+                                     smiles_fingerprint_sizes,
+                                     smiles_fingerprint_radius,
+                                     chunk_size,
+                                     timeout,
+                                     graph)
+    write_skipped_report(output_path, skipped)
+    histograms = create_histograms(output_path, labels)
+    print(f'adding descriptor with size {writer.size}, labels {labels}')
+    return writer.write_descriptor({'name': name, 'version': dataset_version, 'histograms': histograms,
+                                    'sketches': create_sketches(output_path, labels),
+                                    'skipped': len(skipped),
+                                    'mol_graph': graph,
+                                    'parameters': [path, max_size, data_offset, smiles_fingerprint_sizes,
+                                                   smiles_fingerprint_radius, labels, name]})
+
+
+def append_dataset(dataset_path, path, max_size, data_offset, chunk_size=_chunk_size, timeout=default_task_timeout):
+    """
+    Appends the rows of a .csv or .parquet file to an existing dataset. Only the new rows are featurized, rows of
+    molecules already in the dataset (by canonical SMILES) are skipped as duplicates. Size, histograms, skipped rows
+    and hash are updated without re-reading the existing molecules' labels.
+    The extended dataset is written next to the existing one and replaces it in one step once complete, so the
+    dataset stays readable meanwhile. Its content hash changes, its ID stays the same, see dataset_storage.dataset_id.
+    Datasets converted from the pickle format have no smiles columns to detect duplicates with, they cannot be
+    appended to and have to be created anew from their source file.
+    :param dataset_path: path to the dataset directory, it must have smiles columns (created by create_dataset)
+    :param path: path to the .csv or .parquet file, it must contain the dataset's labels
+    :param max_size: maximum number of rows to append
+    :param data_offset: number of rows of the file to skip
+    :param chunk_size: number of rows read and featurized at once
+    :param timeout: seconds the featurization of a single molecule may take before it is skipped
+    :return: path of the extended dataset
+    """
+    dataset_path = Path(dataset_path)
+    base = ColumnarDataset(dataset_path)
+    known_smiles = base.get_smiles()
+    if known_smiles is None:
+        raise ValueError(f'{dataset_path.name} has no SMILES column, create it anew to append to it')
+    columns = read_column_names(path)
+    if not set(base.labels).issubset(set(columns)):
+        raise ValueError(f'Appended file must contain the labels {base.labels}, available columns: {columns}')
+    print(f'appending at most {max_size} entries, starting at entry {data_offset}, to {base.name}')
+
+    # radius as given when the dataset was created, see create_complete_dataset parameters
+    radius = base.descriptor.get('parameters')[4]
+    temporary_path = dataset_path.with_name(f'.{dataset_path.name}.append')
+    writer = DatasetWriter(temporary_path, base.labels, base=base)
+    skipped = append_rows(writer, path, max_size, data_offset, base.descriptor.get('fingerprint_sizes'), radius,
+                          chunk_size, timeout, set(known_smiles), base.descriptor.get('mol_graph'))
+    writer.close()
+
+    report_path = dataset_path / _skipped_report_file
+    previously_skipped = list()
+    if report_path.exists():
+        with report_path.open('r') as file:
+            previously_skipped = json.load(file).get('skipped')
+    write_skipped_report(temporary_path, previously_skipped + skipped)
+
+    histograms = dict(base.descriptor.get('histograms'))
+    sketches = dict(base.descriptor.get('sketches', {}))
+    for idx, label in enumerate(base.labels):
+        values = np.load(temporary_path / f'labels_{idx}.npy', mmap_mode='r')
+        histograms[label] = update_histogram(histograms.get(label), values[base.size:])
+        # datasets created before sketches were added get a sketch of all their values
+        sketches[label] = merge_sketches(sketches[label], create_sketch(values[base.size:])) if label in sketches \
+            else create_sketch(values)
+    header = {key: value for key, value in base.descriptor.items() if key != 'hash'}
+    header |= {'id': dataset_id(base.descriptor | {'hash': base.content_hash}),
+               'histograms': histograms,
+               'sketches': sketches,
+               'skipped': base.descriptor.get('skipped', 0) + len(skipped),
+               'appended': base.descriptor.get('appended', []) + [[path, max_size, data_offset]]}
+    writer.write_descriptor(header)
+    print(f'appended {writer.size - base.size} entries, dataset size {writer.size}')
+
+    replace_dataset(dataset_path, temporary_path)
+    return dataset_path
+
+
+def replace_dataset(dataset_path, new_path):
+    """
+    Swaps a completely written dataset directory in place of an existing one.
+    Readers still holding the old columns memory-mapped keep reading them. Scans between the two renames skip the
+    dataset, see read_descriptors
+    :param dataset_path: path to the dataset directory to replace
+    :param new_path: path to the new dataset directory, a hidden sibling of dataset_path
+    """
+    old_path = dataset_path.with_name(f'.{dataset_path.name}.old')
+    shutil.rmtree(old_path, ignore_errors=True)
+    dataset_path.rename(old_path)
+    new_path.rename(dataset_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def write_skipped_report(path, skipped):
+    """
+    Writes the rows skipped while creating a dataset to skipped.json in the dataset directory and prints a summary
+    :param path: path to the dataset directory
+    :param skipped: list of dictionaries with 'row', 'smiles' and 'reason', as returned by create_dataset
+    """
+    reasons = dict()
+    for entry in skipped:
+        reason = entry.get('reason')
+        reasons[reason] = reasons.get(reason, 0) + 1
+    print(f'skipped {len(skipped)} entries: {reasons}')
+    with (Path(path) / _skipped_report_file).open('w') as file:
+        json.dump({'reasons': reasons, 'skipped': skipped}, file, indent=1)
 
 
 def update_dataset(path):
     """
     if necessary,
     updates the referenced dataset to the current version by creating it anew with create_complete_dataset and
-    writes changes to the pkl file
-    :param path: string path to dataset pickle (pkl) file
-    :return: the latest version of the dataset
+    writes it back to the dataset directory.
+    The new version is written next to the existing one and replaces it in one step once complete, see append_dataset
+    :param path: string path to dataset directory
+    :return: the descriptor of the latest version of the dataset
     """
     path = (Path.cwd() / path)
-    with path.open('rb') as old_set_file_read:
-        old_set = pickle.load(old_set_file_read)
+    old_descriptor = read_descriptor(path)
 
-    if old_set.get('version') == _version:
-        return old_set
+    if old_descriptor.get('version') == dataset_version:
+        return old_descriptor
 
+    temporary_path = path.with_name(f'.{path.name}.update')
+    shutil.rmtree(temporary_path, ignore_errors=True)
     try:
-        new_set = create_complete_dataset(*old_set.get('parameters'))
-        with path.open('wb') as old_set_file_write:
-            pickle.dump(new_set, old_set_file_write)
-
-        return old_set
-
-    except ValueError:
+        graph = old_descriptor.get('mol_graph', {})
+        create_complete_dataset(*old_descriptor.get('parameters'), output_path=temporary_path,
+                                mol_graph_cutoff=graph.get('cutoff'), mol_graph_max_neighbors=graph.get('maxNeighbors'))
+        for appended in old_descriptor.get('appended', []):
+            append_dataset(temporary_path, *appended)
+    except (ValueError, TypeError):
+        shutil.rmtree(temporary_path, ignore_errors=True)
         print('Dataset too old to automatically upgrade')
+        return None
+
+    replace_dataset(path, temporary_path)
+    return read_descriptor(path)
 
 
-def create_histograms(dataset, labels):
+def create_histograms(path, labels):
     """
     Creates a histogram of the dataset for each label
     Its granularity can be customized according to required degree of detail
-    :param dataset: dataset to create a histogram of
-    :param labels: for which to create histograms
+    :param path: path to the dataset directory, its label columns are read one at a time
+    :param labels: for which to create histograms, in the order of the dataset's label columns
     :return: dictionary containing histogram (dictionary containing lists for buckets and interval edges) for each label
     """
     histograms = dict()
 
-    # prep: separate data by label
-    columns_by_label = dict()
-    for label in labels:
-        columns_by_label[label] = list()
-
-    for entry in dataset:
-        for [label, value] in entry['y'].items():
-            columns_by_label[label].append(value)
-
     # create histogram for each label
-    for [label, data] in columns_by_label.items():
+    for idx, label in enumerate(labels):
+        data = np.load(Path(path) / f'labels_{idx}.npy', mmap_mode='r')
         # bucket count is currently an arbitrary value, change corresponding to degree of detail required
-        hist, bin_edges = np.histogram(data, math.floor(len(data) / 100))
+        hist, bin_edges = np.histogram(data, max(math.floor(len(data) / 100), 1))
         histograms[label] = dict({
             'buckets': hist.tolist(),
             'bin_edges': bin_edges.tolist()
@@ -210,23 +457,74 @@ def create_histograms(dataset, labels):
     return histograms
 
 
+def create_sketches(path, labels):
+    """
+    Creates a quantile sketch of the dataset for each label, histograms of any resolution can be computed from them
+    :param path: path to the dataset directory, its label columns are read one at a time
+    :param labels: for which to create sketches, in the order of the dataset's label columns
+    :return: dictionary containing a sketch (see quantile_sketch.create_sketch) for each label
+    """
+    return {label: create_sketch(np.load(Path(path) / f'labels_{idx}.npy', mmap_mode='r'))
+            for idx, label in enumerate(labels)}
+
+
+def update_histogram(histogram, values):
+    """
+    Adds values to a histogram created by create_histograms without the values it was created from.
+    Bins keep their width, the range is extended by whole bins where values fall outside of it.
+    :param histogram: dictionary containing lists for buckets and interval edges
+    :param values: array of the values to add
+    :return: updated histogram dictionary
+    """
+    buckets = np.array(histogram.get('buckets'))
+    bin_edges = np.array(histogram.get('bin_edges'))
+    if len(values) == 0:
+        return histogram
+    width = (bin_edges[-1] - bin_edges[0]) / len(buckets)
+    below = math.ceil(max(bin_edges[0] - values.min(), 0) / width)
+    above = math.ceil(max(values.max() - bin_edges[-1], 0) / width)
+    lower = bin_edges[0] - width * np.arange(below, 0, -1)
+    upper = bin_edges[-1] + width * np.arange(1, above + 1)
+    # rounding must not leave values outside of the outermost bins, numpy.histogram would drop them
+    if below:
+        lower[0] = min(lower[0], values.min())
+    if above:
+        upper[-1] = max(upper[-1], values.max())
+
+    bin_edges = np.concatenate([lower, bin_edges, upper])
+    buckets = np.concatenate([np.zeros(below, dtype=buckets.dtype), buckets, np.zeros(above, dtype=buckets.dtype)])
+    buckets += np.histogram(values, bin_edges)[0]
+    return {'buckets': buckets.tolist(), 'bin_edges': bin_edges.tolist()}
+
+
 # HOW TO USE:
 # Look at examples below
 if __name__ == '__main__':
     '''
     Example for creating a new dataset:
-    new_set = create_complete_dataset(path="../../storage/csv_data/solubility.csv",
-                                      max_size=100,
-                                      data_offset=0,
-                                      smiles_fingerprint_sizes=[128, 512, 1024],
-                                      smiles_fingerprint_radius=2,
-                                      labels=['Solubility'],
-                                      name='Medium Solubility Set')
-
-    file = (Path.cwd() / 'output.pkl').open('wb')
-    pickle.dump(new_set, file)
-    file.close()
+    create_complete_dataset(path="../../storage/csv_data/solubility.csv",
+                            max_size=100,
+                            data_offset=0,
+                            smiles_fingerprint_sizes=[128, 512, 1024],
+                            smiles_fingerprint_radius=2,
+                            labels=['Solubility'],
+                            name='Medium Solubility Set',
+                            output_path=Path.cwd() / 'output')
+    
+    Parquet files (.parquet) are read the same way, only the SMILES and label columns are loaded
+    
+    Mol graphs connect bonded atoms. For neighbor graphs of all atoms within a radius, e.g. for larger molecules,
+    pass mol_graph_cutoff=5.0 and optionally mol_graph_max_neighbors=32
+    
+    Example for appending the rows of another file to a dataset, existing molecules are neither featurized again
+    nor duplicated:
+    append_dataset(dataset_path='../../storage/data/solubility',
+                   path="../../storage/csv_data/more_solubility.csv",
+                   max_size=1000,
+                   data_offset=0)
     
     Example for updating dataset:
-    updated_set = update_dataset('../../storage/data/solubility.pkl')
+    updated_set = update_dataset('../../storage/data/solubility')
+    
+    Datasets in the old pickle format (version 5) can be converted without rebuilding them, see convert_dataset.py
     '''
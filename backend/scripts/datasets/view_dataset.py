@@ -1,7 +1,5 @@
 from pathlib import Path
-import pickle
+from backend.utils.dataset_storage import ColumnarDataset
 if __name__ == '__main__':
-    in_file = (Path.cwd() / 'output.pkl').open('rb')
-    first = pickle.load(in_file)
+    first = ColumnarDataset(Path.cwd() / 'output')
     print('Set a breakpoint here to inspect the dataset in the Debugger')
-    in_file.close()
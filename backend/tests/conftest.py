@@ -0,0 +1,14 @@
+import pytest
+
+from backend.utils import featurization_cache as fc
+
+
+@pytest.fixture
+def isolated_featurization_cache(tmp_path, mocker):
+    """
+    Points the featurization cache to an empty database in tmp_path, so tests neither read nor write the shared one
+    """
+    path = tmp_path / 'cache.sqlite'
+    mocker.patch.object(fc, '_featurization_cache_path', path)
+    mocker.patch.object(fc, '_connection', None)
+    return path
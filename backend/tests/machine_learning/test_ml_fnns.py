@@ -0,0 +1,21 @@
+import numpy
+import tensorflow as tf
+
+from backend.machine_learning import ml_fnns
+from backend.utils.molecule_formats import smiles_to_fingerprint
+
+
+def test_unpack_fingerprints():
+    fingerprints = numpy.random.default_rng(0).integers(0, 2, size=(5, 128), dtype='uint8')
+    unpacked = ml_fnns.unpack_fingerprints(tf.constant(numpy.packbits(fingerprints, axis=-1)))
+    assert unpacked.dtype == tf.float32
+    assert unpacked.shape == (5, 128)
+    assert numpy.array_equal(unpacked.numpy(), fingerprints.astype('float32'))
+
+
+def test_smiles_to_fnn_input(isolated_featurization_cache):
+    fnn_input = ml_fnns.smiles_to_fnn_input('CCO')
+    assert fnn_input.dtype == tf.float32
+    assert fnn_input.shape == (1, ml_fnns._fingerprint_size)
+    assert fnn_input.numpy()[0].tolist() == smiles_to_fingerprint('CCO', fingerprint_size=ml_fnns._fingerprint_size)
+    assert ml_fnns.smiles_to_fnn_input('invalid') is None
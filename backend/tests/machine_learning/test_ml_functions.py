@@ -9,6 +9,7 @@ import numpy
 
 from backend.tests.mocks.mock_ml import MockTraining
 from backend.tests.mocks.mock_models import TrainMockModel
+from backend.utils.dataset_storage import compute_split_indices
 
 
 @pytest.fixture(autouse=True)
@@ -20,9 +21,58 @@ def fix_seeds():
 
 def test_training_start(mocker):
     mocker.patch('backend.machine_learning.ml_functions.is_training_running', return_value=False)
-    mocker.patch('backend.machine_learning.ml_functions.Training')
+    queueing = mocker.patch.object(ml.scheduler, 'submit', return_value=True)
     status = ml.train('', '', '', '', '', '','')
     assert status, 'ml.train should have "succeeded"'
+    queueing.assert_called_once()
+
+
+def test_run_training(mocker):
+    mocker.patch.object(ml, '_isolated_trainings', False)
+    training = mocker.patch('backend.machine_learning.ml_functions.Training')
+    assert ml.run_training('u', 'd', 'm', ['a'], 5, 0.1, 64)
+    training.assert_called_once_with('u', 'd', 'm', ['a'], 5, 0.1, 64, None)
+    training.return_value.start_training.assert_called_once()
+
+    notifying = mocker.patch('backend.utils.api.notify_training_error')
+    training.side_effect = ValueError('unknown input type')
+    assert not ml.run_training('u', 'd', 'm', ['a'], 5, 0.1, 64)
+    notifying.assert_called_once_with('u')
+    assert 'u' not in ml.live_trainings
+
+
+def test_worker_training(mocker):
+    mocker.patch('backend.utils.storage_handler.get_model_summary',
+                 return_value={'baseModelID': '1', 'parameters': {'layers': []}})
+    mocker.patch('backend.utils.storage_handler.get_base_model', return_value={'type': 'sequential', 'metrics': ['R2']})
+    mocker.patch('backend.utils.storage_handler.get_dataset', return_value=mocker.Mock(path='/data/set'))
+    mocker.patch('backend.utils.storage_handler.get_fitting_summary',
+                 return_value={'epochs': 3, 'fittingPath': '/fittings/f'})
+    training = ml.WorkerTraining('u', 'd', 'm', ['a'], 5, 0.1, '64', 'f')
+    assert training.epochs == 8 and training.batch_size == 64
+    assert training.arguments.get('dataset_path') == '/data/set'
+    assert training.arguments.get('fitting_path') == '/fittings/f' and training.arguments.get('initial_epoch') == 3
+
+    def run(user_id, arguments, on_event, waiting):
+        on_event('started', 8)
+        on_event('update', {'loss': 1., 'epoch': 3})
+        on_event('done', (4, 12.5, None))
+    mocker.patch.object(ml.workers, 'run', side_effect=run)
+    started = mocker.patch('backend.utils.api.notify_training_start')
+    updated = mocker.patch('backend.utils.api.update_training_logs')
+    finished = mocker.patch('backend.machine_learning.ml_functions.finish_training')
+    ml.live_trainings = {'u': training}
+    training.start_training()
+    started.assert_called_once_with('u', 8)
+    updated.assert_called_once_with('u', {'loss': 1., 'epoch': 3})
+    assert finished.call_args.args[:4] == ('u', training, 4, 12.5)
+    assert 'u' not in ml.live_trainings
+
+
+def test_stop_queued_training(mocker):
+    mocker.patch.object(ml.scheduler, 'cancel', return_value=True)
+    ml.live_trainings = dict()
+    assert ml.stop_training('u'), 'Expected waiting trainings to be cancelled'
 
 
 def test_training_start_running(mocker):
@@ -55,6 +105,26 @@ def test_analyze(user_id, smiles, fitting_id, model_id, base_model_id, labels, p
     assert result == formatted_analysis, 'This should match. Every label to every value'
 
 
+@pytest.mark.parametrize(
+    'conversion_error, expected_code',
+    [
+        (None, 422),
+        (ml.ConversionError('worker crashed'), 422),
+        (TimeoutError('timeout after 30s'), 503),
+    ]
+)
+def test_analyze_unconvertible(conversion_error, expected_code, mocker):
+    conversion = mocker.Mock(return_value=None, side_effect=conversion_error)
+    mocker.patch('backend.utils.storage_handler.get_fitting', return_value=TrainMockModel(numpy.array([[1.]])))
+    mocker.patch('backend.utils.storage_handler.get_fitting_summary', return_value={'modelID': '1', 'labels': ['a']})
+    mocker.patch('backend.utils.storage_handler.get_model_summary', return_value={'baseModelID': '1'})
+    mocker.patch('backend.utils.storage_handler.get_base_model', return_value={'type': 'random'})
+    mocked_sh = mocker.patch('backend.utils.storage_handler.add_analysis')
+    mocker.patch.dict('backend.machine_learning.ml_functions.mld.molecule_conversion_functions', {'random': conversion})
+    assert ml.analyze('user', '1', 'C') == (None, expected_code)
+    mocked_sh.assert_not_called()
+
+
 @pytest.mark.parametrize(
     'uid, content',
     [
@@ -186,6 +256,7 @@ class TestTrainingClassGroup:
     def mock_init_sh(self, mocker):
         mocker.patch('backend.utils.storage_handler.get_model_summary')
         mocker.patch('backend.utils.storage_handler.get_base_model')
+        mocker.patch('backend.utils.storage_handler.get_dataset', return_value=mocker.Mock(streaming=False))
 
     @pytest.fixture()
     def mock_init_creation(self, mocker):
@@ -231,10 +302,23 @@ class TestTrainingClassGroup:
         set = tf.data.Dataset.from_tensor_slices(dataset_data)
         mocker.patch('backend.machine_learning.ml_functions.Training.create_model_and_set',
                      return_value=[None, set])
+        split_indices = compute_split_indices([str(x).encode('utf-8') for x in range(size)])
+        mocker.patch('backend.utils.storage_handler.get_dataset',
+                     return_value=mocker.Mock(streaming=False, get_split_indices=lambda: split_indices))
         test_training = ml.Training(user_id, dataset_id, model_id, labels, epochs, learning_rate, batch_size)
-        assert test_training.training_set.cardinality().numpy() == 70, 'Dataset should have a 70-20-10 split'
-        assert test_training.validation_set.cardinality().numpy() == 20, 'Dataset should have a 70-20-10 split'
-        assert test_training.test_set.cardinality().numpy() == 10, 'Dataset should have a 70-20-10 split'
+        splits = [[example.tolist() for example in split.unbatch().as_numpy_iterator()]
+                  for split in (test_training.training_set, test_training.validation_set, test_training.test_set)]
+        assert [len(split) for split in splits] == [70, 20, 10], 'Dataset should have a 70-20-10 split'
+        assert sorted(splits[2]) == [dataset_data[index] for index in split_indices[2]], \
+            'Splits should follow the split indices of the dataset'
+        assert test_training.training_set.cardinality().numpy() == -(-70 // batch_size)
+        assert sorted(sum(splits, [])) == sorted(dataset_data), 'Every example should be in exactly one split'
+        assert [example.tolist() for example in test_training.validation_set.unbatch().as_numpy_iterator()] == \
+               splits[1], 'Splits should not change between epochs'
+        training_set = [example.tolist() for example in test_training.training_set.unbatch().as_numpy_iterator()]
+        assert sorted(training_set) == sorted(splits[0]) and training_set != splits[0], \
+            'Training set should be reshuffled every epoch'
+        assert all(len(batch) <= batch_size for batch in test_training.training_set)
 
     @pytest.mark.parametrize(
         'accuracy',
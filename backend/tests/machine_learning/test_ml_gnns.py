@@ -0,0 +1,63 @@
+import numpy
+import pytest
+import tensorflow as tf
+
+from backend.machine_learning import ml_gnns
+from backend.machine_learning import tensor_cache as tc
+from backend.utils import molecule_formats as mf
+
+
+class MockDataset:
+    streaming = False
+
+    def __init__(self, smiles_list):
+        self.name = 'mock'
+        self.content_hash = 'hash'
+        self.smiles_list = smiles_list
+
+    def get_smiles(self):
+        return self.smiles_list
+
+    def get_labels(self, labels):
+        return numpy.arange(len(self.smiles_list), dtype='float32')[:, None]
+
+
+def test_topology_tensor_dataset():
+    ds = ml_gnns.topology_tensor_dataset(MockDataset(['CCO', 'C', 'c1ccccc1']), 'value')
+    graphs = list(ds)
+    assert len(graphs) == 3
+    for ((nodes, edges, edges_i), y), smiles in zip(graphs, ['CCO', 'C', 'c1ccccc1']):
+        expected = mf.smiles_to_topology_graph(smiles)
+        assert numpy.array_equal(nodes.numpy(), expected[0])
+        assert numpy.array_equal(edges.numpy().reshape(-1, 2), expected[1])
+        assert numpy.array_equal(edges_i.numpy().reshape(-1, 2), expected[2])
+    assert [y.numpy() for _, y in graphs] == [0., 1., 2.]
+
+    with pytest.raises(ValueError):
+        ml_gnns.topology_tensor_dataset(MockDataset(None), 'value')
+
+
+def test_create_topology_schnet(tmp_path, mocker):
+    mocker.patch.object(tc, '_tensor_cache_path', tmp_path)
+    mocker.patch.object(tc, '_memory_cache', tc.LRUCache(4))
+    embedding = mocker.spy(mf, 'mol_to_mol_graph')
+    parameters = {'depth': 1, 'embeddingDimension': 8, 'readoutSize': 1, 'inputType': 'topology'}
+    model, ds = ml_gnns.create_schnet_with_dataset(parameters, MockDataset(['CCO', 'CCN', 'CCCC']), ['value'],
+                                                   tf.keras.losses.MeanSquaredError(), tf.keras.optimizers.Adam(),
+                                                   [])
+    (_, edges_spec, _), _ = ds.element_spec
+    assert edges_spec.shape[-1] == 2, 'Expected bond order and path length as edge features'
+    assert model.predict(ml_gnns.batch_schnet_input(ds, 2), verbose=0).shape == (3, 1)
+    embedding.assert_not_called()
+
+    with pytest.raises(ValueError):
+        ml_gnns.create_schnet_with_dataset(parameters | {'inputType': 'unknown'}, MockDataset(['CCO']), ['value'],
+                                           None, None, [])
+
+
+def test_smiles_to_topology_schnet_input(mocker):
+    submitting = mocker.patch.object(mf.chemistry_service, 'submit')
+    nodes, edges, edges_i = ml_gnns.smiles_to_schnet_input('CCO', None, {'inputType': 'topology'})
+    submitting.assert_not_called()
+    assert nodes.shape[-1] == 1 and edges.shape[-1] == 2 and len(edges[0]) == len(edges_i[0])
+    assert ml_gnns.smiles_to_schnet_input('invalid', None, {'inputType': 'topology'}) is None
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+import pytest
+import tensorflow as tf
+
+from backend.machine_learning import tensor_cache as tc
+
+
+class MockDataset:
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, mocker):
+    mocker.patch('backend.machine_learning.tensor_cache._tensor_cache_path', tmp_path)
+    mocker.patch('backend.machine_learning.tensor_cache._memory_cache', tc.LRUCache(4))
+    return tmp_path
+
+
+def build_counted(builds):
+    def build():
+        builds.append(1)
+        return tf.data.Dataset.from_tensor_slices(([[1, 2], [3, 4]], [0.5, 1.5]))
+    return build
+
+
+def test_memory_and_disk_hits(cache_path, mocker):
+    builds = []
+    dataset = MockDataset('hash')
+    first = tc.get_tensor_dataset(dataset, 'fingerprints_2', ['a'], build_counted(builds))
+    second = tc.get_tensor_dataset(dataset, 'fingerprints_2', ['a'], build_counted(builds))
+    assert first is second, 'Expected in-memory cache hit'
+    assert len(builds) == 1, 'Expected tensors to be built once'
+    assert tc._entry_path(tc.tensor_cache_key('hash', 'fingerprints_2', ['a'])).exists(), 'Expected tensors on disk'
+
+    mocker.patch('backend.machine_learning.tensor_cache._memory_cache', tc.LRUCache(4))
+    loaded = tc.get_tensor_dataset(dataset, 'fingerprints_2', ['a'], build_counted(builds))
+    assert len(builds) == 1, 'Expected tensors to be loaded from disk instead of being rebuilt'
+    assert [x.numpy().tolist() for x, _ in loaded] == [[1, 2], [3, 4]]
+    assert loaded.cardinality().numpy() == 2
+
+
+def test_builds_do_not_block_other_keys():
+    building = threading.Event()
+    finish = threading.Event()
+
+    def slow_build():
+        building.set()
+        finish.wait(10)
+        return build_counted([])()
+
+    thread = threading.Thread(target=tc.get_tensor_dataset,
+                              args=(MockDataset('slow'), 'fingerprints_2', ['a'], slow_build))
+    thread.start()
+    assert building.wait(10)
+    tc.get_tensor_dataset(MockDataset('fast'), 'fingerprints_2', ['a'], build_counted([]))
+    assert thread.is_alive(), 'Expected another key to be served while a build is running'
+    finish.set()
+    thread.join()
+    assert not tc._build_locks, 'Expected locks to be dropped once their builds finished'
+
+
+def test_clean_tensor_cache(cache_path):
+    tc.get_tensor_dataset(MockDataset('hash'), 'fingerprints_2', ['a'], build_counted([]))
+    tc.get_tensor_dataset(MockDataset('old'), 'fingerprints_2', ['a'], build_counted([]))
+    stale = cache_path / 'v0' / 'entry'
+    stale.mkdir(parents=True)
+    old = tc._entry_path(tc.tensor_cache_key('old', 'fingerprints_2', ['a']))
+    os.utime(old, (time.time() - 100, time.time() - 100))
+
+    tc.clean_tensor_cache(max_age=50)
+    assert not (cache_path / 'v0').exists(), 'Expected entries of other versions to be removed'
+    assert not old.exists(), 'Expected unused entries to be removed'
+    assert tc._entry_path(tc.tensor_cache_key('hash', 'fingerprints_2', ['a'])).exists()
+
+
+@pytest.mark.parametrize(
+    'other',
+    [
+        ('other hash', 'fingerprints_2', ['a']),
+        ('hash', 'mol_graph', ['a']),
+        ('hash', 'fingerprints_2', ['a', 'b']),
+        ('hash', 'fingerprints_2', ['b']),
+    ]
+)
+def test_key_separation(other):
+    assert tc.tensor_cache_key('hash', 'fingerprints_2', ['a']) != tc.tensor_cache_key(*other)
@@ -0,0 +1,36 @@
+import pytest
+
+from backend.machine_learning.training_resources import allocate_cpus, split_cpus, thread_budget
+
+
+@pytest.mark.parametrize(
+    'cpus, running, waiting, slots, threads',
+    [
+        (64, 0, 0, 16, 64),
+        (64, 1, 0, 16, 32),
+        (64, 3, 0, 16, 16),
+        (64, 15, 0, 16, 4),
+        (64, 1, 6, 16, 8),
+        (64, 15, 30, 16, 4),
+        (2, 3, 0, 16, 1),
+        (4, 0, 0, 0, 4),
+    ]
+)
+def test_thread_budget(cpus, running, waiting, slots, threads):
+    assert thread_budget(cpus, running, waiting, slots) == threads
+
+
+def test_split_cpus():
+    assert split_cpus([0, 1, 2, 3], 1) == [[0, 1, 2, 3]]
+    assert split_cpus([0, 1, 2, 3, 4], 2) == [[0, 1, 2], [3, 4]]
+    assert split_cpus([4, 5, 6, 7], 4) == [[4], [5], [6], [7]]
+    assert split_cpus([0, 1], 3) == [[0], [1], [0]], 'Expected CPUs to be shared by more trainings than CPUs'
+    assert split_cpus([0, 1], 0) == []
+
+
+def test_allocate_cpus():
+    assert allocate_cpus([0, 1, 2, 3], [2, 2]) == [[0, 1], [2, 3]]
+    assert allocate_cpus([0, 1, 2, 3], [4, 1]) == [[0, 1, 2, 3], [2, 3]], \
+        'Expected a training to keep as many CPUs as it has threads'
+    assert allocate_cpus([0, 1, 2, 3], [1, 1, 3]) == [[0, 1], [2], [0, 1, 3]], 'Expected sets to wrap around'
+    assert allocate_cpus([0, 1], [4]) == [[0, 1]]
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+from backend.machine_learning.training_scheduler import TrainingScheduler
+
+
+@pytest.fixture
+def notifications():
+    return list()
+
+
+@pytest.fixture
+def scheduler(notifications):
+    scheduler = TrainingScheduler(slots=2, notify_position=lambda user_id, position:
+                                  notifications.append((user_id, position)))
+    yield scheduler
+    scheduler.close()
+
+
+def blocking_job(started, release, name):
+    def job():
+        started.append(name)
+        release.wait(5)
+    return job
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out waiting for the scheduler'
+        time.sleep(0.01)
+
+
+def test_bounded_slots_and_queue_positions(scheduler, notifications):
+    started = list()
+    release = threading.Event()
+    for user_id in ['a', 'b', 'c', 'd']:
+        assert scheduler.submit(user_id, blocking_job(started, release, user_id))
+    wait_for(lambda: len(started) == 2)
+    time.sleep(0.05)
+    assert sorted(started) == ['a', 'b'], 'Expected only as many jobs as slots to run'
+    assert scheduler.get_stats() == {'slots': 2, 'running': 2, 'waiting': 2}
+    assert scheduler.position('c') == 1 and scheduler.position('d') == 2 and scheduler.position('a') == 0
+    assert ('c', 1) in notifications and ('d', 2) in notifications
+
+    assert not scheduler.submit('c', blocking_job(started, release, 'c2')), 'Expected one job per user'
+    assert scheduler.is_scheduled('a') and scheduler.is_scheduled('c') and not scheduler.is_scheduled('e')
+
+    assert scheduler.cancel('c')
+    assert not scheduler.cancel('a'), 'Expected running jobs not to be cancelled'
+    assert notifications[-1] == ('d', 1), 'Expected the remaining job to move up'
+    release.set()
+    wait_for(lambda: not scheduler.is_scheduled('d'))
+    assert started[2:] == ['d']
+
+
+def test_users_take_turns():
+    scheduler = TrainingScheduler(slots=1, max_jobs_per_user=3)
+    started = list()
+    release = threading.Event()
+    assert scheduler.submit('blocker', blocking_job(started, release, 'blocker'))
+    wait_for(lambda: started)
+    for name in ['a1', 'a2', 'a3', 'b1', 'c1', 'b2']:
+        assert scheduler.submit(name[0], lambda name=name: started.append(name))
+    assert not scheduler.submit('a', lambda: None), 'Expected at most max_jobs_per_user jobs per user'
+    release.set()
+    wait_for(lambda: len(started) == 7)
+    assert started == ['blocker', 'a1', 'b1', 'c1', 'a2', 'b2', 'a3'], 'Expected users to take turns'
+    scheduler.close()
+
+
+def test_failing_job_frees_slot(scheduler):
+    def failing():
+        raise ValueError('failed')
+
+    done = threading.Event()
+    assert scheduler.submit('a', failing)
+    wait_for(lambda: not scheduler.is_scheduled('a'))
+    assert scheduler.submit('a', done.set), 'Expected the user to be able to train again after a failure'
+    assert done.wait(5)
+
+
+def test_closed_scheduler_rejects_jobs():
+    scheduler = TrainingScheduler(slots=1)
+    scheduler.close()
+    assert not scheduler.submit('a', lambda: None)
@@ -0,0 +1,92 @@
+from pathlib import Path
+import os
+
+import pytest
+import tensorflow as tf
+
+from backend.machine_learning import tensor_cache as tc
+from backend.machine_learning.training_workers import SavedModel, TrainingWorkerPool, _StopSignal
+from backend.scripts.datasets.convert_dataset import convert_dataset
+from backend.tests.mocks.mock_models import TrainMockModel
+
+_test_pickle_path = Path(__file__).parent / '..' / 'storage' / 'data' / 'test_dataset.pkl'
+
+
+@pytest.fixture
+def pool(tmp_path, mocker):
+    # workers use the tensor cache directory of the process starting them
+    mocker.patch.object(tc, '_tensor_cache_path', tmp_path / 'tensor_cache')
+    pool = TrainingWorkerPool(1)
+    yield pool
+    pool.close()
+
+
+def training_arguments(dataset_path, **arguments):
+    return {'user_id': 'u',
+            'dataset_id': 'd',
+            'model_id': 'm',
+            'labels': ['Solubility'],
+            'epochs': 2,
+            'learning_rate': 0.01,
+            'batch_size': 4,
+            'model_type': 'sequential',
+            'parameters': {'lossFunction': 'Mean Squared Error', 'optimizer': 'Adam',
+                           'layers': [{'type': 'Dense', 'units': 8, 'activation': 'relu'}]},
+            'dataset_path': str(dataset_path),
+            'metrics': ['MeanAbsoluteError', 'R2']} | arguments
+
+
+def test_training_in_worker(pool, tmp_path):
+    dataset_path = convert_dataset(_test_pickle_path, tmp_path / 'test_dataset')
+    events = list()
+    allocations = list()
+    pool.notify_allocation = lambda user_id, allocation: allocations.append((user_id, allocation))
+    assert pool.run('u', training_arguments(dataset_path), lambda event, payload: events.append((event, payload)))
+    assert allocations == [('u', {'threads': len(pool.cpus), 'cpus': pool.cpus})], \
+        'Expected a lone training to get all CPUs'
+    assert pool.allocation('u') is None
+
+    assert events[0] == ('started', 2)
+    assert [payload.get('epoch') for event, payload in events if event == 'update'] == [0, 1]
+    event, (epochs_trained, accuracy, path) = events[-1]
+    assert event == 'done' and epochs_trained == 2 and isinstance(accuracy, float)
+
+    assert list((tmp_path / 'tensor_cache').glob('*/*')), 'Expected inputs to be cached in the given directory'
+    model = SavedModel(path)
+    model.save(tmp_path / 'fitting')
+    assert not Path(path).exists(), 'Expected the saved model to be moved'
+    assert isinstance(tf.keras.models.load_model(tmp_path / 'fitting'), tf.keras.Model)
+
+    worker = pool.idle[0]
+    if hasattr(os, 'sched_getaffinity'):
+        assert sorted(os.sched_getaffinity(worker.process.pid)) == pool.cpus
+    continued = training_arguments(dataset_path, fitting_path=str(tmp_path / 'fitting'), initial_epoch=2, epochs=1)
+    events.clear()
+    assert pool.run('u', continued, lambda event, payload: events.append((event, payload)))
+    assert events[0] == ('started', 3) and events[-1][1][0] == 3
+    assert pool.idle == [worker], 'Expected the worker process to be reused'
+    SavedModel(events[-1][1][2]).discard()
+
+
+def test_failing_training_in_worker(pool, tmp_path):
+    events = list()
+    assert not pool.run('u', training_arguments(tmp_path / 'missing'),
+                        lambda event, payload: events.append((event, payload)))
+    assert [event for event, _ in events] == ['error']
+    assert len(pool.idle) == 1, 'Expected the worker to stay available after a failed training'
+    assert not pool.stop('u'), 'Expected no training to stop'
+
+
+def test_stop_signal():
+    signal = _StopSignal()
+    signal.request()
+    model = TrainMockModel()
+    signal.attach(model)
+    assert model.stop_training, 'Expected stops requested before the training started to apply'
+
+    signal.reset()
+    model = TrainMockModel()
+    signal.attach(model)
+    assert not model.stop_training
+    signal.request()
+    assert model.stop_training
@@ -2,6 +2,8 @@ import hashlib
 import json
 import copy
 import backend.utils.api as api
+import backend.utils.molecule_formats as mf
+from backend.utils.lru_cache import LRUCache
 import backend.tests.mocks.mock_sh
 import pytest
 import pytest_mock
@@ -309,7 +311,8 @@ class TestDatasetRequestGroup:
             ({'dataset_id': {'name': 'dataset_name',
                              'size': 12515,
                              'labelDescriptors': ['label', 'label2', 'label3'],
-                             'datasetPath': 'X'
+                             'datasetPath': 'X',
+                             'hasSmiles': True,
                              }})
         ]
     )
@@ -324,6 +327,7 @@ class TestDatasetRequestGroup:
             converted_set |= {'datasetID': dataset_id}
             converted_set |= {'size': dataset.get('size')}
             converted_set |= {'labelDescriptors': dataset.get('labelDescriptors')}
+            converted_set |= {'hasSmiles': dataset.get('hasSmiles')}
             assert converted_set in response_json, 'Dataset to be in Response'
 
 
@@ -413,8 +417,10 @@ class TestTrainRequestGroup:
         ]
     )
     def test_train_post_response(self, dataset_id, model_id, labels, epochs, learning_rate, batch_size,client, mocker):
-        magic_background = mocker.patch('backend.utils.api.sio.start_background_task')
+        queueing = mocker.patch('backend.utils.api.ml.train', return_value=True)
         mocker.patch('backend.utils.api.ml.is_training_running', return_value=False)
+        mocker.patch('backend.utils.api.sh.get_model_summary', return_value={'parameters': {}})
+        mocker.patch('backend.utils.api.sh.get_dataset_summaries', return_value={})
         response = client.post(f'/users/{_test_user_id}/train', json={
             'datasetID': dataset_id,
             'modelID': model_id,
@@ -423,8 +429,7 @@ class TestTrainRequestGroup:
             'batchSize': batch_size,
             'learningRate': learning_rate,
         })
-        magic_background.assert_called_once_with(
-            target=backend.utils.api.ml.train,
+        queueing.assert_called_once_with(
             user_id=_test_user_id,
             dataset_id=dataset_id,
             model_id=model_id,
@@ -435,6 +440,26 @@ class TestTrainRequestGroup:
         assert response.status_code in range(200, 300), 'Expected request to work'
         assert response.json, 'Expecting response to be "True"'
 
+    def test_train_queue_full_post_response(self, client, mocker):
+        mocker.patch('backend.utils.api.ml.is_training_running', return_value=False)
+        mocker.patch('backend.utils.api.ml.train', return_value=False)
+        mocker.patch('backend.utils.api.sh.get_model_summary', return_value={'parameters': {}})
+        mocker.patch('backend.utils.api.sh.get_dataset_summaries', return_value={})
+        response = client.post(f'/users/{_test_user_id}/train', json={'labels': json.dumps(['label'])})
+        assert response.status_code == 503, 'Expecting status code for server busy if the training was not queued'
+        assert not response.json
+
+    @pytest.mark.parametrize('has_smiles, status_code', [(False, 400), (True, 202)])
+    def test_train_topology_post_response(self, has_smiles, status_code, client, mocker):
+        mocker.patch('backend.utils.api.ml.is_training_running', return_value=False)
+        queueing = mocker.patch('backend.utils.api.ml.train', return_value=True)
+        mocker.patch('backend.utils.api.sh.get_model_summary', return_value={'parameters': {'inputType': 'topology'}})
+        mocker.patch('backend.utils.api.sh.get_dataset_summaries', return_value={'id': {'hasSmiles': has_smiles}})
+        response = client.post(f'/users/{_test_user_id}/train', json={'datasetID': 'id', 'modelID': 'm',
+                                                                        'labels': json.dumps(['label'])})
+        assert response.status_code == status_code, 'Expected topology trainings only on datasets with SMILES codes'
+        assert queueing.called == has_smiles
+
     def test_train_busy_post_response(self, client, mocker):
         mocker.patch('backend.utils.api.ml.is_training_running', return_value=True)
         response = client.post(f'/users/{_test_user_id}/train', json={})
@@ -451,9 +476,11 @@ class TestTrainRequestGroup:
     def test_train_patch_response(self, fitting_id, epochs, client, mocker):
         mocker.patch('backend.utils.api.ml.is_training_running', return_value=False)
         mocker.patch('backend.utils.api.sh.get_fitting_summary', return_value={'epochs': 50})
+        queueing = mocker.patch('backend.utils.api.ml.continue_training', return_value=True)
         response = client.patch(f'/users/{_test_user_id}/train', json={'fittingID': fitting_id, 'epochs': epochs})
         assert response.status_code in range(200, 300), 'Expecting request to work'
-        assert response.json
+        assert response.json == 50 + epochs
+        queueing.assert_called_once_with(user_id=_test_user_id, fitting_id=fitting_id, epochs=epochs)
 
     def test_train_busy_patch_response(self, client, mocker):
         mocker.patch('backend.utils.api.ml.is_training_running', return_value=True)
@@ -546,6 +573,31 @@ def test_histogram_get(dataset_histograms, dataset_id, labels, client, mocker):
         assert response.json[x]['binEdges'] == old_hist[x]['bin_edges'], 'Expected bin_edges to have been renamed'
         assert response.json[x].get('bin_edges') is None, 'Expected bin_edges to have been removed'
 
+
+@pytest.mark.parametrize(
+    'query, expected_args, expected_response_range',
+    [
+        ('', (None, None), range(200, 300)),
+        ('?bins=20', (20, None), range(200, 300)),
+        ('?bins=5&min=-1.5&max=2', (5, (-1.5, 2.)), range(200, 300)),
+        ('?bins=0', None, {422}),
+        ('?min=2&max=1', None, {422}),
+        ('?min=1', None, {422}),
+        ('?min=nan&max=1', None, {422}),
+        ('?min=0&max=inf', None, {422}),
+        ('?bins=1000000', (1000, None), range(200, 300)),
+    ]
+)
+def test_histogram_get_zoomed(query, expected_args, expected_response_range, client, mocker):
+    histograms_mock = mocker.patch('backend.utils.api.sh.get_dataset_histograms',
+                                   return_value={'lumo': {'buckets': [1], 'bin_edges': [1, 2]}})
+    response = client.get(f'/histograms/2/lumo{query}')
+    assert response.status_code in expected_response_range
+    if expected_args:
+        histograms_mock.assert_called_once_with('2', ['lumo'], *expected_args)
+    else:
+        histograms_mock.assert_not_called()
+
 @pytest.mark.parametrize(
     'b64smiles, mocked_rval, expected_response_range',
     [
@@ -555,5 +607,8 @@ def test_histogram_get(dataset_histograms, dataset_id, labels, client, mocker):
 )
 def test_molecule_3d_get(b64smiles, mocked_rval, expected_response_range, client, mocker):
     mocker.patch('backend.utils.molecule_formats.smiles_to_3DCML', return_value=mocked_rval)
+    mocker.patch('backend.utils.cml_cache._memory_cache', LRUCache(4))
+    mocker.patch('backend.utils.cml_cache._persistent', False)
+    mocker.patch('backend.utils.molecule_formats.chemistry_service', mf.ChemistryService(0))
     response = client.get(f'/molecule/{b64smiles}')
     assert response.status_code in expected_response_range, 'Request should have a code in the expected range'
\ No newline at end of file
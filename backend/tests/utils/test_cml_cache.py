@@ -0,0 +1,56 @@
+import pytest
+
+from backend.utils import cml_cache
+from backend.utils import featurization_cache as fc
+from backend.utils import molecule_formats as mf
+from backend.utils.lru_cache import LRUCache
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(isolated_featurization_cache, mocker):
+    mocker.patch.object(cml_cache, '_memory_cache', LRUCache(2))
+    mocker.patch.object(cml_cache, '_disk_hits', 0)
+    mocker.patch.object(cml_cache, '_disk_misses', 0)
+    # runs embeddings in this process, so they can be spied on
+    mocker.patch.object(mf, 'chemistry_service', mf.ChemistryService(0))
+
+
+def test_cml_cached_by_canonical_smiles(mocker):
+    embedding = mocker.spy(mf, 'smiles_to_3DCML')
+    cml = cml_cache.get_3DCML('CCO')
+    assert cml is not None
+    assert cml_cache.get_3DCML('OCC') == cml, 'Expected notations of a molecule to share their document'
+    assert embedding.call_count == 1
+
+    cml_cache.get_3DCML('C')
+    cml_cache.get_3DCML('N')
+    assert cml_cache.get_3DCML('CCO') == cml, 'Expected evicted documents to be read from disk'
+    assert embedding.call_count == 3
+    stats = cml_cache.get_cml_cache_stats()
+    assert (stats.get('hits'), stats.get('misses'), stats.get('diskHits'), stats.get('diskMisses')) == (1, 4, 1, 3)
+
+
+def test_failed_embedding_cached(mocker):
+    embedding = mocker.patch.object(mf, 'smiles_to_3DCML', return_value=None)
+    assert cml_cache.get_3DCML('CCO') is None
+    assert cml_cache.get_3DCML('CCO') is None
+    cml_cache._memory_cache.clear()
+    assert cml_cache.get_3DCML('CCO') is None
+    assert embedding.call_count == 1, 'Expected failed embeddings to be cached in memory and on disk'
+
+    assert cml_cache.get_3DCML('invalid') is None
+    assert embedding.call_count == 1, 'Expected invalid SMILES codes not to be embedded'
+
+
+def test_failed_conversion_not_cached(mocker):
+    embedding = mocker.patch.object(mf, 'smiles_to_3DCML', side_effect=[RuntimeError('crashed'), 'cml'])
+    assert cml_cache.get_3DCML('CCO') is None
+    assert cml_cache.get_3DCML('CCO') == 'cml', 'Expected conversions which did not finish not to be cached'
+    assert embedding.call_count == 2
+
+
+def test_memory_only(mocker):
+    mocker.patch.object(cml_cache, '_persistent', False)
+    cml_cache.get_3DCML('CCO')
+    assert fc.get_many([fc.featurization_key('cml', cml_cache._cml_parameters, 'CCO')]) == dict(), \
+        'Expected nothing to be stored on disk'
@@ -0,0 +1,352 @@
+from pathlib import Path
+import hashlib
+import json
+import pickle
+
+import numpy
+import pandas
+import pytest
+
+from backend.utils import dataset_storage as ds
+from backend.scripts.datasets.convert_dataset import convert_dataset, upgrade_dataset
+from backend.scripts.datasets import create_dataset
+from backend.scripts.datasets.create_dataset import append_dataset, create_complete_dataset, featurize_chunk, \
+    update_histogram
+from backend.utils.featurization_pool import TaskFailure
+from backend.utils.molecule_formats import smiles_to_fingerprint
+from backend.utils.quantile_sketch import create_sketch
+
+_test_pickle_path = Path(__file__).parent / '..' / 'storage' / 'data' / 'test_dataset.pkl'
+
+
+@pytest.fixture
+def old_set():
+    with _test_pickle_path.open('rb') as file:
+        return pickle.load(file)
+
+
+@pytest.fixture
+def converted_path(tmp_path):
+    return convert_dataset(_test_pickle_path, tmp_path / 'test_dataset')
+
+
+def test_conversion_descriptor(old_set, converted_path):
+    assert ds.is_dataset(converted_path), 'Converted dataset should have a descriptor'
+    descriptor = ds.read_descriptor(converted_path)
+    assert descriptor.get('name') == old_set.get('name')
+    assert descriptor.get('size') == old_set.get('size')
+    assert descriptor.get('labels') == old_set.get('labels')
+    assert descriptor.get('histograms') == old_set.get('histograms')
+    assert descriptor.get('sketches').get(old_set.get('labels')[0]).get('count') == old_set.get('size')
+    assert 'dataset' not in descriptor, 'Descriptor should not contain the data itself'
+
+
+def test_conversion_columns(old_set, converted_path):
+    dataset = ds.ColumnarDataset(converted_path)
+    molecules = old_set.get('dataset')
+    labels = dataset.get_labels(old_set.get('labels'))
+    assert labels.shape == (len(molecules), len(old_set.get('labels')))
+    for size in ['128', '512', '1024']:
+        fingerprints = dataset.get_fingerprints(size)
+        assert fingerprints.dtype == numpy.uint8
+        assert fingerprints.shape == (len(molecules), int(size) // 8), 'Expected fingerprints to be bit-packed'
+        assert numpy.unpackbits(fingerprints, axis=-1).tolist() == [mol['x']['fingerprints'][size]
+                                                                    for mol in molecules]
+
+    nodes, node_splits, edges, edges_i, edge_splits = dataset.get_mol_graphs()
+    assert len(node_splits) == len(edge_splits) == len(molecules) + 1
+    assert (nodes.dtype, edges.dtype, edges_i.dtype) == (numpy.uint8, numpy.float32, numpy.int32), \
+        'Expected graphs to be stored with compact dtypes'
+    for idx, mol in enumerate(molecules):
+        mol_nodes, mol_edges, mol_edges_i = mol['x']['mol_graph']
+        assert numpy.array_equal(nodes[node_splits[idx]:node_splits[idx + 1]], mol_nodes)
+        assert numpy.array_equal(edges[edge_splits[idx]:edge_splits[idx + 1]], mol_edges.astype('float32'))
+        assert numpy.array_equal(edges_i[edge_splits[idx]:edge_splits[idx + 1]], mol_edges_i)
+        assert labels[idx, 0] == pytest.approx(mol['y'][old_set.get('labels')[0]])
+
+
+def test_columns_are_memory_mapped(converted_path):
+    dataset = ds.ColumnarDataset(converted_path)
+    assert len(dataset.columns) == 0, 'No column should be read before it is accessed'
+    fingerprints = dataset.get_fingerprints(128)
+    assert isinstance(fingerprints, numpy.memmap), 'Columns should be memory-mapped'
+    assert not fingerprints.flags.writeable, 'Columns should be read-only'
+    assert list(dataset.columns.keys()) == ['fingerprints_128'], 'Only accessed columns should be mapped'
+
+
+def test_convert_wrong_version(tmp_path, old_set):
+    old_set['version'] = 4
+    path = tmp_path / 'old.pkl'
+    with path.open('wb') as file:
+        pickle.dump(old_set, file)
+    assert convert_dataset(path) is None, 'Only version 5 pickles can be converted'
+    assert not ds.is_dataset(tmp_path / 'old')
+
+
+def test_upgrade_unpacked_dataset(converted_path, tmp_path):
+    dataset = ds.ColumnarDataset(converted_path)
+    packed = numpy.array(dataset.get_fingerprints(128))
+    old_path = tmp_path / 'old'
+    old_set = {key: value for key, value in dataset.descriptor.items() if key != 'hash'}
+    old_set['version'] = 6
+    old_path.mkdir()
+    for column_path in converted_path.glob('*.npy'):
+        data = numpy.load(column_path)
+        if column_path.stem.startswith('fingerprints'):
+            data = numpy.unpackbits(data, axis=-1)
+        numpy.save(old_path / column_path.name, data)
+    with (old_path / 'descriptor.json').open('w') as file:
+        json.dump(old_set, file)
+
+    assert upgrade_dataset(old_path) == old_path
+    upgraded = ds.ColumnarDataset(old_path)
+    assert upgraded.descriptor.get('version') == dataset.descriptor.get('version')
+    assert numpy.array_equal(upgraded.get_fingerprints(128), packed)
+    assert upgraded.content_hash == dataset.content_hash, 'Expected upgrade to result in the converted columns'
+    assert upgrade_dataset(old_path) is None, 'Only version 6 datasets can be upgraded'
+
+
+def test_descriptor_index(tmp_path, mocker):
+    convert_dataset(_test_pickle_path, tmp_path / 'a')
+    convert_dataset(_test_pickle_path, tmp_path / 'b')
+    descriptors = ds.read_descriptors(tmp_path)
+    assert [path.name for path in descriptors.keys()] == ['a', 'b']
+    assert (tmp_path / 'index.json').exists(), 'Expected index to be written'
+
+    reading = mocker.spy(ds, 'read_descriptor')
+    assert ds.read_descriptors(tmp_path) == descriptors, 'Expected index to contain the same descriptors'
+    assert reading.call_count == 0, 'Expected up-to-date datasets to be read from the index only'
+
+    convert_dataset(_test_pickle_path, tmp_path / 'c')
+    assert len(ds.read_descriptors(tmp_path)) == 3, 'Expected new dataset to be indexed'
+    assert reading.call_count == 1, 'Expected only the new dataset to be read'
+
+
+def test_unwritable_descriptor_index(tmp_path, mocker):
+    convert_dataset(_test_pickle_path, tmp_path / 'a')
+    descriptor = ds.read_descriptor(tmp_path / 'a')
+    descriptor.pop('hash')
+    with (tmp_path / 'a' / 'descriptor.json').open('w') as file:
+        json.dump(descriptor, file)
+    mocker.patch.object(ds, '_unsaved_indices', dict())
+    mocker.patch('tempfile.NamedTemporaryFile', side_effect=PermissionError('read-only'))
+    hashing = mocker.spy(ds, 'hash_columns')
+
+    descriptors = ds.read_descriptors(tmp_path)
+    assert descriptors.get(tmp_path / 'a').get('hash') and not (tmp_path / 'index.json').exists()
+    assert ds.read_descriptors(tmp_path) == descriptors
+    assert hashing.call_count == 1, 'Expected hashes to be kept in memory if the index cannot be written'
+    assert [path.name for path in tmp_path.iterdir()] == ['a']
+
+
+def test_descriptors_skip_removed_datasets(tmp_path, mocker):
+    convert_dataset(_test_pickle_path, tmp_path / 'a')
+    (tmp_path / 'b').mkdir()
+    # b was a dataset when it was listed, but is swapped out before its descriptor is read
+    mocker.patch.object(ds, 'is_dataset', return_value=True)
+    assert list(ds.read_descriptors(tmp_path).keys()) == [tmp_path / 'a']
+
+
+def test_sharded_stream(converted_path, tmp_path):
+    columnar = ds.ColumnarDataset(converted_path)
+    sharded_path = ds.write_sharded_dataset(tmp_path / 'sharded', columnar, shard_size=3)
+    sharded = ds.open_dataset(sharded_path)
+    assert isinstance(sharded, ds.ShardedDataset)
+    assert len(list(sharded_path.glob('*.tfrecord'))) == 4, 'Expected 10 molecules in shards of 3'
+    assert sharded.size == columnar.size
+
+    stream = sharded.stream(['fingerprints_128'], columnar.labels)
+    assert stream.cardinality().numpy() == columnar.size
+    for idx, (x, y) in enumerate(stream):
+        assert x.numpy().tolist() == columnar.get_fingerprints(128)[idx].tolist()
+        assert y.numpy().tolist() == columnar.get_labels(columnar.labels)[idx].tolist()
+
+    nodes, node_splits, edges, edges_i, edge_splits = columnar.get_mol_graphs()
+    stream = sharded.stream(['mol_graph_nodes', 'mol_graph_edges', 'mol_graph_edge_indices'], columnar.labels)
+    for idx, ((mol_nodes, mol_edges, mol_edges_i), _) in enumerate(stream):
+        assert numpy.array_equal(mol_nodes.numpy(), nodes[node_splits[idx]:node_splits[idx + 1]])
+        assert numpy.array_equal(mol_edges.numpy(), edges[edge_splits[idx]:edge_splits[idx + 1]])
+        assert numpy.array_equal(mol_edges_i.numpy(), edges_i[edge_splits[idx]:edge_splits[idx + 1]])
+
+
+def test_split_indices(converted_path, tmp_path):
+    keys = [str(row).encode('utf-8') for row in range(100)]
+    training, validation, test = ds.compute_split_indices(keys)
+    assert [len(training), len(validation), len(test)] == [70, 20, 10]
+    assert sorted(numpy.concatenate([training, validation, test]).tolist()) == list(range(100))
+    reordered = ds.compute_split_indices(keys[::-1])
+    assert sorted(99 - reordered[2]) == test.tolist(), 'Expected splits to not depend on the order of the rows'
+    # duplicates the molecule right before the cut between training and validation split
+    ranked = sorted(range(99), key=lambda row: hashlib.blake2b(keys[row], digest_size=8).digest())
+    training, validation, test = ds.compute_split_indices(keys[:99] + [keys[ranked[69]]])
+    assert ranked[69] in training and 99 in training, 'Expected duplicated molecules to end up in the same split'
+    assert [len(training), len(validation), len(test)] == [71, 20, 9]
+
+    dataset = ds.ColumnarDataset(converted_path)
+    split_indices = dataset.get_split_indices()
+    assert (converted_path / ds._split_file).exists()
+    assert dataset.content_hash == ds.hash_columns(converted_path), 'Expected split file to not be a column'
+    reopened = ds.ColumnarDataset(converted_path)
+    assert all(numpy.array_equal(stored, computed)
+               for stored, computed in zip(reopened.get_split_indices(), split_indices))
+
+    sharded = ds.open_dataset(ds.write_sharded_dataset(tmp_path / 'sharded', dataset, shard_size=3))
+    assert sum(len(indices) for indices in sharded.get_split_indices()) == sharded.size
+
+
+def test_chunked_writer(old_set, converted_path, tmp_path):
+    writer = ds.DatasetWriter(tmp_path / 'chunked', old_set.get('labels'))
+    molecules = old_set.get('dataset')
+    for start in range(0, len(molecules), 3):
+        writer.append(molecules[start:start + 3])
+    writer.append([])
+    writer.close()
+    assert not list((tmp_path / 'chunked').glob('*.part')), 'Expected temporary files to be removed'
+    header = {key: value for key, value in old_set.items() if key != 'dataset'}
+    chunked = ds.ColumnarDataset(writer.write_descriptor(header))
+    assert chunked.size == len(molecules)
+    assert chunked.content_hash == ds.ColumnarDataset(converted_path).content_hash, \
+        'Expected chunked write to produce the same columns as a single write'
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_create_dataset_from_file(tmp_path, isolated_featurization_cache, suffix):
+    if suffix == '.parquet':
+        pytest.importorskip('pyarrow')
+    table = pandas.DataFrame({'SMILES': ['C', 'CC', 'invalid', 'CCO', 'CCN', 'c1ccccc1', 'CCCC'],
+                              'unused': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+                              'value': [0., 1., 2., 3., 4., 5., 6.]})
+    path = tmp_path / f'table{suffix}'
+    table.to_csv(path, index=False) if suffix == '.csv' else table.to_parquet(path)
+
+    dataset_path = create_complete_dataset(str(path), 5, 1, [128], 2, ['value'], 'test', tmp_path / 'set',
+                                           chunk_size=2)
+    dataset = ds.ColumnarDataset(dataset_path)
+    assert dataset.size == 4, 'Expected rows 1 to 5 without the invalid molecule'
+    assert dataset.labels == ['value']
+    assert dataset.get_labels(['value']).flatten().tolist() == [1., 3., 4., 5.]
+    assert dataset.descriptor.get('fingerprint_sizes') == [128]
+    with (dataset_path / 'skipped.json').open('r') as file:
+        assert json.load(file).get('skipped') == [{'row': 2, 'smiles': 'invalid', 'reason': 'invalid SMILES'}]
+    assert dataset.descriptor.get('skipped') == 1
+    assert dataset.descriptor.get('mol_graph') == {'cutoff': None, 'maxNeighbors': None}
+    assert dataset.descriptor.get('sketches') == {'value': create_sketch([1., 3., 4., 5.])}
+    _, node_splits, _, _, _ = dataset.get_mol_graphs()
+    assert node_splits.tolist() == [0, 8, 17, 27, 39], \
+        'Expected row splits (atoms including hydrogens) to continue across chunks'
+
+
+def test_append_dataset(tmp_path, mocker, isolated_featurization_cache):
+    pandas.DataFrame({'SMILES': ['C', 'CC', 'invalid', 'CCO'], 'value': [0., 1., 2., 3.]}) \
+        .to_csv(tmp_path / 'first.csv', index=False)
+    pandas.DataFrame({'SMILES': ['OCC', 'CCN', 'NCC', 'c1ccccc1'], 'value': [9., 4., 4., -2.]}) \
+        .to_csv(tmp_path / 'second.csv', index=False)
+    dataset_path = create_complete_dataset(str(tmp_path / 'first.csv'), 10, 0, [128], 2, ['value'], 'test',
+                                           tmp_path / 'data' / 'set')
+    original = ds.ColumnarDataset(dataset_path)
+    fingerprints = numpy.array(original.get_fingerprints(128))
+    node_splits = original.get_mol_graphs()[1].tolist()
+    assert original.get_smiles() == ['C', 'CC', 'CCO']
+
+    featurizing = mocker.spy(create_dataset, 'featurize_chunk')
+    assert append_dataset(dataset_path, str(tmp_path / 'second.csv'), 10, 0) == dataset_path
+    assert featurizing.call_args.args[1] == ['CCN', 'c1ccccc1'], 'Expected only new molecules to be featurized'
+    assert [entry.name for entry in (tmp_path / 'data').iterdir()] == ['set'], 'Expected temporary data removed'
+
+    dataset = ds.ColumnarDataset(dataset_path)
+    assert dataset.size == 5
+    assert dataset.get_smiles() == ['C', 'CC', 'CCO', 'CCN', 'c1ccccc1']
+    assert dataset.get_labels(['value']).flatten().tolist() == [0., 1., 3., 4., -2.]
+    assert numpy.array_equal(dataset.get_fingerprints(128)[:3], fingerprints)
+    assert dataset.get_mol_graphs()[1].tolist()[:4] == node_splits
+    assert dataset.content_hash == ds.hash_columns(dataset_path) != original.content_hash
+    assert ds.dataset_id(dataset.descriptor) == ds.dataset_id(original.descriptor), \
+        'Expected appending to keep the dataset ID'
+    assert dataset.descriptor.get('appended') == [[str(tmp_path / 'second.csv'), 10, 0]]
+    assert dataset.descriptor.get('skipped') == 3
+    with (dataset_path / 'skipped.json').open('r') as file:
+        assert [(entry.get('row'), entry.get('reason')) for entry in json.load(file).get('skipped')] == \
+               [(2, 'invalid SMILES'), (0, 'duplicate'), (2, 'duplicate')]
+
+    histogram = dataset.descriptor.get('histograms').get('value')
+    assert sum(histogram.get('buckets')) == 5
+    assert dataset.descriptor.get('sketches').get('value') == create_sketch([0., 1., 3., 4., -2.]), \
+        'Expected sketches to be merged with the appended values'
+    assert histogram.get('bin_edges')[0] <= -2 and histogram.get('bin_edges')[-1] >= 4
+
+    assert ds.has_smiles(dataset_path, dataset.descriptor)
+    converted_path = convert_dataset(_test_pickle_path, tmp_path / 'converted')
+    assert not ds.has_smiles(converted_path, ds.read_descriptor(converted_path))
+    with pytest.raises(ValueError):
+        append_dataset(converted_path, str(tmp_path / 'second.csv'), 10, 0)
+
+
+def test_update_histogram():
+    values = numpy.array([0., 1., 1., 2., 3., 4.])
+    counts, edges = numpy.histogram(values, 4)
+    histogram = update_histogram({'buckets': counts.tolist(), 'bin_edges': edges.tolist()}, numpy.array([-1.5, 4.5]))
+    assert histogram.get('bin_edges') == pytest.approx([-2., -1., 0., 1., 2., 3., 4., 5.])
+    assert histogram.get('buckets') == [1, 0, 1, 2, 1, 2, 1]
+    assert update_histogram(histogram, numpy.array([])) == histogram
+
+
+class SerialPool:
+    def __init__(self):
+        self.tasks = list()
+
+    def starmap(self, function, tasks):
+        self.tasks.extend(tasks)
+        return [function(*task) for task in tasks]
+
+
+def test_featurize_chunk_computes_missing_only(isolated_featurization_cache):
+    pool = SerialPool()
+    features, reasons = featurize_chunk(pool, ['CCO', 'invalid'], [128], 2)
+    assert pool.tasks == [(['CCO'], [128], 2, True), ('CCO', None, None)], \
+        'Expected one fingerprint batch and one mol graph task per valid molecule'
+    assert features[0]['fingerprints']['128'].tolist() == \
+           numpy.packbits(smiles_to_fingerprint('CCO', 128)).tolist(), 'Expected bit-packed fingerprints'
+    assert features[1] is None
+    assert reasons == {1: 'invalid SMILES'}
+
+    pool = SerialPool()
+    new_features, _ = featurize_chunk(pool, ['OCC', 'CC'], [128, 256], 2)
+    assert pool.tasks == [(['OCC', 'CC'], [128, 256], 2, True), ('CC', None, None)], \
+        'Expected only representations missing from the cache to be computed'
+    assert numpy.array_equal(new_features[0]['fingerprints']['128'], features[0]['fingerprints']['128'])
+    assert numpy.array_equal(new_features[0]['mol_graph'][1], features[0]['mol_graph'][1]), \
+        'Expected the cached conformer to be reused'
+
+
+class FailingPool(SerialPool):
+    def __init__(self, failing):
+        super().__init__()
+        self.failing = failing
+
+    def starmap(self, function, tasks):
+        tasks = list(tasks)
+        self.tasks.extend(tasks)
+        return [TaskFailure('timeout after 1s') if task in self.failing else function(*task) for task in tasks]
+
+
+@pytest.mark.parametrize(
+    'failing, expected_failed',
+    [
+        ([('CCO', None, None)], [0]),
+        ([(['CCO', 'CC'], [128], 2, True)], [0, 1]),
+    ]
+)
+def test_featurize_chunk_reports_failures(isolated_featurization_cache, failing, expected_failed):
+    features, reasons = featurize_chunk(FailingPool(failing), ['CCO', 'CC'], [128], 2)
+    assert [idx for idx, x in enumerate(features) if x is None] == expected_failed
+    assert reasons == {idx: 'timeout after 1s' for idx in expected_failed}
+    assert featurize_chunk(SerialPool(), ['CCO'], [128], 2)[0][0] is not None, 'Expected timeouts not to be cached'
+
+
+def test_featurize_chunk_radius_graph(isolated_featurization_cache):
+    bond_features, _ = featurize_chunk(SerialPool(), ['CCCCO'], [128], 2)
+    pool = SerialPool()
+    features, _ = featurize_chunk(pool, ['CCCCO'], [128], 2, graph={'cutoff': 4., 'maxNeighbors': None})
+    assert pool.tasks == [('CCCCO', 4., None)], 'Expected neighbor graphs to be cached apart from bond graphs'
+    _, edges, edges_i = features[0]['mol_graph']
+    assert len(edges_i) > len(bond_features[0]['mol_graph'][2]) and numpy.all(edges <= 4.)
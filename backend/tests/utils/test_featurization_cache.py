@@ -0,0 +1,46 @@
+import pytest
+
+from backend.utils import featurization_cache as fc
+from backend.utils.molecule_formats import smiles_to_fingerprint
+
+
+pytestmark = pytest.mark.usefixtures('isolated_featurization_cache')
+
+
+def counting_map(calls):
+    def map_function(function, smiles_list):
+        calls.extend(smiles_list)
+        return list(map(function, smiles_list))
+    return map_function
+
+
+def test_map_cached():
+    calls = list()
+    smiles_list = ['CCO', 'c1ccccc1', 'invalid']
+    results = fc.map_cached(counting_map(calls), 'fingerprint', {'size': 128}, smiles_list, smiles_to_fingerprint)
+    assert results == [smiles_to_fingerprint(smiles) for smiles in smiles_list]
+    assert calls == smiles_list, 'Expected all molecules to be featurized on first use'
+
+    calls.clear()
+    assert fc.map_cached(counting_map(calls), 'fingerprint', {'size': 128}, ['OCC', 'CCO', 'invalid'],
+                         smiles_to_fingerprint) == [results[0], results[0], None]
+    assert calls == ['invalid'], 'Expected other notations of cached molecules to be cache hits'
+
+    calls.clear()
+    fc.map_cached(counting_map(calls), 'fingerprint', {'size': 256}, ['CCO'], smiles_to_fingerprint)
+    assert calls == ['CCO'], 'Expected different parameters to be a cache miss'
+
+
+def test_get_or_create_caches_failures(mocker):
+    featurize = mocker.Mock(return_value=None)
+    assert fc.get_or_create('mol_graph', {}, 'CC', featurize) is None
+    assert fc.get_or_create('mol_graph', {}, 'CC', featurize) is None
+    assert featurize.call_count == 1, 'Expected failed featurizations to be cached'
+
+
+def test_featurizer_version(mocker):
+    calls = list()
+    fc.map_cached(counting_map(calls), 'fingerprint', {}, ['CCO'], smiles_to_fingerprint)
+    mocker.patch.object(fc, '_featurizer_version', fc._featurizer_version + 1)
+    fc.map_cached(counting_map(calls), 'fingerprint', {}, ['CCO'], smiles_to_fingerprint)
+    assert calls == ['CCO', 'CCO'], 'Expected a new featurizer version to invalidate the cache'
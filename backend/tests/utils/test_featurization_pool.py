@@ -0,0 +1,53 @@
+import os
+import time
+
+import pytest
+
+from backend.utils.featurization_pool import FeaturizationPool, TaskFailure
+
+
+def square(x):
+    return x * x
+
+
+def slow_square(x):
+    if x == 3:
+        time.sleep(60)
+    return x * x
+
+
+def failing_square(x):
+    if x == 2:
+        raise ValueError('bad molecule')
+    if x == 4:
+        os._exit(1)
+    return x * x
+
+
+@pytest.fixture
+def pool():
+    with FeaturizationPool(2, timeout=2, max_chunk_size=4) as pool:
+        yield pool
+
+
+def test_results_in_task_order(pool):
+    assert pool.starmap(square, [(x,) for x in range(50)]) == [x * x for x in range(50)]
+    assert pool.starmap(square, []) == []
+
+
+def test_timeout(pool):
+    start = time.monotonic()
+    results = pool.starmap(slow_square, [(x,) for x in range(8)])
+    assert time.monotonic() - start < 30, 'Expected the stalled task to be stopped after its timeout'
+    assert isinstance(results[3], TaskFailure)
+    assert results[3].reason.startswith('timeout')
+    assert [result for idx, result in enumerate(results) if idx != 3] == [x * x for x in range(8) if x != 3], \
+        'Expected other tasks, including the rest of the stalled chunk, to complete'
+    assert pool.starmap(square, [(5,)]) == [25], 'Expected the pool to keep working after a timeout'
+
+
+def test_failures(pool):
+    results = pool.starmap(failing_square, [(x,) for x in range(6)])
+    assert results[2].reason.startswith('error'), 'Expected exceptions to fail their task only'
+    assert results[4].reason == 'worker crashed', 'Expected a crashed worker to fail its task only'
+    assert [results[idx] for idx in (0, 1, 3, 5)] == [0, 1, 9, 25]
@@ -0,0 +1,64 @@
+import threading
+import pytest
+
+from backend.utils.lru_cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1, 'Expected a to be cached'
+    cache.put('c', 3)
+    assert cache.get('b') is None, 'Expected least recently used entry to be evicted'
+    assert cache.get('a') == 1, 'Expected recently used entry to be kept'
+    assert cache.get('c') == 3, 'Expected just added entry to be kept'
+
+
+@pytest.mark.parametrize(
+    'budget, values, expected_keys',
+    [
+        (10, [4, 4, 4], [1, 2]),
+        (10, [20], [0]),
+        (10, [3, 3, 3], [0, 1, 2]),
+    ]
+)
+def test_cost_budget(budget, values, expected_keys):
+    cache = LRUCache(budget, cost=lambda value: value)
+    for key, value in enumerate(values):
+        cache.put(key, value)
+    assert list(cache.entries.keys()) == expected_keys, 'Expected entries over budget to be evicted'
+
+
+def test_get_or_create_stats():
+    cache = LRUCache(5)
+    created = []
+    for _ in range(3):
+        cache.get_or_create('key', lambda: created.append('value') or 'value')
+    assert created == ['value'], 'Expected value to be created only once'
+    assert cache.get_or_create('none', lambda: None) is None
+    assert 'none' not in cache.entries, 'Expected None to not be cached'
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['entries'] == 1
+
+
+def test_get_or_create_does_not_block_other_keys():
+    cache = LRUCache(5)
+    creating = threading.Event()
+    release = threading.Event()
+
+    def create_slowly():
+        creating.set()
+        release.wait(10)
+        return 'slow'
+
+    thread = threading.Thread(target=cache.get_or_create, args=('slow', create_slowly))
+    thread.start()
+    assert creating.wait(10)
+    assert cache.get_or_create('fast', lambda: 'fast') == 'fast', 'Expected other keys to be created meanwhile'
+    release.set()
+    thread.join()
+    assert cache.get_or_create('slow', lambda: 'again') == 'slow', 'Expected created value to be shared'
+    assert not cache.creations, 'Expected creation locks to be dropped'
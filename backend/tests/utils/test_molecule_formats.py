@@ -1,5 +1,9 @@
+import time
+import numpy
 import pytest
 
+from rdkit import DataStructs
+
 from backend.utils import molecule_formats as mf
 
 
@@ -53,6 +57,9 @@ def test_mol_graph_conversion(test_smiles):
     assert nodes.shape[1] == 1, 'Elements in nodes are 1-Dimensional'
     assert edges.shape[1] == 1, 'Elements in edges are 1-Dimensional'
     assert edges_i.shape[1] == 2, 'Elements in edges_i are 2-Dimensional'
+    assert nodes.dtype == numpy.uint8, 'Nodes are stored as compact atomic numbers'
+    assert edges.dtype == numpy.float32, 'Edges are stored as float32 distances'
+    assert edges_i.dtype == numpy.int32, 'Edge indices are stored as int32'
 
 
 @pytest.mark.parametrize(
@@ -73,6 +80,49 @@ def test_faulty_mol_graph_conversion(test_smiles):
     assert edges_i is None, 'Converted molecule should be None'
 
 
+@pytest.mark.parametrize('max_neighbors', [None, 1, 4])
+def test_radius_edge_indices(max_neighbors):
+    positions = numpy.random.default_rng(0).uniform(0, 6, size=(60, 3))
+    edge_indices = mf.radius_edge_indices(positions, 2., max_neighbors)
+    assert edge_indices.dtype == numpy.int32 and edge_indices.shape[1] == 2
+
+    distances = numpy.linalg.norm(positions[:, None] - positions[None], axis=-1)
+    expected = list()
+    for atom in range(len(positions)):
+        neighbors = [idx for idx in numpy.argsort(distances[atom]) if idx != atom and distances[atom, idx] <= 2.]
+        expected.extend([atom, neighbor] for neighbor in sorted(neighbors[:max_neighbors]))
+    assert edge_indices.tolist() == expected
+
+
+def test_radius_mol_graph():
+    nodes, bond_edges, bond_edges_i = mf.smiles_to_mol_graph('CCCCCCCCCCCC')
+    _, edges, edges_i = mf.smiles_to_mol_graph('CCCCCCCCCCCC', cutoff=3.)
+    assert numpy.all(edges <= 3.) and len(edges) == len(edges_i)
+    assert {tuple(pair) for pair in bond_edges_i} < {tuple(pair) for pair in edges_i}, \
+        'Expected bonded atoms to be neighbors within the cutoff'
+    assert numpy.all(bond_edges > 0.9) and numpy.all(bond_edges < 1.6), 'Expected bond lengths in Ångström'
+
+    _, limited_edges, limited_edges_i = mf.smiles_to_mol_graph('CCCCCCCCCCCC', cutoff=3., max_neighbors=4)
+    assert numpy.bincount(limited_edges_i[:, 0]).max() == 4
+    assert len(limited_edges) == 4 * len(nodes)
+    assert mf.mol_graph_parameters() == mf._mol_graph_parameters
+    assert mf.mol_graph_parameters(3., 4) != mf.mol_graph_parameters(3.)
+
+
+def test_topology_graph():
+    nodes, edges, edges_i = mf.smiles_to_topology_graph('c1ccccc1CO')
+    assert nodes.dtype == numpy.uint8 and nodes.ravel().tolist() == [6, 6, 6, 6, 6, 6, 6, 8]
+    assert edges.dtype == numpy.float32 and edges.shape == (len(edges_i), 2)
+    assert edges_i.dtype == numpy.int32
+    features = {tuple(pair): feature.tolist() for pair, feature in zip(edges_i, edges)}
+    assert features[(0, 1)] == [1.5, 1.], 'Expected aromatic bonds to have order 1.5'
+    assert features[(6, 7)] == features[(7, 6)] == [1., 1.]
+    assert features[(0, 3)] == [0., 3.], 'Expected atoms three bonds apart to be connected'
+    assert (2, 7) not in features and max(length for _, length in edges) == 3
+    assert mf.smiles_to_topology_graph('C')[2].shape == (0, 2)
+    assert mf.smiles_to_topology_graph('awd') == (None, None, None)
+
+
 @pytest.mark.parametrize(
     'test_smiles, chem_output, expected_validity',
     [
@@ -105,3 +155,102 @@ def test_working_3d_generation(test_smiles):
 def test_faulty_3d_generation():
     cml_code = mf.smiles_to_3DCML('awdsda')
     assert cml_code is None, 'Expecting None on faulty SMILES code'
+
+
+def test_featurize_smiles(mocker):
+    parsing = mocker.spy(mf.Chem, 'MolFromSmiles')
+    features = mf.featurize_smiles('CCO', [128, 512], 2, mol_graph=True, cml=True)
+    assert parsing.call_count == 1, 'Expected the SMILES code to be parsed once for all representations'
+    for size in [128, 512]:
+        assert features['fingerprints'][size].tolist() == mf.smiles_to_fingerprint('CCO', size, 2)
+    nodes, edges, edges_i = features['mol_graph']
+    assert numpy.array_equal(nodes, mf.smiles_to_mol_graph('CCO')[0])
+    assert len(edges) == len(edges_i)
+    assert type(features['cml']) is str
+
+
+def test_faulty_featurize_smiles():
+    features = mf.featurize_smiles('awd', [128], mol_graph=True)
+    assert features['fingerprints'][128] is None
+    assert features['mol_graph'] == (None, None, None)
+    assert 'cml' not in features, 'Expected only requested representations'
+
+
+@pytest.mark.parametrize(
+    'test_smiles',
+    [
+        'C',
+        'CCO',
+        'c1ccccc1C(=O)O',
+        'CC(C)Cc1ccc(cc1)C(C)C(=O)O',
+        'CN1C=NC2=C1C(=O)N(C(=O)N2C)C',
+    ],
+)
+def test_folded_fingerprints_match_rdkit(test_smiles):
+    mol = mf.Chem.MolFromSmiles(test_smiles)
+    fingerprints = mf.mol_to_fingerprints(mol, [128, 512, 1024, 96], radius=2)
+    for size, fingerprint in fingerprints.items():
+        native = mf.AllChem.GetMorganFingerprintAsBitVect(mol, radius=2, nBits=size)
+        assert fingerprint.tolist() == list(native), 'Expected folded fingerprints to equal native RDKit fingerprints'
+    native_folded = DataStructs.FoldFingerprint(mf.AllChem.GetMorganFingerprintAsBitVect(mol, 2, nBits=1024), 8)
+    assert mf.fold_fingerprint(fingerprints[1024], 128) == list(native_folded), \
+        'Expected folding to equal RDKit FoldFingerprint'
+
+
+def test_fold_fingerprint_wrong_size():
+    with pytest.raises(ValueError):
+        mf.fold_fingerprint([0] * 128, 96)
+
+
+def test_smiles_list_to_fingerprints():
+    fingerprints, valid = mf.smiles_list_to_fingerprints(['CCO', 'awd', 'C'], [128, 512])
+    assert valid.tolist() == [True, False, True]
+    for size in [128, 512]:
+        assert fingerprints[size].shape == (3, size)
+        assert fingerprints[size].dtype == numpy.uint8
+        assert fingerprints[size][0].tolist() == mf.smiles_to_fingerprint('CCO', size)
+        assert not fingerprints[size][1].any(), 'Expected invalid molecules to have empty fingerprints'
+
+
+def test_smiles_list_to_packed_fingerprints():
+    smiles_list = ['CCO', 'awd', 'c1ccccc1C(=O)O', 'CN1C=NC2=C1C(=O)N(C(=O)N2C)C']
+    dense, valid = mf.smiles_list_to_fingerprints(smiles_list, [64, 1024, 96])
+    packed, packed_valid = mf.smiles_list_to_fingerprints(smiles_list, [64, 1024, 96], packed=True)
+    assert packed_valid.tolist() == valid.tolist() == [True, False, True, True]
+    for size in [64, 1024, 96]:
+        assert packed[size].shape == (4, size // 8)
+        assert numpy.array_equal(numpy.unpackbits(packed[size], axis=-1), dense[size])
+        for idx in [0, 2, 3]:
+            assert dense[size][idx].tolist() == mf.smiles_to_fingerprint(smiles_list[idx], size)
+    assert mf.smiles_list_to_fingerprints(smiles_list, [])[0] == dict()
+
+
+@pytest.fixture
+def service():
+    service = mf.ChemistryService(1, timeout=1)
+    yield service
+    service.close()
+
+
+def test_chemistry_service(service):
+    first = service.submit(mf.smiles_to_3DCML, 'CCO')
+    assert service.submit(mf.smiles_to_3DCML, 'CCO') is first, 'Expected identical requests in flight to be shared'
+    assert 'cml' in first.result(timeout=30)
+    assert service.submit(mf.smiles_to_3DCML, 'CCO') is not first, 'Expected finished requests not to be shared'
+    with pytest.raises(mf.ConversionError):
+        service.submit(int, 'no number').result(timeout=30)
+
+
+def test_chemistry_service_timeout(service):
+    start = time.monotonic()
+    stalled = service.submit(time.sleep, 10)
+    waiting = service.submit(mf.smiles_to_mol_graph, 'CCO')
+    with pytest.raises(TimeoutError):
+        stalled.result(timeout=30)
+    assert waiting.result(timeout=30)[0].tolist() == [[6], [6], [8], [1], [1], [1], [1], [1], [1]], \
+        'Expected the worker to be replaced'
+    assert time.monotonic() - start < 8, 'Expected the stalled worker to be terminated'
+
+    service.close()
+    with pytest.raises(RuntimeError):
+        service.submit(mf.smiles_to_3DCML, 'CCO')
@@ -0,0 +1,52 @@
+import numpy
+import pytest
+
+from backend.utils.quantile_sketch import count_below, create_sketch, merge_sketches, sketch_histogram
+
+
+@pytest.mark.parametrize(
+    'bins, value_range',
+    [
+        (17, None),
+        (10, (-1., 1.)),
+        (1, (-5., 5.)),
+    ]
+)
+def test_small_sketch_is_exact(bins, value_range):
+    values = numpy.random.default_rng(0).normal(size=500).astype('float32')
+    sketch = create_sketch(values)
+    assert sketch.get('count') == 500 and len(sketch.get('quantiles')) == 500, 'Expected all values to be stored'
+    histogram = sketch_histogram(sketch, bins, value_range)
+    buckets, bin_edges = numpy.histogram(values, bins, value_range)
+    assert histogram.get('buckets') == buckets.tolist()
+    assert histogram.get('bin_edges') == pytest.approx(bin_edges.tolist())
+
+
+def test_large_sketch_approximates():
+    values = numpy.random.default_rng(0).normal(size=100000).astype('float32')
+    sketch = create_sketch(values, size=256)
+    assert len(sketch.get('quantiles')) == 256
+    assert sketch.get('quantiles')[0] == values.min() and sketch.get('quantiles')[-1] == values.max()
+    histogram = sketch_histogram(sketch, 40)
+    buckets, _ = numpy.histogram(values, 40)
+    assert sum(histogram.get('buckets')) == len(values)
+    assert numpy.abs(numpy.array(histogram.get('buckets')) - buckets).max() < 0.01 * len(values)
+
+
+def test_count_below():
+    sketch = create_sketch([1., 2., 2., 3.])
+    assert count_below(sketch, [0., 1., 2., 2.5, 4.]).tolist() == [0, 0, 1, 3, 4]
+    assert count_below(sketch, [0., 1., 2., 2.5, 4.], inclusive=True).tolist() == [0, 1, 3, 3, 4]
+    assert count_below(create_sketch([]), [1.]).tolist() == [0]
+
+
+def test_merge_sketches():
+    values = numpy.random.default_rng(1).exponential(size=30000).astype('float32')
+    exact = merge_sketches(create_sketch(values[:10]), create_sketch(values[10:20]))
+    assert exact == create_sketch(values[:20]), 'Expected merging small sketches to be exact'
+
+    merged = merge_sketches(create_sketch(values[:20000], size=512), create_sketch(values[20000:], size=512), size=512)
+    assert merged.get('count') == len(values) and len(merged.get('quantiles')) == 512
+    histogram = sketch_histogram(merged, 30, (0., 3.))
+    buckets, _ = numpy.histogram(values, 30, (0., 3.))
+    assert numpy.abs(numpy.array(histogram.get('buckets')) - buckets).max() < 0.01 * len(values)
@@ -1,8 +1,15 @@
 from pathlib import Path
 
+import numpy
 import pytest
 import copy
+import shutil
+import threading
 import backend.utils.storage_handler as sh
+from backend.utils import dataset_storage as ds
+from backend.utils.lru_cache import LRUCache
+from backend.utils.quantile_sketch import create_sketch
+from backend.scripts.datasets.convert_dataset import convert_dataset
 import backend.tests.mocks.mock_models as mm
 
 _test_user_id = 'Wakawaka'
@@ -376,3 +383,79 @@ def test_get_dataset_histograms(sh_datasets_histograms, dataset_id, labels):
         if sh_datasets_histograms.get(dataset_id):
             assert sh_datasets_histograms.get(dataset_id).get('histograms').get(label) == histograms.get(label)
 
+
+def test_get_dataset_histograms_from_sketches(mocker):
+    values = [0., 1., 1., 2., 3., 4.]
+    buckets, bin_edges = numpy.histogram(values, 4)
+    mocker.patch.object(sh._inst, 'dataset_summaries', {'1': {
+        'histograms': {'lumo': {'buckets': buckets.tolist(), 'bin_edges': bin_edges.tolist()},
+                       'gap': {'buckets': [6], 'bin_edges': [0, 1]}},
+        'sketches': {'lumo': create_sketch(values)}}})
+    mocker.patch.object(sh._inst, 'histogram_cache', LRUCache(4))
+
+    histograms = sh.get_dataset_histograms('1', ['lumo', 'gap'], value_range=(1., 3.))
+    assert histograms.get('lumo') == {'buckets': [2, 0, 1, 1], 'bin_edges': [1., 1.5, 2., 2.5, 3.]}, \
+        'Expected the stored number of bins in the requested range'
+    assert histograms.get('gap') == {'buckets': [6], 'bin_edges': [0, 1]}, 'Expected fixed histogram without sketch'
+    assert sh.get_dataset_histograms('1', ['lumo'], bins=2).get('lumo').get('buckets') == [3, 3]
+
+    histograms.get('lumo')['buckets'] = []
+    assert sh.get_dataset_histograms('1', ['lumo'], value_range=(1., 3.)).get('lumo').get('buckets') == [2, 0, 1, 1], \
+        'Expected cached histograms not to be modified through returned ones'
+    assert sh._inst.histogram_cache.hits == 1
+
+
+
+def test_dataset_cache_shares_instance(mocker):
+    dataset_path = next(path for path in sh._datasets_path.iterdir() if path.is_dir())
+    mocker.patch.object(sh._inst, 'dataset_summaries', {'0': {'datasetPath': str(dataset_path), 'version': 6}})
+    sh._inst.dataset_cache.clear()
+    hits = sh.get_dataset_cache_stats().get('hits')
+    dataset = sh.get_dataset('0')
+    assert dataset is not None, 'Expected shipped dataset to be loadable'
+    assert sh.get_dataset('0') is dataset, 'Expected trainings on the same dataset to share one instance'
+    assert sh.get_dataset_cache_stats().get('hits') == hits + 1, 'Expected second access to be a cache hit'
+    assert sh.get_dataset('not a dataset') is None
+
+
+def test_rescan_datasets(mocker, tmp_path):
+    shipped_path = next(path for path in sh._datasets_path.iterdir() if path.is_dir())
+    mocker.patch('backend.utils.storage_handler._datasets_path', tmp_path)
+    mocker.patch.object(sh._inst, 'dataset_summaries', dict())
+    shutil.copytree(shipped_path, tmp_path / 'b')
+    summaries = sh.rescan_datasets()
+    assert len(summaries) == 1, 'Expected copied dataset to be published'
+    dataset_id = next(iter(summaries))
+    assert dataset_id == ds.read_descriptor(shipped_path).get('hash')[:8], 'Expected ID derived from content'
+
+    convert_dataset(Path(__file__).parent / '..' / 'storage' / 'data' / 'test_dataset.pkl', tmp_path / 'a')
+    summaries = sh.rescan_datasets()
+    assert len(summaries) == 2, 'Expected new dataset to be published without a restart'
+    assert summaries.get(dataset_id).get('datasetPath') == str((tmp_path / 'b').absolute()), \
+        'Expected ID of existing dataset to stay the same'
+
+    shutil.copytree(tmp_path / 'a', tmp_path / 'c')
+    assert len(sh.rescan_datasets()) == 2, 'Expected datasets with identical content to be published once'
+
+    shutil.rmtree(tmp_path / 'b')
+    shutil.rmtree(tmp_path / 'c')
+    summaries = sh.rescan_datasets()
+    assert dataset_id not in summaries, 'Expected removed dataset to be unpublished'
+    assert sh.get_dataset(dataset_id) is None
+    assert sh.get_dataset_summaries() is summaries, 'Expected recent scan to be reused'
+
+    scanning = threading.Event()
+    finish = threading.Event()
+
+    def slow_scan(path):
+        scanning.set()
+        finish.wait(10)
+        return {}
+    mocker.patch.object(ds, 'read_descriptors', side_effect=slow_scan)
+    mocker.patch.object(sh._inst, 'datasets_scanned', 0)
+    assert sh.get_dataset_summaries() is summaries, 'Expected due scans to not block requests'
+    assert scanning.wait(10), 'Expected due scan to run in the background'
+    assert sh.get_dataset_summaries() is summaries
+    finish.set()
+    with sh._inst.scan_lock:
+        assert sh._inst.dataset_summaries == {}
@@ -1,5 +1,6 @@
 import hashlib
 import json
+import math
 import time
 import base64
 from functools import wraps
@@ -13,6 +14,7 @@ from flask_socketio import SocketIO, join_room
 import queue as gq
 
 from backend.machine_learning import ml_functions as ml
+from backend.utils import cml_cache
 from backend.utils import molecule_formats as mf
 from backend.utils import storage_handler as sh
 
@@ -55,6 +57,14 @@ parser.add_argument('baseModelID')
 parser.add_argument('parameters', type=dict)
 parser.add_argument('learningRate', type=float)
 
+# declaration of histogram query arguments
+histogram_parser = reqparse.RequestParser()
+histogram_parser.add_argument('bins', type=int, location='args')
+histogram_parser.add_argument('min', type=float, location='args')
+histogram_parser.add_argument('max', type=float, location='args')
+# upper limit of bins a client may request, larger requests are capped
+max_histogram_bins = 1000
+
 
 def authenticate(func):
     """
@@ -229,7 +239,7 @@ class Molecule(Resource):
         :return: Tuple of the CML-String and a response code, or None and a response code
         """
         smiles = base64.b64decode(b64_smiles).decode('utf8')
-        converted = mf.smiles_to_3DCML(smiles)
+        converted = cml_cache.get_3DCML(smiles)
         if converted:
             return converted, 200
         return None, 422
@@ -429,6 +439,7 @@ class Datasets(Resource):
                     'datasetID': dataset_id,
                     'size': current_dataset['size'],
                     'labelDescriptors': current_dataset['labelDescriptors'],
+                    'hasSmiles': current_dataset.get('hasSmiles', False),
                 })
         return processed_datasets
 
@@ -436,13 +447,27 @@ class Datasets(Resource):
 class Histograms(Resource):
     def get(self, dataset_id, labels):
         """
-        GET a dictionary of histograms of given dataset for each given label
+        GET a dictionary of histograms of given dataset for each given label.
+        Optional query arguments bins, min and max select the resolution and value range, e.g. to zoom into a chart.
+        min and max have to be given together and finite, bins are capped at max_histogram_bins
         :param dataset_id: string, ID of dataset
         :param labels: string containing comma-separated labels
         :return: dictionary with label-histogram entries; histograms are dictionaries with keys binEdges and buckets
         """
+        args = histogram_parser.parse_args()
+        bins = args['bins']
+        value_range = None
+        if args['min'] is not None or args['max'] is not None:
+            value_range = (args['min'], args['max'])
+            if None in value_range or not all(math.isfinite(value) for value in value_range) \
+                    or value_range[0] >= value_range[1]:
+                return None, 422
+        if bins is not None:
+            if bins < 1:
+                return None, 422
+            bins = min(bins, max_histogram_bins)
         separated_labels = labels.split(',')
-        histograms = sh.get_dataset_histograms(dataset_id, separated_labels)
+        histograms = sh.get_dataset_histograms(dataset_id, separated_labels, bins, value_range)
         for hist in histograms.values():
             hist['binEdges'] = list(hist.get('bin_edges'))
             del hist['bin_edges']
@@ -516,16 +541,20 @@ class Train(AuthenticatedResource):
         # Axios can't send arrays for some reason, => array converted to json string in frontend, back to array in here
         args = parser.parse_args()
         labels = json.loads(args['labels'])
-        # Starts the training as a background task to allow the server to respond to other requests while training
-        sio.start_background_task(target=ml.train,
-                                  user_id=user_id,
-                                  dataset_id=args['datasetID'],
-                                  model_id=args['modelID'],
-                                  labels=labels,
-                                  epochs=args['epochs'],
-                                  learning_rate=args['learningRate'],
-                                  batch_size=args['batchSize'])
-        return True, 202
+        # Topology graphs are built from SMILES codes, datasets converted from the pickle format have none
+        parameters = (sh.get_model_summary(user_id, args['modelID']) or {}).get('parameters', {})
+        dataset_summary = sh.get_dataset_summaries().get(args['datasetID'], {})
+        if parameters.get('inputType') == 'topology' and not dataset_summary.get('hasSmiles', False):
+            return False, 400
+        # Queues the training, the scheduler runs it in the background once a training slot is free
+        queued = ml.train(user_id=user_id,
+                          dataset_id=args['datasetID'],
+                          model_id=args['modelID'],
+                          labels=labels,
+                          epochs=args['epochs'],
+                          learning_rate=args['learningRate'],
+                          batch_size=args['batchSize'])
+        return (True, 202) if queued else (False, 503)
 
     def patch(self, user_id):
         """
@@ -544,15 +573,13 @@ class Train(AuthenticatedResource):
         if not bool(fitting_summary):
             return 0, 404
 
-        sio.start_background_task(target=ml.continue_training,
-                                  user_id=user_id,
-                                  fitting_id=args['fittingID'],
-                                  epochs=args['epochs'])
+        if not ml.continue_training(user_id=user_id, fitting_id=args['fittingID'], epochs=args['epochs']):
+            return 0, 503
         return (fitting_summary.get('epochs') + args['epochs']), 202
 
     def delete(self, user_id):
         """
-        Abort training if it is running
+        Abort training if it is running, or remove it from the queue if it has not started yet
         :param user_id: String ID of user wanting to stop their training
         :return: Boolean whether deletion was successful, int error code
         """
@@ -632,6 +659,30 @@ def notify_training_start(user_id, epochs):
         queue.put(('started', {user_id: epochs}))
 
 
+def notify_training_queued(user_id, position):
+    """
+    Queues a "queued" message with the position of the user's training in the training queue
+    :param user_id: ID of the user the "queued" message is intended to be received by
+    :param position: position in the training queue, starting at 1
+    :return: None
+    """
+    queue, _ = user_socket_queues.get(user_id, (None, None))
+    if queue:
+        queue.put(('queued', {user_id: position}))
+
+
+def notify_training_resources(user_id, allocation):
+    """
+    Queues a "resources" message with the CPU allocation of the user's running training
+    :param user_id: ID of the user the "resources" message is intended to be received by
+    :param allocation: dictionary with the number of threads and the list of CPU IDs the training runs on
+    :return: None
+    """
+    queue, _ = user_socket_queues.get(user_id, (None, None))
+    if queue and allocation:
+        queue.put(('resources', {user_id: allocation}))
+
+
 def update_training_logs(user_id, logs):
     """
     Queues an update message to be sent to the user
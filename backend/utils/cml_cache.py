@@ -0,0 +1,83 @@
+import threading
+
+from backend.utils import featurization_cache as fc
+from backend.utils import molecule_formats as mf
+from backend.utils.lru_cache import LRUCache
+
+"""
+Cache of the 3D CML documents served to the molecule viewer
+
+Embedding a molecule in 3D takes up to hundreds of milliseconds and the frontend requests the same molecules
+repeatedly. Documents are kept in memory by canonical SMILES and, if persistent, stored in the featurization cache on
+disk, so they survive restarts. Failed embeddings are cached as well, molecules which cannot be embedded are not
+retried on every request.
+"""
+
+# number of documents kept in memory
+_memory_cache_size = 1024
+# whether documents are stored in the featurization cache on disk as well
+_persistent = True
+# settings of smiles_to_3DCML, part of its featurization cache key
+_cml_parameters = {'embedding': 'ETKDG', 'maxAttempts': 1000}
+
+# values are 1-tuples, so failed embeddings (None) can be cached
+_memory_cache = LRUCache(_memory_cache_size)
+_disk_lock = threading.Lock()
+_disk_hits = 0
+_disk_misses = 0
+
+
+def get_3DCML(smiles):
+    """
+    Gets the CML document with 3D coordinates of a molecule, embedding it with smiles_to_3DCML on a miss.
+    All notations of a molecule share one document
+    :param smiles: SMILES code
+    :return: CML string or None if the molecule cannot be embedded (in time) or the SMILES code is invalid
+    """
+    canonical = fc.canonical_smiles(smiles)
+    if canonical is None:
+        return None
+    entry = _memory_cache.get(canonical)
+    if entry is None:
+        # embedding without holding the cache lock, so other molecules are served meanwhile
+        try:
+            entry = (_load_or_create(canonical),)
+        except (TimeoutError, mf.ConversionError):
+            # not cached, the molecule may be embedded in time on a less loaded server
+            return None
+        _memory_cache.put(canonical, entry)
+    return entry[0]
+
+
+def get_cml_cache_stats():
+    """
+    :return: dictionary with the hit/miss counters and usage of the memory cache and the hit/miss counters of the
+    disk cache, disk lookups only happen on memory misses
+    """
+    with _disk_lock:
+        requests = _disk_hits + _disk_misses
+        return _memory_cache.stats() | {'diskHits': _disk_hits,
+                                        'diskMisses': _disk_misses,
+                                        'diskHitRate': _disk_hits / requests if requests else 0}
+
+
+def _load_or_create(canonical):
+    global _disk_hits, _disk_misses
+    if not _persistent:
+        return _embed(canonical)
+
+    key = fc.featurization_key('cml', _cml_parameters, canonical)
+    cached = fc.get_many([key])
+    with _disk_lock:
+        _disk_hits += key in cached
+        _disk_misses += key not in cached
+    if key in cached:
+        return cached[key]
+    cml = _embed(canonical)
+    fc.put_many({key: cml})
+    return cml
+
+
+def _embed(canonical):
+    # Embeds in a worker process of the chemistry service, identical requests in flight share one embedding
+    return mf.chemistry_service.submit(mf.smiles_to_3DCML, canonical).result()
@@ -0,0 +1,651 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+"""
+Columnar on-disk format for datasets
+
+A dataset is a directory containing a descriptor.json (name, size, labels, histograms, ...) and one .npy file per
+column. Every column is a single contiguous array, so it can be memory-mapped and only the columns a training
+actually needs are ever read from disk.
+
+Columns:
+    labels_<i>                  float32 (size,)             values of the i-th label in the descriptor's label list
+    fingerprints_<bits>         uint8   (size, bits / 8)    morgan fingerprint bit vectors, bit-packed (numpy.packbits)
+    mol_graph_nodes             uint8   (total nodes, 1)    atomic numbers of all molecules, concatenated
+    mol_graph_node_splits       int64   (size + 1,)         row splits into mol_graph_nodes
+    mol_graph_edges             float32 (total edges, 1)    bond lengths of all molecules, concatenated
+    mol_graph_edge_indices      int32   (total edges, 2)    edge indices (per molecule) of all molecules, concatenated
+    mol_graph_edge_splits       int64   (size + 1,)         row splits into mol_graph_edges and mol_graph_edge_indices
+    smiles                      uint8   (total bytes,)      canonical SMILES codes of all molecules, utf-8, concatenated
+    smiles_splits               int64   (size + 1,)         row splits into smiles
+The smiles columns are optional, datasets converted from the pickle format do not have them.
+
+Datasets too large to be held in memory during training can be written as TFRecord shards instead
+(descriptor 'format': 'tfrecord'). Each record holds one molecule: 'labels' (all labels as floats) and every other
+column as raw bytes, their dtype and shape per molecule are listed in the descriptor's 'column_types'.
+Sharded datasets are streamed from disk during training.
+
+The split of a dataset into training, validation and test molecules is computed once and stored alongside its columns
+as split_indices.npz (sorted row indices per split), see compute_split_indices. It is not a column, so it neither
+changes the content hash nor is copied into appended datasets, which get splits of their own.
+
+The directory holding all datasets additionally contains an index.json caching the descriptors of all datasets,
+so listing the datasets only reads a single small file.
+Datasets are identified by a prefix of their content hash, so their IDs do not depend on the other datasets present.
+Appended datasets keep the ID of the dataset they extend (descriptor 'id'), so fittings on it stay attached.
+"""
+
+_descriptor_file = 'descriptor.json'
+_index_file = 'index.json'
+_split_file = 'split_indices.npz'
+# fractions of the molecules in the training, validation and test split
+_split_fractions = (0.7, 0.2, 0.1)
+# raise when altering how splits are computed, stored splits of other versions are computed anew
+_split_version = 1
+# number of molecules per TFRecord shard
+_shard_size = 10000
+# number of hex digits of the content hash used as dataset ID
+_dataset_id_length = 8
+# indices of dataset directories which could not be written, by directory path
+_unsaved_indices = dict()
+
+
+def is_dataset(path):
+    """
+    Checks whether the given path points to a dataset in the columnar format
+    :param path: path to check
+    :return: True if path is a dataset directory
+    """
+    return (Path(path) / _descriptor_file).exists()
+
+
+def has_smiles(path, descriptor):
+    """
+    Checks whether ColumnarDataset.get_smiles returns the SMILES codes of a dataset without opening it, e.g. to build
+    topology graphs from. Datasets converted from the pickle format and sharded datasets do not provide them
+    :param path: path to the dataset directory
+    :param descriptor: descriptor dictionary of the dataset
+    :return: True if the dataset has smiles columns
+    """
+    return descriptor.get('format') != 'tfrecord' and (Path(path) / 'smiles.npy').exists()
+
+
+def read_descriptor(path):
+    """
+    Reads the descriptor of a dataset without touching any of its columns
+    :param path: path to the dataset directory
+    :return: descriptor dictionary
+    """
+    with (Path(path) / _descriptor_file).open('r') as file:
+        return json.load(file)
+
+
+def write_descriptor(path, descriptor):
+    """
+    Writes the descriptor of a dataset, replacing an existing one in one step, so readers never see a partially
+    written descriptor
+    :param path: path to the dataset directory
+    :param descriptor: descriptor dictionary
+    """
+    temporary_path = Path(path) / f'{_descriptor_file}.tmp'
+    with temporary_path.open('w') as file:
+        json.dump(descriptor, file)
+    temporary_path.replace(Path(path) / _descriptor_file)
+
+
+def read_descriptors(datasets_path):
+    """
+    Reads the descriptors of all datasets in a directory without touching any of their columns.
+    Descriptors are taken from the index where it is up-to-date, only new or changed datasets are read.
+    Descriptors without a content hash get it computed once and stored in the index.
+    Rewrites the index if it was outdated. Writing it is best-effort, if the directory is read-only the index is kept
+    in memory only, so hashes are still computed only once per process.
+    :param datasets_path: path to the directory containing the datasets
+    :return: dictionary of dataset path: descriptor, sorted by path
+    """
+    datasets_path = Path(datasets_path)
+    index_path = datasets_path / _index_file
+    index = dict()
+    if index_path.exists():
+        try:
+            with index_path.open('r') as file:
+                index = json.load(file)
+        except (json.decoder.JSONDecodeError, OSError):
+            print(f'Error reading {index_path.name}, rebuilding it')
+    unsaved_index = _unsaved_indices.get(str(datasets_path), {})
+
+    descriptors = dict()
+    new_index = dict()
+    for path in sorted(datasets_path.iterdir()):
+        # hidden directories hold datasets which are being rewritten, e.g. by append_dataset
+        if path.name.startswith('.') or not is_dataset(path):
+            continue
+        try:
+            modified = (path / _descriptor_file).stat().st_mtime_ns
+            entry = next((entry for entry in (index.get(path.name), unsaved_index.get(path.name))
+                          if entry and entry.get('modified') == modified), None)
+            if not entry:
+                descriptor = read_descriptor(path)
+                if not descriptor.get('hash'):
+                    descriptor['hash'] = hash_columns(path)
+                entry = {'modified': modified, 'descriptor': descriptor}
+        except FileNotFoundError:
+            # removed or being swapped meanwhile, e.g. by replace_dataset, the next scan picks it up again
+            continue
+        new_index[path.name] = entry
+        descriptors[path] = entry.get('descriptor')
+
+    if new_index != index:
+        _unsaved_indices[str(datasets_path)] = new_index
+        temporary_path = None
+        try:
+            # Replaces the index in one step, so concurrent readers never see a partially written index.
+            # Every writer uses its own temporary file, so concurrent writers never interleave
+            with tempfile.NamedTemporaryFile('w', dir=datasets_path, prefix=f'.{_index_file}.', suffix='.tmp',
+                                             delete=False) as file:
+                temporary_path = Path(file.name)
+                json.dump(new_index, file)
+            os.replace(temporary_path, index_path)
+            _unsaved_indices.pop(str(datasets_path), None)
+        except OSError as e:
+            print(f'Error writing {index_path.name}, keeping the index in memory')
+            print(e)
+            if temporary_path is not None:
+                temporary_path.unlink(missing_ok=True)
+    return descriptors
+
+
+def dataset_id(descriptor):
+    """
+    Derives the stable ID of a dataset from its content hash, appended datasets keep the ID stored in their descriptor
+    :param descriptor: descriptor dictionary containing the content hash
+    :return: string ID, identical for datasets with identical columns
+    """
+    return descriptor.get('id') or descriptor.get('hash')[:_dataset_id_length]
+
+
+def open_dataset(path):
+    """
+    Opens a dataset in the format given by its descriptor
+    :param path: path to the dataset directory
+    :return: ColumnarDataset or ShardedDataset
+    """
+    if read_descriptor(path).get('format') == 'tfrecord':
+        return ShardedDataset(path)
+    return ColumnarDataset(path)
+
+
+def hash_columns(path):
+    """
+    Computes a content hash over all columns (or shards) of a dataset
+    :param path: path to the dataset directory
+    :return: hex digest, identical for datasets with identical columns
+    """
+    content_hash = hashlib.sha256()
+    # other files, e.g. reports written along with the dataset, are not part of its content
+    for column_path in sorted(p for p in Path(path).iterdir() if p.suffix in ('.npy', '.tfrecord')):
+        content_hash.update(column_path.stem.encode('utf-8'))
+        with column_path.open('rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def compute_split_indices(keys, fractions=_split_fractions):
+    """
+    Splits the rows of a dataset by a stable hash of their keys: rows are ordered by the blake2b digests of their keys
+    and this order is cut into the training, validation and test split. Unlike hash(), the digests neither depend on the
+    process nor on the order of the rows, so every process computes the same splits.
+    Rows with identical keys, e.g. duplicated molecules, are adjacent in this order. Cuts are moved behind them, so they
+    always end up in the same split
+    :param keys: list of bytes identifying the rows, e.g. their canonical SMILES codes
+    :param fractions: fractions of the rows in the training and validation split, the test split gets the rest
+    :return: training, validation and test indices, sorted int64 arrays
+    """
+    digests = np.array([hashlib.blake2b(key, digest_size=8).digest() for key in keys], dtype='S8')
+    order = np.argsort(digests, kind='stable')
+    ranked = digests[order]
+
+    def cut(position):
+        if 0 < position < len(ranked):
+            return int(np.searchsorted(ranked, ranked[position - 1], side='right'))
+        return position
+
+    training_end = cut(int(fractions[0] * len(keys)))
+    validation_end = cut(training_end + int(fractions[1] * len(keys)))
+    return (np.sort(order[:training_end]),
+            np.sort(order[training_end:validation_end]),
+            np.sort(order[validation_end:]))
+
+
+def load_split_indices(dataset, keys=None):
+    """
+    Loads the split indices stored alongside a dataset, computes and stores them if they are missing
+    :param dataset: ColumnarDataset or ShardedDataset
+    :param keys: list of bytes identifying the rows, the rows' positions salted with the content hash if None
+    :return: training, validation and test indices, see compute_split_indices
+    """
+    path = dataset.path / _split_file
+    try:
+        with np.load(path) as stored:
+            split_indices = (stored['training'], stored['validation'], stored['test'])
+            version = stored['version']
+        if version == _split_version and sum(len(indices) for indices in split_indices) == dataset.size:
+            return split_indices
+    except (OSError, KeyError, ValueError):
+        pass
+
+    if keys is None:
+        keys = [f'{dataset.content_hash}:{row}'.encode('utf-8') for row in range(dataset.size)]
+    split_indices = compute_split_indices(keys)
+    # Writes to a temporary file first, so concurrent trainings never read a partially written file
+    temporary_path = dataset.path / f'{_split_file}.{os.getpid()}.part'
+    try:
+        with temporary_path.open('wb') as file:
+            np.savez(file, training=split_indices[0], validation=split_indices[1], test=split_indices[2],
+                     version=_split_version)
+        temporary_path.replace(path)
+    except OSError as e:
+        print(f'Error storing the split indices of {dataset.path}')
+        print(e)
+        temporary_path.unlink(missing_ok=True)
+    return split_indices
+
+
+class ColumnarDataset:
+    """
+    Read-only view of a dataset stored in the columnar format.
+    Columns are memory-mapped on first access and kept open for the lifetime of this object.
+    All returned arrays are read-only, so a single instance can be shared between concurrent trainings.
+    """
+
+    streaming = False
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.descriptor = read_descriptor(self.path)
+        self.columns = dict()
+        self.label_sets = dict()
+        self.split_indices = None
+
+    @property
+    def name(self):
+        return self.descriptor.get('name')
+
+    @property
+    def size(self):
+        return self.descriptor.get('size')
+
+    @property
+    def labels(self):
+        return self.descriptor.get('labels')
+
+    @property
+    def content_hash(self):
+        """
+        Content hash of the dataset's columns, computed on first access if the descriptor does not contain it
+        """
+        if not self.descriptor.get('hash'):
+            self.descriptor['hash'] = hash_columns(self.path)
+        return self.descriptor.get('hash')
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of heap memory owned by this instance, i.e. of the label sets built so far.
+        Mapped columns are not counted, their pages are shared with other instances and processes through the OS page
+        cache and are evicted by the OS under memory pressure.
+        """
+        return sum(label_set.nbytes for label_set in self.label_sets.values())
+
+    def get_column(self, column):
+        """
+        Memory-maps a single column of the dataset
+        :param column: name of the column, see module documentation
+        :return: read-only numpy array
+        """
+        if column not in self.columns:
+            self.columns[column] = np.load(self.path / f'{column}.npy', mmap_mode='r')
+        return self.columns[column]
+
+    def get_labels(self, labels):
+        """
+        Gets the values of the given labels
+        :param labels: list of label names
+        :return: float32 array of shape (size, len(labels))
+        """
+        key = tuple(labels)
+        if key not in self.label_sets:
+            label_set = np.stack([self.get_column(f'labels_{self.labels.index(label)}') for label in labels], axis=-1)
+            label_set.flags.writeable = False
+            self.label_sets[key] = label_set
+        return self.label_sets[key]
+
+    def get_fingerprints(self, fingerprint_size):
+        """
+        Gets the bit-packed fingerprints of the given size, unpack them with numpy.unpackbits(..., axis=-1)
+        :param fingerprint_size: number of bits per fingerprint
+        :return: uint8 array of shape (size, fingerprint_size / 8)
+        """
+        return self.get_column(f'fingerprints_{fingerprint_size}')
+
+    def get_mol_graphs(self):
+        """
+        Gets the mol graphs of all molecules as concatenated arrays with row splits
+        :return: nodes, node_splits, edges, edge_indices, edge_splits
+        """
+        return tuple(self.get_column(f'mol_graph_{part}')
+                     for part in ('nodes', 'node_splits', 'edges', 'edge_indices', 'edge_splits'))
+
+    def get_smiles(self):
+        """
+        Gets the canonical SMILES codes of all molecules
+        :return: list of strings or None if the dataset has no smiles columns
+        """
+        if not (self.path / 'smiles.npy').exists():
+            return None
+        data = self.get_column('smiles').tobytes()
+        splits = self.get_column('smiles_splits')
+        return [data[start:end].decode('utf-8') for start, end in zip(splits[:-1], splits[1:])]
+
+    def get_split_indices(self):
+        """
+        Gets the rows of the training, validation and test split, keyed by the canonical SMILES codes if present, so
+        a molecule contained more than once is part of a single split. Datasets converted from the pickle format have
+        no SMILES codes, their rows are keyed by position and duplicates may end up in different splits
+        :return: training, validation and test indices, see compute_split_indices
+        """
+        if self.split_indices is None:
+            smiles = self.get_smiles()
+            keys = None if smiles is None else [code.encode('utf-8') for code in smiles]
+            self.split_indices = load_split_indices(self, keys)
+        return self.split_indices
+
+
+class ShardedDataset:
+    """
+    Dataset stored as TFRecord shards, streamed from disk instead of being loaded into memory.
+    """
+
+    streaming = True
+    nbytes = 0
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.descriptor = read_descriptor(self.path)
+        self.split_indices = None
+
+    @property
+    def name(self):
+        return self.descriptor.get('name')
+
+    @property
+    def size(self):
+        return self.descriptor.get('size')
+
+    @property
+    def labels(self):
+        return self.descriptor.get('labels')
+
+    @property
+    def content_hash(self):
+        if not self.descriptor.get('hash'):
+            self.descriptor['hash'] = hash_columns(self.path)
+        return self.descriptor.get('hash')
+
+    def get_split_indices(self):
+        """
+        Gets the rows of the training, validation and test split, in the order the shards are streamed
+        :return: training, validation and test indices, see compute_split_indices
+        """
+        if self.split_indices is None:
+            self.split_indices = load_split_indices(self)
+        return self.split_indices
+
+    def stream(self, inputs, labels):
+        """
+        Streams the given columns and labels from the shards
+        :param inputs: list of column names, e.g. ['fingerprints_512']
+        :param labels: list of label names
+        :return: unbatched tf.data.Dataset of (inputs, labels) pairs with the stored dtypes.
+        inputs is a tuple if more than one column is given, labels is a float32 vector
+        """
+        column_types = self.descriptor.get('column_types')
+        label_indices = [self.labels.index(label) for label in labels]
+        features = {'labels': tf.io.FixedLenFeature([len(self.labels)], tf.float32)}
+        for column in inputs:
+            features[column] = tf.io.FixedLenFeature([], tf.string)
+
+        def parse(record):
+            example = tf.io.parse_single_example(record, features)
+            x = tuple(tf.reshape(tf.io.decode_raw(example[column], column_types[column]['dtype']),
+                                 [-1 if dim is None else dim for dim in column_types[column]['shape']])
+                      for column in inputs)
+            y = tf.gather(example['labels'], label_indices)
+            return (x[0] if len(x) == 1 else x), y
+
+        shards = [str(shard) for shard in sorted(self.path.glob('*.tfrecord'))]
+        return tf.data.TFRecordDataset(shards, num_parallel_reads=tf.data.AUTOTUNE) \
+            .map(parse, num_parallel_calls=tf.data.AUTOTUNE) \
+            .apply(tf.data.experimental.assert_cardinality(self.size))
+
+
+def molecules_to_columns(molecules, labels):
+    """
+    Converts a list of molecule dictionaries as produced by create_dataset to columns
+    :param molecules: list of dictionaries with keys 'x' (fingerprints, mol_graph), 'y' (label: value) and optionally
+    'smiles' (canonical SMILES code). Fingerprints are bit vectors or bit-packed, see pack_fingerprints
+    :param labels: list of label names, defines the order of the label columns
+    :return: dictionary of column name: numpy array
+    """
+    columns = dict()
+    for idx, label in enumerate(labels):
+        columns[f'labels_{idx}'] = np.array([mol['y'][label] for mol in molecules], dtype='float32')
+
+    for size in molecules[0]['x']['fingerprints'].keys():
+        if int(size) % 8 != 0:
+            raise ValueError(f'Fingerprint size must be a multiple of 8 to be bit-packed, got {size}')
+        fingerprints = np.asarray([mol['x']['fingerprints'][size] for mol in molecules], dtype='uint8')
+        # fingerprints of featurize_chunk are bit-packed already
+        columns[f'fingerprints_{size}'] = fingerprints if fingerprints.shape[-1] == int(size) // 8 \
+            else pack_fingerprints(fingerprints)
+
+    nodes, edges, edge_indices = zip(*[mol['x']['mol_graph'] for mol in molecules])
+    columns['mol_graph_nodes'] = np.concatenate(nodes).astype('uint8')
+    columns['mol_graph_node_splits'] = np.cumsum([0] + [len(n) for n in nodes], dtype='int64')
+    columns['mol_graph_edges'] = np.concatenate(edges).astype('float32')
+    columns['mol_graph_edge_indices'] = np.concatenate(edge_indices).astype('int32')
+    columns['mol_graph_edge_splits'] = np.cumsum([0] + [len(e) for e in edges], dtype='int64')
+
+    if 'smiles' in molecules[0]:
+        encoded = [mol['smiles'].encode('utf-8') for mol in molecules]
+        columns['smiles'] = np.frombuffer(b''.join(encoded), dtype='uint8')
+        columns['smiles_splits'] = np.cumsum([0] + [len(e) for e in encoded], dtype='int64')
+    return columns
+
+
+def pack_fingerprints(fingerprints):
+    """
+    Packs fingerprint bit vectors into bytes, 8 bits per byte
+    :param fingerprints: array-like of shape (..., bits) containing only 0 and 1, bits a multiple of 8
+    :return: uint8 array of shape (..., bits / 8)
+    """
+    return np.packbits(np.asarray(fingerprints, dtype='uint8'), axis=-1)
+
+
+class DatasetWriter:
+    """
+    Writes a dataset in the columnar format chunk by chunk, so datasets larger than memory can be created.
+    Appended chunks are written to temporary .part files right away, close() turns them into .npy columns.
+    The dataset becomes readable once write_descriptor() was called.
+    """
+
+    def __init__(self, path, labels, base=None):
+        """
+        Creates a new DatasetWriter, replaces an existing dataset at the given path
+        :param path: path of the dataset directory to create
+        :param labels: list of label names, defines the order of the label columns
+        :param base: optional ColumnarDataset whose molecules are copied to the new dataset before any appended ones,
+        must be stored at a different path
+        """
+        self.path = Path(path)
+        self.labels = labels
+        self.size = 0
+        self.fingerprint_sizes = list()
+        # column: (dtype, shape per row, number of rows)
+        self.column_types = dict()
+        # last value of each row splits column written so far
+        self.split_ends = dict()
+        if base is not None and (base.labels != labels or base.path.resolve() == self.path.resolve()):
+            raise ValueError('A base dataset must have the same labels and a different path')
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        if base is not None:
+            self.__copy(base)
+
+    def __copy(self, base):
+        # Copies the data behind the .npy headers of the base dataset's columns to .part files, as if appended
+        for column_path in sorted(base.path.glob('*.npy')):
+            column = column_path.stem
+            with column_path.open('rb') as source, (self.path / f'{column}.part').open('wb') as file:
+                version = np.lib.format.read_magic(source)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+                shape, _, dtype = read_header(source)
+                shutil.copyfileobj(source, file, 1024 * 1024)
+            if column.endswith('_splits'):
+                self.split_ends[column] = base.get_column(column)[-1]
+            self.column_types[column] = (dtype, shape[1:], shape[0])
+        self.size = base.size
+        self.fingerprint_sizes = list(base.descriptor.get('fingerprint_sizes'))
+
+    def append(self, molecules):
+        """
+        Appends molecules to the dataset
+        :param molecules: list of dictionaries with keys 'x' (fingerprints, mol_graph), 'y' (label: value) and
+        optionally 'smiles' (canonical SMILES code)
+        """
+        if not molecules:
+            return
+        columns = molecules_to_columns(molecules, self.labels)
+        if self.column_types and set(columns.keys()) != set(self.column_types.keys()):
+            raise ValueError(f'Columns changed from {sorted(self.column_types.keys())} to {sorted(columns.keys())}')
+        if not self.fingerprint_sizes:
+            self.fingerprint_sizes = [int(size) for size in molecules[0]['x']['fingerprints'].keys()]
+
+        for column, data in columns.items():
+            if column.endswith('_splits'):
+                # row splits of later chunks continue where the previous chunk ended
+                if column in self.split_ends:
+                    data = data[1:] + self.split_ends[column]
+                self.split_ends[column] = data[-1]
+            dtype, shape, rows = self.column_types.get(column, (data.dtype, data.shape[1:], 0))
+            if (dtype, shape) != (data.dtype, data.shape[1:]):
+                raise ValueError(f'Column {column} changed from {dtype}{shape} to {data.dtype}{data.shape[1:]}')
+            self.column_types[column] = (dtype, shape, rows + len(data))
+            with (self.path / f'{column}.part').open('ab') as file:
+                np.ascontiguousarray(data).tofile(file)
+        self.size += len(molecules)
+
+    def close(self):
+        """
+        Writes all appended columns as .npy files
+        """
+        for column, (dtype, shape, rows) in self.column_types.items():
+            part_path = self.path / f'{column}.part'
+            with (self.path / f'{column}.npy').open('wb') as file:
+                np.lib.format.write_array_header_1_0(file, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                            'fortran_order': False,
+                                                            'shape': (rows,) + shape})
+                with part_path.open('rb') as part:
+                    shutil.copyfileobj(part, file, 1024 * 1024)
+            part_path.unlink()
+
+    def write_descriptor(self, header):
+        """
+        Writes the descriptor of the closed dataset. It is written last, an interrupted write never results in a
+        readable dataset
+        :param header: descriptor fields, 'size', 'labels', 'fingerprint_sizes' and 'hash' are set by the writer
+        :return: path of the written dataset
+        """
+        header = dict(header)
+        header['size'] = self.size
+        header['labels'] = self.labels
+        header['fingerprint_sizes'] = self.fingerprint_sizes
+        header['hash'] = hash_columns(self.path)
+        write_descriptor(self.path, header)
+        return self.path
+
+
+def write_dataset(path, descriptor):
+    """
+    Writes a dataset descriptor as produced by add_dataset_descriptor to the columnar format.
+    Replaces an existing dataset at the given path.
+    :param path: path of the dataset directory to create
+    :param descriptor: dictionary with fields 'name', 'size', 'labels', 'dataset', 'version', 'histograms',
+    'parameters'
+    :return: path of the written dataset
+    """
+    writer = DatasetWriter(path, descriptor.get('labels'))
+    writer.append(descriptor.get('dataset'))
+    writer.close()
+    return writer.write_descriptor({key: value for key, value in descriptor.items() if key != 'dataset'})
+
+
+def write_sharded_dataset(path, dataset, shard_size=None):
+    """
+    Writes a columnar dataset as TFRecord shards. Reads the columnar dataset one molecule at a time,
+    so datasets larger than memory can be sharded.
+    Replaces an existing dataset at the given path.
+    :param path: path of the dataset directory to create
+    :param dataset: ColumnarDataset to shard
+    :param shard_size: number of molecules per shard, defaults to 10000
+    :return: path of the written dataset
+    """
+    shard_size = shard_size or _shard_size
+    path = Path(path)
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+
+    labels = [dataset.get_column(f'labels_{idx}') for idx in range(len(dataset.labels))]
+    fingerprints = {f'fingerprints_{size}': dataset.get_fingerprints(size)
+                    for size in dataset.descriptor.get('fingerprint_sizes')}
+    nodes, node_splits, edges, edges_i, edge_splits = dataset.get_mol_graphs()
+    graph_columns = {'mol_graph_nodes': (nodes, node_splits),
+                     'mol_graph_edges': (edges, edge_splits),
+                     'mol_graph_edge_indices': (edges_i, edge_splits)}
+
+    column_types = {column: {'dtype': data.dtype.name, 'shape': list(data.shape[1:])}
+                    for column, data in fingerprints.items()}
+    # graph columns hold a variable number of rows per molecule
+    column_types |= {column: {'dtype': data.dtype.name, 'shape': [None] + list(data.shape[1:])}
+                     for column, (data, _) in graph_columns.items()}
+
+    def to_bytes_feature(array):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.ascontiguousarray(array).tobytes()]))
+
+    for shard_idx, start in enumerate(range(0, dataset.size, shard_size)):
+        with tf.io.TFRecordWriter(str(path / f'shard_{shard_idx:05d}.tfrecord')) as writer:
+            for idx in range(start, min(start + shard_size, dataset.size)):
+                feature = {'labels': tf.train.Feature(float_list=tf.train.FloatList(
+                    value=[float(column[idx]) for column in labels]))}
+                for column, data in fingerprints.items():
+                    feature[column] = to_bytes_feature(data[idx])
+                for column, (data, splits) in graph_columns.items():
+                    feature[column] = to_bytes_feature(data[splits[idx]:splits[idx + 1]])
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+    header = dict(dataset.descriptor)
+    header['format'] = 'tfrecord'
+    header['column_types'] = column_types
+    header['hash'] = hash_columns(path)
+    write_descriptor(path, header)
+    return path
@@ -0,0 +1,130 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from rdkit import Chem
+
+"""
+Persistent cache of molecule featurizations
+
+Maps (featurizer, featurizer parameters, canonical SMILES) to the featurizer's result, stored in a sqlite database.
+Failed featurizations are cached as well, so molecules which cannot be embedded are not retried on every build.
+Results are looked up and stored by the calling process only, worker pools just compute the misses.
+"""
+
+_featurization_cache_path = Path(__file__.replace('featurization_cache.py', '')) / '..' / 'storage' / \
+                            'featurization_cache.sqlite'
+# raise when altering any featurizer in molecule_formats, invalidates all cached featurizations
+_featurizer_version = 1
+
+_lock = threading.Lock()
+# connection of this process, a connection must not be shared with forked worker processes
+_connection = None
+_connection_pid = None
+
+
+def canonical_smiles(smiles):
+    """
+    Converts a SMILES code to RDKit's canonical SMILES, so different notations of a molecule share cache entries
+    :param smiles: SMILES code
+    :return: canonical SMILES or None if RDKit cannot parse the SMILES code
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    return Chem.MolToSmiles(mol) if mol is not None else None
+
+
+def featurization_key(featurizer, parameters, canonical):
+    """
+    Creates the cache key for a featurization
+    :param featurizer: name of the featurizer, e.g. 'fingerprint' or 'mol_graph'
+    :param parameters: dictionary of all parameters influencing the result, e.g. {'size': 512, 'radius': 2}
+    :param canonical: canonical SMILES code, see canonical_smiles
+    :return: hex digest or None if there is no canonical SMILES code
+    """
+    if canonical is None:
+        return None
+    content = json.dumps([_featurizer_version, featurizer, parameters, canonical], sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_or_create(featurizer, parameters, smiles, featurize):
+    """
+    Gets a single featurization from the cache, computing and storing it with featurize() on a miss
+    :param featurizer: name of the featurizer, e.g. 'fingerprint' or 'mol_graph'
+    :param parameters: dictionary of all parameters influencing the result
+    :param smiles: SMILES code
+    :param featurize: function without arguments computing the featurization
+    :return: cached or computed featurization
+    """
+    return map_cached(lambda function, smiles_list: [function() for _ in smiles_list],
+                      featurizer, parameters, [smiles], featurize)[0]
+
+
+def map_cached(map_function, featurizer, parameters, smiles_list, featurize):
+    """
+    Featurizes a list of SMILES codes, only those missing from the cache are passed to map_function
+    :param map_function: map-like function, e.g. Pool.map, called as map_function(featurize, missing_smiles)
+    :param featurizer: name of the featurizer, e.g. 'fingerprint' or 'mol_graph'
+    :param parameters: dictionary of all parameters influencing the result
+    :param smiles_list: list of SMILES codes
+    :param featurize: function featurizing a single SMILES code, must be picklable to be used with a process pool
+    :return: list of featurizations in the order of smiles_list
+    """
+    keys = [featurization_key(featurizer, parameters, canonical_smiles(smiles)) for smiles in smiles_list]
+    cached = get_many([key for key in keys if key is not None])
+    missing = [idx for idx, key in enumerate(keys) if key not in cached]
+
+    results = dict(zip(missing, map_function(featurize, [smiles_list[idx] for idx in missing])))
+    put_many({keys[idx]: result for idx, result in results.items() if keys[idx] is not None})
+    return [results[idx] if idx in results else cached[key] for idx, key in enumerate(keys)]
+
+
+def get_many(keys):
+    """
+    Reads featurizations from the cache
+    :param keys: list of keys, see featurization_key
+    :return: dictionary of key: featurization for all keys in the cache
+    """
+    found = dict()
+    with _lock:
+        connection = _get_connection()
+        # sqlite limits the number of variables per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = connection.execute(f'SELECT key, value FROM featurizations WHERE key IN '
+                                      f'({",".join("?" * len(batch))})', batch)
+            found |= {key: pickle.loads(value) for key, value in rows}
+    return found
+
+
+def put_many(results):
+    """
+    Stores featurizations in the cache
+    :param results: dictionary of key: featurization, see featurization_key
+    """
+    if not results:
+        return
+    with _lock:
+        connection = _get_connection()
+        connection.executemany('INSERT OR REPLACE INTO featurizations VALUES (?, ?)',
+                               [(key, pickle.dumps(value)) for key, value in results.items()])
+        connection.commit()
+
+
+def clear():
+    with _lock:
+        _get_connection().execute('DELETE FROM featurizations')
+        _get_connection().commit()
+
+
+def _get_connection():
+    global _connection, _connection_pid
+    if _connection is None or _connection_pid != os.getpid():
+        _featurization_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        _connection = sqlite3.connect(_featurization_cache_path, timeout=60, check_same_thread=False)
+        _connection.execute('CREATE TABLE IF NOT EXISTS featurizations (key TEXT PRIMARY KEY, value BLOB)')
+        _connection_pid = os.getpid()
+    return _connection
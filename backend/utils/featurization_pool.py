@@ -0,0 +1,164 @@
+from collections import deque
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+import math
+import time
+
+"""
+Process pool for featurizations which may stall
+
+Unlike multiprocessing.Pool, every task has a time limit: a worker exceeding it is terminated and replaced, its task
+fails with a TaskFailure while the remaining tasks continue on the other workers. Tasks raising an exception or
+crashing their worker fail the same way, so a few bad molecules can neither stall nor abort a dataset build.
+"""
+
+# seconds a single task may take before its worker is terminated
+default_task_timeout = 120
+# upper limit of tasks sent to a worker at once, larger chunks need less communication
+_max_chunk_size = 32
+
+
+class TaskFailure:
+    """
+    Result of a task which did not return a value
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __repr__(self):
+        return f'TaskFailure({self.reason!r})'
+
+
+def _work(connection):
+    while True:
+        try:
+            chunk = connection.recv()
+        except EOFError:
+            return
+        if chunk is None:
+            return
+        function, tasks = chunk
+        for idx, args in tasks:
+            try:
+                result = function(*args)
+            except Exception as e:
+                result = TaskFailure(f'error: {e!r}')
+            connection.send((idx, result))
+
+
+class Worker:
+    """
+    Worker process running chunks of tasks sent to it, one at a time.
+    Tasks of the current chunk are held in tasks until their result arrives, the first one is running since started
+    """
+
+    def __init__(self, context=None):
+        """
+        Starts a new worker process
+        :param context: multiprocessing context to start the process with, defaults to the platform's start method.
+        Processes running threads, e.g. TensorFlow's, must not fork, pass a 'spawn' or 'forkserver' context there
+        """
+        self.connection, worker_connection = Pipe()
+        process = Process if context is None else context.Process
+        self.process = process(target=_work, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        # (idx, args) of the tasks sent to this worker without a result yet, the first one is running
+        self.tasks = deque()
+        self.started = None
+
+    def send(self, function, tasks):
+        self.tasks.extend(tasks)
+        self.started = time.monotonic()
+        self.connection.send((function, tasks))
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+class FeaturizationPool:
+    """
+    Pool of worker processes running tasks with a time limit per task.
+    Use as a context manager, like multiprocessing.Pool.
+    """
+
+    def __init__(self, processes, timeout=default_task_timeout, max_chunk_size=_max_chunk_size):
+        """
+        Starts a new FeaturizationPool
+        :param processes: number of worker processes
+        :param timeout: seconds a single task may take before its worker is terminated
+        :param max_chunk_size: upper limit of tasks sent to a worker at once
+        """
+        self.timeout = timeout
+        self.max_chunk_size = max_chunk_size
+        self.workers = [Worker() for _ in range(processes)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def starmap(self, function, tasks):
+        """
+        Runs function(*args) for all args in tasks. Results arrive in any order, but are returned in task order
+        :param function: module level function, so it can be sent to the worker processes
+        :param tasks: iterable of argument tuples
+        :return: list of results, TaskFailure for tasks that timed out, raised an exception or crashed their worker
+        """
+        pending = deque(enumerate(tasks))
+        results = [None] * len(pending)
+        remaining = len(pending)
+        # small chunks for few tasks, so all workers get some, at most max_chunk_size to limit re-sent tasks
+        chunk_size = max(1, min(math.ceil(len(pending) / (len(self.workers) * 4)), self.max_chunk_size))
+
+        while remaining:
+            for worker in self.workers:
+                if not worker.tasks and pending:
+                    worker.send(function, [pending.popleft() for _ in range(min(chunk_size, len(pending)))])
+
+            busy = {worker.connection: worker for worker in self.workers if worker.tasks}
+            deadline = min(worker.started for worker in busy.values()) + self.timeout
+            for connection in wait(list(busy.keys()), timeout=max(deadline - time.monotonic(), 0)):
+                worker = busy[connection]
+                try:
+                    idx, result = connection.recv()
+                except (EOFError, OSError):
+                    self.__replace(worker, results, pending, 'worker crashed')
+                    remaining -= 1
+                    continue
+                results[idx] = result
+                remaining -= 1
+                worker.tasks.popleft()
+                # the next task of the chunk starts now
+                worker.started = time.monotonic()
+
+            now = time.monotonic()
+            for worker in busy.values():
+                if worker.tasks and now - worker.started > self.timeout:
+                    self.__replace(worker, results, pending, f'timeout after {self.timeout}s')
+                    remaining -= 1
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=1)
+            worker.terminate()
+        self.workers = []
+
+    def __replace(self, worker, results, pending, reason):
+        # Fails the running task of a worker, re-queues the rest of its chunk and replaces it with a new worker
+        idx, _ = worker.tasks.popleft()
+        results[idx] = TaskFailure(reason)
+        pending.extendleft(reversed(worker.tasks))
+        worker.tasks.clear()
+        worker.terminate()
+        self.workers[self.workers.index(worker)] = Worker()
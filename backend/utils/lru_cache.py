@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache with a budget.
+
+    Every entry has a cost, by default 1, so the budget is the maximum number of entries.
+    Pass a cost function (e.g. size in bytes) to budget by something else.
+    Costs are re-evaluated whenever the cache evicts, so entries may grow after they have been added.
+    """
+
+    def __init__(self, budget, cost=None):
+        """
+        Creates a new, empty LRUCache
+        :param budget: maximum total cost of all entries
+        :param cost: function mapping a value to its cost, defaults to 1 per entry
+        """
+        self.budget = budget
+        self.cost = cost if cost else (lambda value: 1)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        # key -> [lock, number of callers holding or waiting for it], see get_or_create
+        self.creations = dict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.__evict(keep=key)
+
+    def get_or_create(self, key, create):
+        """
+        Gets the value for key, creating and adding it with create() on a miss.
+        create is called while holding a lock of this key only, so concurrent callers of the same key share one value
+        without blocking callers of other keys.
+        If create returns None, nothing is added.
+        :param key: hashable key
+        :param create: function without arguments creating the value
+        :return: cached or created value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            creation = self.creations.setdefault(key, [threading.Lock(), 0])
+            creation[1] += 1
+        try:
+            with creation[0]:
+                with self.lock:
+                    value = self.entries.get(key)
+                if value is None:
+                    value = create()
+                    if value is not None:
+                        self.put(key, value)
+                return value
+        finally:
+            with self.lock:
+                # drops the lock of the key once no caller is creating or waiting for its value
+                creation[1] -= 1
+                if not creation[1]:
+                    del self.creations[key]
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def remove(self, key):
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def total_cost(self):
+        with self.lock:
+            return sum(self.cost(value) for value in self.entries.values())
+
+    def stats(self):
+        """
+        :return: dictionary with hit/miss counters and the current usage of the cache
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRate': self.hits / requests if requests else 0,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'cost': self.total_cost(),
+                    'budget': self.budget}
+
+    def __evict(self, keep=None):
+        # Evicts least recently used entries until the budget is met, never evicts the just added entry
+        total = self.total_cost()
+        while total > self.budget and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            if key == keep:
+                break
+            total -= self.cost(self.entries.pop(key))
+            self.evictions += 1
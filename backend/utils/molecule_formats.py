@@ -1,7 +1,35 @@
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+import functools
+import multiprocessing
+import threading
+import time
 import numpy as np
 from rdkit import Chem
-from rdkit.Chem import AllChem
-from scipy.spatial.distance import squareform, pdist
+from rdkit.Chem import AllChem, rdFingerprintGenerator
+from scipy.spatial import cKDTree
+
+from backend.utils.featurization_pool import TaskFailure, Worker
+
+# arguments of EmbedMolecule tried in order until one embeds the molecule, the fallback starts from random
+# coordinates with few attempts, so molecules failing the default embedding do not stall a worker for long
+_embedding_strategies = [{}, {'useRandomCoords': True, 'maxAttempts': 10}]
+# conformer settings of smiles_to_mol_graph, part of its featurization cache key
+_mol_graph_parameters = {'embedding': 'ETKDG', 'forceField': 'MMFF', 'strategies': _embedding_strategies}
+# atoms at most this many bonds apart are connected in topology graphs, part of their featurization cache key
+_topology_path_length = 3
+# worker processes of the chemistry service, each runs one conversion at a time
+_service_processes = 2
+# seconds a single conversion of the chemistry service may take before its worker is terminated
+_service_timeout = 30
+# the server process runs threads, e.g. TensorFlow's, and must not fork. Workers of the chemistry service are forked
+# from a fresh server process with this module preloaded instead, so replacing a worker stays fast
+_service_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+if _service_context.get_start_method() == 'forkserver':
+    _service_context.set_forkserver_preload([__name__])
 
 
 def is_valid_molecule(smiles):
@@ -18,6 +46,43 @@ def is_valid_molecule(smiles):
         return Chem.SanitizeMol(m, catchErrors=True) == 0
 
 
+def smiles_to_mol(smiles):
+    """
+    Parses a SMILES code to an RDKit Mol
+
+    :param smiles: SMILES code for a specific molecule
+    :return: Mol or None if Chem cannot handle the given smiles code
+    """
+    try:
+        return Chem.MolFromSmiles(smiles)
+    except TypeError:
+        return None
+
+
+def featurize_smiles(smiles, fingerprint_sizes=(), radius=2, mol_graph=False, cml=False, graph_cutoff=None,
+                     graph_max_neighbors=None):
+    """
+    Parses a SMILES code once and converts it to all requested representations
+
+    :param smiles: A molecule's SMILES code
+    :param fingerprint_sizes: fingerprint sizes to create fingerprint vectors for
+    :param radius: radius for the fingerprint vectors
+    :param mol_graph: True to create the mol graph
+    :param cml: True to create the CML string with 3D coordinates
+    :param graph_cutoff: radius of the mol graph's neighbor graph, None for the bond graph, see mol_to_mol_graph
+    :param graph_max_neighbors: maximum number of neighbors per atom in the neighbor graph
+    :return: dictionary with 'fingerprints' (size: uint8 fingerprint array) and, if requested, 'mol_graph' and 'cml'.
+    Representations that could not be created are None, see the single conversion functions
+    """
+    mol = smiles_to_mol(smiles)
+    features = {'fingerprints': mol_to_fingerprints(mol, fingerprint_sizes, radius)}
+    if mol_graph:
+        features['mol_graph'] = mol_to_mol_graph(mol, graph_cutoff, graph_max_neighbors)
+    if cml:
+        features['cml'] = mol_to_3DCML(mol, smiles)
+    return features
+
+
 def smiles_to_3DCML(smiles: str) -> str | None:
     """
     Converts a given smiles code to a CML string with (mostly) correct 3D coordinates.
@@ -25,9 +90,19 @@ def smiles_to_3DCML(smiles: str) -> str | None:
     :param smiles: A smiles code
     :return: CML string on success, None on error.
     """
+    return mol_to_3DCML(smiles_to_mol(smiles), smiles)
+
+
+def mol_to_3DCML(mol, smiles=None):
+    """
+    Converts a parsed molecule to a CML string with (mostly) correct 3D coordinates.
+
+    :param mol: RDKit Mol, may be None
+    :param smiles: SMILES code of the molecule, used for error messages
+    :return: CML string on success, None on error.
+    """
     try:
-        m = Chem.MolFromSmiles(smiles)
-        m = Chem.AddHs(m)
+        m = Chem.AddHs(mol)
         status = AllChem.EmbedMolecule(m, maxAttempts=1000)
         if status != 0:
             raise ValueError
@@ -47,40 +122,381 @@ def smiles_to_fingerprint(smiles, fingerprint_size=128, radius=2):
     :param radius: radius for the resulting bit vector
     :return: fingerprint vector if Chem can handle the given smiles code
     """
+    return mol_to_fingerprint(smiles_to_mol(smiles), fingerprint_size, radius)
+
+
+def mol_to_fingerprint(mol, fingerprint_size=128, radius=2):
+    """
+    Converts a parsed molecule to a fingerprint vector with the given parameters
+
+    :param mol: RDKit Mol, may be None
+    :param fingerprint_size: fingerprint size for the resulting bit vector
+    :param radius: radius for the resulting bit vector
+    :return: fingerprint vector or None if mol is None
+    """
+    fingerprint = _mol_to_fingerprint_array(mol, fingerprint_size, radius)
+    return fingerprint.tolist() if fingerprint is not None else None
+
+
+def mol_to_fingerprints(mol, fingerprint_sizes, radius=2):
+    """
+    Converts a parsed molecule to fingerprint vectors of several sizes, computing only the largest one with RDKit.
+    Smaller sizes dividing the largest size are folded from it: bit i of the largest fingerprint is set in bit
+    i % size of the smaller one.
+
+    RDKit sets bit (environment hash % nBits) of a morgan bit vector, so folded fingerprints are identical to
+    GetMorganFingerprintAsBitVect(mol, radius, nBits=size) and to DataStructs.FoldFingerprint of the largest one.
+    Sizes not dividing the largest size are computed with RDKit.
+
+    :param mol: RDKit Mol, may be None
+    :param fingerprint_sizes: fingerprint sizes to create fingerprint vectors for
+    :param radius: radius for the resulting bit vectors
+    :return: dictionary of size: uint8 fingerprint array, fingerprint arrays are None if mol is None
+    """
+    if not fingerprint_sizes:
+        return dict()
+    largest = max(fingerprint_sizes)
+    fingerprint = _mol_to_fingerprint_array(mol, largest, radius)
+    if fingerprint is None:
+        return {size: None for size in fingerprint_sizes}
+
+    return {size: _fold(fingerprint, size) if largest % size == 0 else _mol_to_fingerprint_array(mol, size, radius)
+            for size in fingerprint_sizes}
+
+
+def fold_fingerprint(fingerprint, fingerprint_size):
+    """
+    Folds a morgan fingerprint vector to a smaller size by OR-ing bit i into bit i % fingerprint_size,
+    the result is identical to the fingerprint computed with that size, see mol_to_fingerprints
+
+    :param fingerprint: fingerprint vector, its size must be a multiple of fingerprint_size
+    :param fingerprint_size: size of the folded fingerprint vector
+    :return: folded fingerprint vector
+    """
+    if len(fingerprint) % fingerprint_size != 0:
+        raise ValueError(f'Cannot fold a fingerprint of size {len(fingerprint)} to size {fingerprint_size}')
+    return _fold(np.asarray(fingerprint), fingerprint_size).tolist()
+
+
+def smiles_list_to_fingerprints(smiles_list, fingerprint_sizes, radius=2, packed=False):
+    """
+    Converts a sequence of SMILES codes to fingerprint matrices of several sizes, see mol_to_fingerprints.
+    Each molecule's fingerprint is written to the matrix as a numpy array, smaller sizes are folded for all
+    molecules at once.
+
+    :param smiles_list: sequence of SMILES codes
+    :param fingerprint_sizes: fingerprint sizes to create fingerprint matrices for
+    :param radius: radius for the resulting bit vectors
+    :param packed: True to return bit-packed matrices (numpy.packbits), sizes should be multiples of 8
+    :return: dictionary of size: uint8 array of shape (len(smiles_list), size), or (len(smiles_list), size / 8) if
+    packed, and a boolean array marking the valid SMILES codes, rows of invalid SMILES codes are all zeros
+    """
+    largest = max(fingerprint_sizes, default=0)
+    # sizes computed with RDKit, all others are folded from the largest size
+    computed = [size for size in fingerprint_sizes if largest % size != 0] + ([largest] if largest else [])
+    matrices = {size: np.zeros((len(smiles_list), size), dtype='uint8') for size in computed}
+    valid = np.zeros(len(smiles_list), dtype=bool)
+    for idx, smiles in enumerate(smiles_list):
+        mol = smiles_to_mol(smiles)
+        rows = {size: _mol_to_fingerprint_array(mol, size, radius) for size in computed} if mol is not None else None
+        if not rows or any(row is None for row in rows.values()):
+            continue
+        for size, row in rows.items():
+            matrices[size][idx] = row
+        valid[idx] = True
+
+    fingerprints = {size: matrices[size] if size in matrices else _fold(matrices[largest], size)
+                    for size in fingerprint_sizes}
+    if packed:
+        fingerprints = {size: np.packbits(matrix, axis=-1) for size, matrix in fingerprints.items()}
+    return fingerprints, valid
+
+
+@functools.lru_cache(maxsize=None)
+def _morgan_generator(radius, fingerprint_size):
+    # generators are reused, creating one costs more than a fingerprint
+    return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=fingerprint_size)
+
+
+def _mol_to_fingerprint_array(mol, fingerprint_size, radius):
+    # uint8 numpy array of the morgan fingerprint, bit-identical to GetMorganFingerprintAsBitVect, or None
+    if mol is None:
+        return None
     try:
-        mol = Chem.MolFromSmiles(smiles)
-        fingerprint = AllChem.GetMorganFingerprintAsBitVect(mol, radius=radius, nBits=fingerprint_size)
-        return list(fingerprint)
+        return _morgan_generator(radius, fingerprint_size).GetFingerprintAsNumPy(mol).astype('uint8')
     except (IndexError, ValueError, TypeError):
         return None
 
 
-def smiles_to_mol_graph(smiles):
+def _fold(fingerprints, fingerprint_size):
+    # folds the last axis of fingerprint vectors or matrices, its size must be a multiple of fingerprint_size
+    return fingerprints.reshape(fingerprints.shape[:-1] + (-1, fingerprint_size)).max(axis=-2)
+
+
+def smiles_to_mol_graph(smiles, cutoff=None, max_neighbors=None):
     """
     Converts a SMILES code to a mol graph
 
     :param smiles: SMILES code for a specific molecule
-    :return: nodes, edges, edge_indices of the converted graph
+    :param cutoff: radius of the neighbor graph, see mol_to_mol_graph, None for the bond graph
+    :param max_neighbors: maximum number of neighbors per atom in the neighbor graph, None for all within cutoff
+    :return: nodes (uint8 atomic numbers), edges (float32 bond lengths), edge_indices (int32) of the converted graph
+    """
+    return mol_to_mol_graph(smiles_to_mol(smiles), cutoff, max_neighbors)
+
+
+def mol_to_mol_graph(mol, cutoff=None, max_neighbors=None):
+    """
+    Converts a parsed molecule to a mol graph, embeds it with hydrogens and optimizes it in 3D.
+    Falls back to embedding from random coordinates if the default embedding fails.
+    Edges connect bonded atoms or, given a cutoff, all atoms within cutoff Ångström of each other, as SchNet is
+    designed for. Only the distances of the edges are computed, no distance matrix of all atoms
+
+    :param mol: RDKit Mol, may be None
+    :param cutoff: radius of the neighbor graph, None for the bond graph
+    :param max_neighbors: maximum number of neighbors per atom in the neighbor graph, the nearest are kept,
+    None for all within cutoff
+    :return: nodes (uint8 atomic numbers), edges (float32 distances), edge_indices (int32) of the converted graph
     """
     try:
-        mol = Chem.MolFromSmiles(smiles)
         mol = Chem.AddHs(mol)
-        AllChem.EmbedMolecule(mol)
+        for strategy in _embedding_strategies:
+            if AllChem.EmbedMolecule(mol, **strategy) == 0:
+                break
         AllChem.MMFFOptimizeMolecule(mol)
 
+        # raises a ValueError if no strategy could embed the molecule
         conformer = mol.GetConformer()
 
-        node_features = np.array([[a.GetAtomicNum()] for a in mol.GetAtoms()])
-        node_positions = np.array([list(conformer.GetAtomPosition(i)) for i, _ in enumerate(mol.GetAtoms())])
+        node_features = np.array([[a.GetAtomicNum()] for a in mol.GetAtoms()], dtype='uint8')
+        node_positions = conformer.GetPositions()
 
-        dist_mat = squareform(pdist(node_positions))
+        if cutoff is None:
+            edge_indices_forward = [[b.GetBeginAtomIdx(), b.GetEndAtomIdx()] for b in mol.GetBonds()]
+            edge_indices_backward = [[b, a] for a, b in edge_indices_forward]
+            edge_indices = np.array(edge_indices_forward + edge_indices_backward, dtype='int32')
+        else:
+            edge_indices = radius_edge_indices(node_positions, cutoff, max_neighbors)
 
-        edge_indices_forward = [[b.GetBeginAtomIdx(), b.GetEndAtomIdx()] for b in mol.GetBonds()]
-        edge_indices_backward = [[b, a] for a, b in edge_indices_forward]
-        edge_indices = np.array(edge_indices_forward + edge_indices_backward)
-
-        edge_features = dist_mat[edge_indices[:, 0], edge_indices[:, 1]][..., None]
+        edge_vectors = node_positions[edge_indices[:, 0]] - node_positions[edge_indices[:, 1]]
+        edge_features = np.linalg.norm(edge_vectors, axis=-1)[..., None].astype('float32')
 
         return node_features, edge_features, edge_indices
     except (IndexError, ValueError, TypeError):
         return None, None, None
+
+
+def radius_edge_indices(positions, cutoff, max_neighbors=None):
+    """
+    Finds the edges of a neighbor graph using a KD-tree, in O(n log n) time and memory linear in the number of edges
+
+    :param positions: array of shape (atoms, 3)
+    :param cutoff: maximum distance of neighbors
+    :param max_neighbors: maximum number of neighbors per atom, the nearest are kept, None for all within cutoff.
+    Limited graphs may be directed, an atom can be among the nearest neighbors of another one but not vice versa
+    :return: int32 array of shape (edges, 2) of [atom, neighbor] pairs, sorted by atom and neighbor
+    """
+    positions = np.asarray(positions, dtype='float64')
+    tree = cKDTree(positions)
+    if max_neighbors is None:
+        pairs = tree.query_pairs(cutoff, output_type='ndarray')
+        edge_indices = np.concatenate([pairs, pairs[:, ::-1]])
+    else:
+        # the nearest neighbor of each atom is the atom itself, missing neighbors have the index len(positions)
+        _, neighbors = tree.query(positions, k=list(range(1, max_neighbors + 2)),
+                                  distance_upper_bound=np.nextafter(cutoff, np.inf))
+        atoms = np.broadcast_to(np.arange(len(positions))[:, None], neighbors.shape)
+        valid = (neighbors < len(positions)) & (neighbors != atoms)
+        valid &= np.cumsum(valid, axis=1) <= max_neighbors
+        edge_indices = np.stack([atoms[valid], neighbors[valid]], axis=-1)
+    edge_indices = edge_indices.reshape(-1, 2).astype('int32')
+    return edge_indices[np.lexsort((edge_indices[:, 1], edge_indices[:, 0]))]
+
+
+def smiles_to_topology_graph(smiles, max_path_length=_topology_path_length):
+    """
+    Converts a SMILES code to a topology graph
+
+    :param smiles: SMILES code for a specific molecule
+    :param max_path_length: maximum number of bonds between connected atoms
+    :return: nodes (uint8 atomic numbers), edges (float32 bond order and path length), edge_indices (int32)
+    """
+    return mol_to_topology_graph(smiles_to_mol(smiles), max_path_length)
+
+
+def mol_to_topology_graph(mol, max_path_length=_topology_path_length):
+    """
+    Converts a parsed molecule to a graph of its topology, without embedding it in 3D. Nodes are the heavy atoms,
+    edges connect all atoms at most max_path_length bonds apart. Each edge holds the order of the bond between its
+    atoms (0 if they are not bonded, 1.5 for aromatic bonds) and the number of bonds on the shortest path between them
+
+    :param mol: RDKit Mol, may be None
+    :param max_path_length: maximum number of bonds between connected atoms
+    :return: nodes (uint8 atomic numbers), edges (float32 bond order and path length), edge_indices (int32) of the
+    converted graph
+    """
+    if mol is None or not mol.GetNumAtoms():
+        return None, None, None
+    node_features = np.array([[a.GetAtomicNum()] for a in mol.GetAtoms()], dtype='uint8')
+    # atoms of different fragments are not connected, their path length is a large constant
+    path_lengths = Chem.GetDistanceMatrix(mol)
+    bond_orders = Chem.GetAdjacencyMatrix(mol, useBO=True)
+
+    edge_indices = np.argwhere((path_lengths > 0) & (path_lengths <= max_path_length)).astype('int32')
+    edge_features = np.stack([bond_orders[edge_indices[:, 0], edge_indices[:, 1]],
+                              path_lengths[edge_indices[:, 0], edge_indices[:, 1]]], axis=-1).astype('float32')
+    return node_features, edge_features, edge_indices
+
+
+def mol_graph_parameters(cutoff=None, max_neighbors=None):
+    """
+    :return: featurization cache parameters of mol graphs with the given edges, see mol_to_mol_graph.
+    Bond graphs keep the parameters they had before neighbor graphs were added, so their cache entries stay valid
+    """
+    if cutoff is None:
+        return _mol_graph_parameters
+    return _mol_graph_parameters | {'cutoff': cutoff, 'maxNeighbors': max_neighbors}
+
+
+class ConversionError(Exception):
+    """
+    Raised by futures of the ChemistryService for conversions which raised an exception or crashed their worker
+    """
+
+
+class ChemistryService:
+    """
+    Runs CPU-heavy conversions, e.g. 3D embeddings, in worker processes, so they neither hold the GIL of the server's
+    request threads nor make concurrent requests wait for each other.
+
+    submit() returns a concurrent.futures.Future. Identical requests, by function and arguments, share the future of
+    the one already in flight. A conversion exceeding the timeout fails with a TimeoutError, its worker is terminated
+    and replaced. Worker processes are started on the first request.
+    """
+
+    def __init__(self, processes=_service_processes, timeout=_service_timeout):
+        """
+        Creates a new ChemistryService
+        :param processes: number of worker processes, 0 runs conversions in the calling thread (for debugging and
+        tests, without timeouts)
+        :param timeout: seconds a single conversion may take before its worker is terminated
+        """
+        self.processes = processes
+        self.timeout = timeout
+        # (key, function, args) of the requests waiting for a worker
+        self.pending = deque()
+        # key: future of all requests in flight
+        self.futures = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.wake_receiver, self.wake_sender = Pipe(duplex=False)
+
+    def submit(self, function, *args):
+        """
+        Requests a conversion
+        :param function: module level function, so it can be sent to the worker processes
+        :param args: hashable arguments of function, e.g. a SMILES code
+        :return: Future of function(*args), failing with TimeoutError or ConversionError
+        """
+        if self.processes == 0:
+            return self.__run_inline(function, args)
+        key = (function.__module__, function.__qualname__, args)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('ChemistryService is closed')
+            if key in self.futures:
+                return self.futures[key]
+            future = Future()
+            self.futures[key] = future
+            self.pending.append((key, function, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__dispatch, daemon=True)
+                self.thread.start()
+            self.wake_sender.send(None)
+        return future
+
+    def close(self):
+        """
+        Terminates the worker processes, requests in flight fail with a ConversionError
+        """
+        with self.lock:
+            self.closed = True
+            self.wake_sender.send(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    @staticmethod
+    def __run_inline(function, args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(ConversionError(f'error: {e!r}'))
+        return future
+
+    def __dispatch(self):
+        # Sends pending requests to idle workers and resolves the futures of finished, failed or timed out ones
+        workers = [Worker(_service_context) for _ in range(self.processes)]
+        while True:
+            with self.lock:
+                if self.closed:
+                    break
+                for worker in workers:
+                    if not worker.tasks and self.pending:
+                        key, function, args = self.pending.popleft()
+                        worker.send(function, [(key, args)])
+
+            busy = {worker.connection: worker for worker in workers if worker.tasks}
+            timeout = max(min(worker.started for worker in busy.values()) + self.timeout - time.monotonic(), 0) \
+                if busy else None
+            for connection in wait(list(busy.keys()) + [self.wake_receiver], timeout=timeout):
+                if connection is self.wake_receiver:
+                    while self.wake_receiver.poll():
+                        self.wake_receiver.recv()
+                    continue
+                worker = busy[connection]
+                try:
+                    key, result = connection.recv()
+                except (EOFError, OSError):
+                    workers[workers.index(worker)] = self.__replace(worker, ConversionError('worker crashed'))
+                    continue
+                worker.tasks.popleft()
+                self.__resolve(key, result if not isinstance(result, TaskFailure)
+                               else ConversionError(result.reason))
+
+            now = time.monotonic()
+            for worker in busy.values():
+                if worker.tasks and now - worker.started > self.timeout:
+                    workers[workers.index(worker)] = self.__replace(
+                        worker, TimeoutError(f'timeout after {self.timeout}s'))
+
+        for worker in workers:
+            worker.terminate()
+        with self.lock:
+            keys = list(self.futures.keys())
+            self.pending.clear()
+        for key in keys:
+            self.__resolve(key, ConversionError('ChemistryService closed'))
+
+    def __replace(self, worker, error):
+        # Fails the request of a worker and replaces the worker with a new one
+        key, _ = worker.tasks.popleft()
+        self.__resolve(key, error)
+        worker.terminate()
+        return Worker(_service_context)
+
+    def __resolve(self, key, result):
+        # results are set without holding the lock, as they run the callbacks of the future
+        with self.lock:
+            future = self.futures.pop(key, None)
+        if future is None:
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+# service used by the server's request threads
+chemistry_service = ChemistryService()
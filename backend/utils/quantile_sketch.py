@@ -0,0 +1,97 @@
+import numpy as np
+
+"""
+Quantile sketches of label values
+
+A sketch stores the values at evenly spaced ranks of the sorted values, at most _sketch_size of them, and the number
+of values. Sets of at most _sketch_size values are stored completely, so their histograms are exact.
+Histograms of any resolution and value range are computed from a sketch by interpolating the number of values below
+each bin edge between the stored quantiles, without reading the values themselves.
+"""
+
+# maximum number of quantiles stored per sketch
+_sketch_size = 1024
+
+
+def create_sketch(values, size=_sketch_size):
+    """
+    Creates a sketch of the given values, NaN values are ignored
+    :param values: array-like of numbers
+    :param size: maximum number of quantiles to store
+    :return: dictionary with 'count' (number of values) and 'quantiles' (sorted list of values at evenly spaced ranks)
+    """
+    values = np.sort(np.asarray(values, dtype='float32').ravel())
+    values = values[~np.isnan(values)]
+    return {'count': len(values), 'quantiles': values[_ranks(len(values), size)].tolist()}
+
+
+def merge_sketches(first, second, size=_sketch_size):
+    """
+    Merges two sketches into a sketch of all their values. Exact if the merged sketch holds all values
+    :param first: sketch, see create_sketch
+    :param second: sketch, see create_sketch
+    :param size: maximum number of quantiles to store
+    :return: merged sketch
+    """
+    count = first.get('count') + second.get('count')
+    if count <= size:
+        # both sketches hold all of their values
+        return create_sketch(first.get('quantiles') + second.get('quantiles'), size)
+
+    candidates = np.unique(np.array(first.get('quantiles') + second.get('quantiles'), dtype='float64'))
+    at_most = count_below(first, candidates, inclusive=True) + count_below(second, candidates, inclusive=True)
+    # the value at rank r is the smallest one with more than r values less or equal to it
+    positions = np.searchsorted(at_most, _ranks(count, size) + 1, side='left')
+    quantiles = candidates[np.minimum(positions, len(candidates) - 1)].astype('float32')
+    return {'count': count, 'quantiles': quantiles.tolist()}
+
+
+def count_below(sketch, edges, inclusive=False):
+    """
+    Estimates the number of values below each edge. Exact if the sketch holds all values
+    :param sketch: sketch, see create_sketch
+    :param edges: array-like of numbers
+    :param inclusive: whether to count values equal to an edge as well
+    :return: float64 array of counts, same shape as edges
+    """
+    edges = np.asarray(edges, dtype='float64')
+    quantiles = np.array(sketch.get('quantiles'), dtype='float64')
+    count = sketch.get('count')
+    if not len(quantiles):
+        return np.zeros(edges.shape)
+    ranks = _ranks(count, len(quantiles))
+
+    # number of quantiles below each edge, the edge lies between the quantiles lower and upper
+    idx = np.searchsorted(quantiles, edges, side='right' if inclusive else 'left')
+    lower = np.clip(idx - 1, 0, len(quantiles) - 1)
+    upper = np.clip(idx, 0, len(quantiles) - 1)
+    span = quantiles[upper] - quantiles[lower]
+    fraction = np.divide(edges - quantiles[lower], span, out=np.zeros(edges.shape), where=span > 0)
+    # values between two quantiles are assumed to be evenly distributed
+    counts = ranks[lower] + 1 + (ranks[upper] - ranks[lower] - 1) * fraction
+    return np.where(idx == 0, 0., np.where(idx == len(quantiles), float(count), counts))
+
+
+def sketch_histogram(sketch, bins, value_range=None):
+    """
+    Computes a histogram from a sketch in O(bins), bins include their left edge, the last one its right edge as well
+    (like numpy.histogram)
+    :param sketch: sketch, see create_sketch
+    :param bins: number of bins
+    :param value_range: optional (min, max) of the histogram, defaults to the range of all values
+    :return: dictionary containing lists for buckets and interval edges
+    """
+    quantiles = sketch.get('quantiles')
+    low, high = value_range if value_range else ((quantiles[0], quantiles[-1]) if quantiles else (0., 1.))
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    bin_edges = np.linspace(low, high, bins + 1)
+    cumulative = np.append(count_below(sketch, bin_edges[:-1]), count_below(sketch, bin_edges[-1:], inclusive=True))
+    return {'buckets': np.diff(np.rint(cumulative).astype('int64')).tolist(), 'bin_edges': bin_edges.tolist()}
+
+
+def _ranks(count, size):
+    # ranks of the stored quantiles of count values
+    if count <= size:
+        return np.arange(count)
+    return np.rint(np.linspace(0, count - 1, size)).astype('int64')
@@ -2,10 +2,15 @@ from pathlib import Path
 import json
 import shutil
 import atexit
-import pickle
+import threading
+import time
 import tensorflow as tf
 import shortuuid
 
+from backend.utils import dataset_storage as ds
+from backend.utils.lru_cache import LRUCache
+from backend.utils.quantile_sketch import sketch_histogram
+
 # registry of storage_handler functions
 __all__ = ['add_analysis',
            'add_fitting',
@@ -21,6 +26,7 @@ __all__ = ['add_analysis',
            'get_base_model',
            'get_base_models',
            'get_dataset',
+           'get_dataset_cache_stats',
            'get_dataset_summaries',
            'get_fitting',
            'get_fitting_summary',
@@ -30,6 +36,7 @@ __all__ = ['add_analysis',
            'get_model_summaries',
            'get_molecules',
            'get_user_handler',
+           'rescan_datasets',
            'update_fitting']
 
 _storage_path = Path(__file__.replace('storage_handler.py', '')) / '..' / 'storage'
@@ -37,7 +44,15 @@ _user_data_path = _storage_path / 'user_data'
 _datasets_path = _storage_path / 'data'
 _base_models_path = _storage_path / 'models'
 # keep dataset_version in sync with create_dataset version
-_dataset_version = 5
+_dataset_version = 7
+# maximum bytes of label sets held by the datasets in the dataset cache, least recently used datasets are evicted first
+_dataset_cache_budget = 2 * 1024 ** 3
+# minimum seconds between two scans of the data directory for new, changed or removed datasets
+_dataset_rescan_interval = 10
+# number of histograms computed from sketches kept, charts request them again on every zoom
+_histogram_cache_size = 256
+# upper limit of bins of a computed histogram
+_max_histogram_bins = 1000
 
 
 class UserDataStorageHandler:
@@ -226,8 +241,14 @@ class StorageHandler:
     def __init__(self):
         self.user_storage_handler = dict()
         self.dataset_summaries = dict()
+        self.skipped_datasets = set()
+        self.datasets_scanned = 0
+        self.dataset_lock = threading.Lock()
+        self.scan_lock = threading.Lock()
         self.base_models = dict()
         self.base_model_types = dict()
+        self.dataset_cache = LRUCache(_dataset_cache_budget, cost=lambda dataset: dataset.nbytes)
+        self.histogram_cache = LRUCache(_histogram_cache_size)
         self.__analyze_datasets()
         self.__read_base_model_types()
         self.__read_base_models()
@@ -247,26 +268,100 @@ class StorageHandler:
             handler.clean_files()
 
     # Datasets
-    def get_dataset(self, dataset_id):
+    def get_dataset(self, dataset_id) -> ds.ColumnarDataset | ds.ShardedDataset:
+        """
+        Gets a dataset from the dataset cache, loading it on a miss.
+        Concurrent callers share the same read-only instance.
+        """
         summary = self.dataset_summaries.get(str(dataset_id))
         if summary and summary.get('datasetPath'):
             path = Path(summary.get('datasetPath'))
-            if path.exists():
-                file = path.open('rb')
-                content = pickle.load(file)
-                file.close()
-                return content.get('dataset')
+            return self.dataset_cache.get_or_create((str(dataset_id), summary.get('hash')),
+                                                    lambda: ds.open_dataset(path) if ds.is_dataset(path) else None)
+
+    def get_dataset_cache_stats(self):
+        return self.dataset_cache.stats()
 
     def get_dataset_summaries(self):
+        # Picks up datasets added to or removed from the data directory while running.
+        # Scans run in the background, requests are answered with the current summaries meanwhile
+        if time.monotonic() - self.datasets_scanned > _dataset_rescan_interval and not self.scan_lock.locked():
+            threading.Thread(target=self.rescan_datasets, kwargs={'blocking': False}, daemon=True).start()
         return self.dataset_summaries
 
-    def get_dataset_histograms(self, dataset_id, labels):
+    def rescan_datasets(self, blocking=True):
+        """
+        Scans the data directory and publishes new, changed or removed datasets without a restart.
+        Only new or changed datasets are read, all others are taken from the dataset index.
+        Dataset IDs are derived from their content, so adding or removing datasets never changes other IDs.
+        Missing content hashes are computed before the dataset lock is taken, only publishing the scan holds it
+        :param blocking: whether to wait for a scan in progress instead of skipping this scan
+        :return: updated dataset summaries
+        """
+        if not self.scan_lock.acquire(blocking=blocking):
+            return self.dataset_summaries
+        try:
+            return self.__publish_datasets(ds.read_descriptors(_datasets_path))
+        finally:
+            self.scan_lock.release()
+
+    def __publish_datasets(self, descriptors):
+        with self.dataset_lock:
+            summaries = dict()
+            skipped = set()
+            for dataset_path, descriptor in descriptors.items():
+                dataset_id = ds.dataset_id(descriptor)
+                if descriptor.get('version') != _dataset_version:
+                    if dataset_path not in self.skipped_datasets:
+                        print(f'Dataset {descriptor.get("name")} not compatible. Current version: {_dataset_version}. '
+                              f'Set version: {descriptor.get("version")}')
+                    skipped.add(dataset_path)
+                elif dataset_id in summaries:
+                    if dataset_path not in self.skipped_datasets:
+                        print(f'Dataset {dataset_path.name} has the same content as '
+                              f'{summaries.get(dataset_id).get("name")}, skipping it')
+                    skipped.add(dataset_path)
+                else:
+                    summaries[dataset_id] = self.__summarize_dataset(dataset_path, descriptor)
+
+            # Closes datasets which were removed or changed, e.g. appended to while keeping their ID.
+            # Trainings still using them keep their own reference
+            for key in self.dataset_cache.keys():
+                if key[0] not in summaries or key[1] != summaries.get(key[0]).get('hash'):
+                    self.dataset_cache.remove(key)
+            # Replaces the summaries in one step, so concurrent readers never see a partial scan
+            self.dataset_summaries = summaries
+            self.skipped_datasets = skipped
+            self.datasets_scanned = time.monotonic()
+            return summaries
+
+    def get_dataset_histograms(self, dataset_id, labels, bins=None, value_range=None):
+        """
+        Gets histograms of a dataset's labels. Without bins and value_range, the histograms created along with the
+        dataset are returned. Otherwise they are computed from the dataset's quantile sketches without reading the
+        dataset, and cached.
+        :param dataset_id: ID of the dataset
+        :param labels: list of labels to get histograms for
+        :param bins: optional number of bins, defaults to the number of bins of the dataset's histograms
+        :param value_range: optional (min, max) of the histograms, defaults to the range of each label's values
+        :return: dictionary of label: histogram (dictionary containing lists for buckets and interval edges)
+        """
         dataset_summary = self.dataset_summaries.get(dataset_id)
         histograms = dict()
         if dataset_summary and 'histograms' in dataset_summary:
+            # datasets created before sketches were added only have their fixed histograms
+            sketches = dataset_summary.get('sketches') or dict()
             for label, histogram in dataset_summary.get('histograms').items():
-                if label in labels:
+                if label not in labels:
+                    continue
+                if (bins is None and value_range is None) or label not in sketches:
                     histograms[label] = dict(histogram)
+                    continue
+                label_bins = min(bins or len(histogram.get('buckets')), _max_histogram_bins)
+                # dataset IDs are content hashes, so cached histograms never become outdated
+                key = (dataset_id, label, label_bins, tuple(value_range) if value_range else None)
+                histograms[label] = dict(self.histogram_cache.get_or_create(
+                    key, lambda: sketch_histogram(sketches.get(label), label_bins, value_range)))
             return histograms
 
     # Base Models
@@ -397,24 +492,23 @@ class StorageHandler:
 
     # Datasets
     def __analyze_datasets(self):
-        for idx, dataset_path in enumerate(sorted(_datasets_path.glob('*.pkl'))):
-            if dataset_path.exists():
-                self.dataset_summaries[str(idx)] = self.__summarize_dataset(dataset_path)
+        for dataset_path in sorted(_datasets_path.glob('*.pkl')):
+            print(f'Dataset {dataset_path.name} uses the old pickle format. '
+                  f'Convert it using scripts/datasets/convert_dataset.py')
+        # Only reads the dataset index, datasets themselves are loaded on their first get_dataset
+        self.rescan_datasets()
 
     @staticmethod
-    def __summarize_dataset(dataset_path):
-        file = dataset_path.open('rb')
-        content = pickle.load(file)
-        file.close()
-        if content.get('version') != _dataset_version:
-            print(
-                f'Dataset {content.get("name")} not compatible. Current version: {_dataset_version}. Set version: {content.get("version")}')
-            return
+    def __summarize_dataset(dataset_path, content):
         dataset_summary = {'name': content.get('name'),
                            'size': content.get('size'),
                            'labelDescriptors': content.get('labels'),
                            'datasetPath': str(dataset_path.absolute()),
-                           'histograms': content.get('histograms')
+                           'version': content.get('version'),
+                           'hash': content.get('hash'),
+                           'hasSmiles': ds.has_smiles(dataset_path, content),
+                           'histograms': content.get('histograms'),
+                           'sketches': content.get('sketches')
                            }
         return dataset_summary
 
@@ -491,6 +585,7 @@ delete_user_handler = _inst.delete_user_handler
 get_base_model = _inst.get_base_model
 get_base_models = _inst.get_base_models
 get_dataset = _inst.get_dataset
+get_dataset_cache_stats = _inst.get_dataset_cache_stats
 get_dataset_summaries = _inst.get_dataset_summaries
 get_dataset_histograms = _inst.get_dataset_histograms
 get_fitting = _inst.get_fitting
@@ -503,4 +598,5 @@ get_model_summary = _inst.get_model_summary
 get_model_summaries = _inst.get_model_summaries
 get_molecules = _inst.get_molecules
 get_user_handler = _inst.get_user_handler
+rescan_datasets = _inst.rescan_datasets
 update_fitting = _inst.update_fitting
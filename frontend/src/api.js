@@ -255,11 +255,15 @@ export default {
    * Requests histograms for a specific dataset
    * @param datasetID {string} ID of the dataset
    * @param labels {string[]} List of labels to be included in the histogram
+   * @param bins {number} Optional number of bins, defaults to the dataset's histograms
+   * @param range {number[]} Optional [min, max] of the histograms, e.g. to zoom in
    * @returns {Promise<AxiosResponse<*[]>, []>} Promise that returns an array containing the histogram data or an empty array on exception
    */
-  async getHistograms(datasetID, labels) {
+  async getHistograms(datasetID, labels, bins, range) {
     return api
-      .get(`/histograms/${datasetID}/${labels}`)
+      .get(`/histograms/${datasetID}/${labels}`, {
+        params: { bins, min: range?.[0], max: range?.[1] },
+      })
       .then((response) => {
         return response.data
       })
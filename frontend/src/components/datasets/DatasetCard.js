@@ -47,7 +47,7 @@ export default function DatasetCard({
               backgroundPosition: 'center',
               backgroundSize: 'cover',
               backgroundImage: `url("/datasets/data${
-                dataset.datasetID % 7
+                parseInt(dataset.datasetID, 16) % 7
               }.png")`,
               filter: 'grayscale(100%)',
             }}
@@ -9,9 +9,11 @@ import Chart from 'react-apexcharts'
  * @param data array of string, amount pair objects( [{x: str, y: int}] )
  * @param highlightedIndex index of highlighted column
  * @param title title of the histogram
+ * @param onZoom optional callback for zooming, called with the indices of the first and last selected column or with
+ * null when the zoom is reset
  * @returns {JSX.Element}
  */
-export default function Histogram({ data, highlightedIndex, title }) {
+export default function Histogram({ data, highlightedIndex, title, onZoom }) {
   const theme = useTheme()
   const displayedData = data || []
   return (
@@ -24,6 +26,23 @@ export default function Histogram({ data, highlightedIndex, title }) {
         chart: {
           background: 'transparent',
           toolbar: { show: true },
+          zoom: { enabled: !!onZoom, type: 'x' },
+          events: {
+            // columns are categories, zoom bounds are 1-based column positions
+            zoomed: (chartContext, { xaxis }) => {
+              if (onZoom && xaxis.min !== undefined) {
+                onZoom(
+                  Math.max(Math.ceil(xaxis.min) - 1, 0),
+                  Math.min(Math.floor(xaxis.max) - 1, displayedData.length - 1)
+                )
+              }
+            },
+            beforeResetZoom: () => {
+              if (onZoom) {
+                onZoom(null)
+              }
+            },
+          },
           animations: {
             enabled: true,
             easing: 'linear',
@@ -45,6 +64,7 @@ export default function Histogram({ data, highlightedIndex, title }) {
         },
         xaxis: {
           type: 'category',
+          tickPlacement: 'on',
           tickAmount: data.length > 30 ? 25 : 10,
         },
         colors: [
@@ -65,4 +85,5 @@ Histogram.propTypes = {
   data: PropTypes.array,
   highlightedIndex: PropTypes.number,
   title: PropTypes.string,
+  onZoom: PropTypes.func,
 }
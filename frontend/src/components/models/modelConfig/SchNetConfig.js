@@ -1,6 +1,7 @@
 import React from 'react'
-import { TextField } from '@mui/material'
+import { MenuItem, TextField } from '@mui/material'
 import PropTypes from 'prop-types'
+import api from '../../../api'
 import { camelToNaturalString } from '../../../utils'
 
 /**
@@ -23,6 +24,22 @@ const settableSizes = {
   },
 }
 
+/**
+ * Molecule representations a SchNet can be trained on
+ * @type {{'3D': string, topology: string}}
+ */
+const inputTypes = {
+  '3D': 'Bonds with their lengths in the molecule embedded in 3D',
+  topology:
+    'Bond orders and path lengths between atoms, much faster as no 3D structure is computed',
+}
+
+/**
+ * Input types which need SMILES codes in the dataset, datasets converted from the old pickle format have none
+ * @type {string[]}
+ */
+const smilesInputTypes = ['topology']
+
 /**
  * Configuration of SchNet-specific parameters
  * @param schnetParams initial values
@@ -45,6 +62,16 @@ export default function SchNetConfig({
     schnetParams.readoutSize,
   ])
   const [sizesError, setSizesError] = React.useState([false, false, false])
+  const [inputType, setInputType] = React.useState(
+    schnetParams.inputType || '3D'
+  )
+  const [smilesAvailable, setSmilesAvailable] = React.useState(true)
+
+  React.useEffect(() => {
+    api.getDatasets().then((datasets) => {
+      setSmilesAvailable(datasets.some((dataset) => dataset.hasSmiles))
+    })
+  }, [])
 
   React.useEffect(() => {
     errorSignal(sizesError.includes(true))
@@ -69,8 +96,47 @@ export default function SchNetConfig({
     }
   }
 
+  /**
+   * called when another input type is selected
+   * @param event the event which triggered
+   */
+  const handleInputTypeChange = (event) => {
+    setInputType(event.target.value)
+    updateFunc('inputType', event.target.value)
+  }
+
   return (
     <div>
+      <TextField
+        select
+        id="outlined-select"
+        label="Input Type"
+        value={inputType}
+        onChange={handleInputTypeChange}
+        onMouseOver={(e) => {
+          hoverFunc(e, inputTypes[inputType])
+        }}
+        onMouseLeave={leaveFunc}
+        helperText={
+          smilesAvailable
+            ? ''
+            : 'Topology needs a dataset with SMILES codes, none is available'
+        }
+        sx={{
+          m: 2,
+          minWidth: 150,
+        }}
+      >
+        {Object.keys(inputTypes).map((type) => (
+          <MenuItem
+            key={type}
+            value={type}
+            disabled={!smilesAvailable && smilesInputTypes.includes(type)}
+          >
+            {camelToNaturalString(type)}
+          </MenuItem>
+        ))}
+      </TextField>
       {Object.entries(settableSizes).map(([key, value], i) => {
         return (
           <TextField
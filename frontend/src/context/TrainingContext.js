@@ -9,6 +9,8 @@ import { camelToNaturalString } from '../utils'
  * @property {boolean} trainingStopped True when training was stopped manually.
  * @property {boolean} trainingFinished True when training is over (including on manual stop).
  * @property {boolean} trainingFailed True when training ended via error.
+ * @property {number} queuePosition Position of the training in the server's training queue while it waits for a free slot, 0 otherwise.
+ * @property {object} trainingResources Threads and CPU IDs the server assigned to the running training, null if unknown.
  * @property {string} trainingID Set after first training is finished. On training start set to '0'.
  * @property {ModelConfig} selectedModel Selected Model for the training process.
  * @property {function} setSelectedModel Sets the selected model.
@@ -35,6 +37,8 @@ const TrainingContext = React.createContext({
   trainingStopped: false,
   trainingFinished: false,
   trainingFailed: false,
+  queuePosition: 0,
+  trainingResources: null,
   setTrainingFinished: () => {},
   trainingID: '0',
   selectedModel: null,
@@ -68,6 +72,8 @@ export const TrainingProvider = ({ children }) => {
   const [trainingStopped, setTrainingStopped] = React.useState(false)
   const [trainingFinished, setTrainingFinished] = React.useState(false)
   const [trainingFailed, setTrainingFailed] = React.useState(false)
+  const [queuePosition, setQueuePosition] = React.useState(0)
+  const [trainingResources, setTrainingResources] = React.useState(null)
   const [trainingID, setTrainingID] = React.useState('0')
   const [selectedModel, setSelectedModel] = React.useState(undefined)
   const [selectedDataset, setSelectedDataset] = React.useState(undefined)
@@ -87,7 +93,14 @@ export const TrainingProvider = ({ children }) => {
    */
   React.useEffect(() => {
     setTrainingStatus(false)
+    api.registerSocketListener('queued', (position) => {
+      setQueuePosition(position)
+    })
+    api.registerSocketListener('resources', (allocation) => {
+      setTrainingResources(allocation)
+    })
     api.registerSocketListener('started', (data) => {
+      setQueuePosition(0)
       setTrainingStatus(true)
       setTrainingStopped(false)
       setTrainingFinished(false)
@@ -97,6 +110,7 @@ export const TrainingProvider = ({ children }) => {
       dispatchTrainingData({ type: 'update', payload: data })
     })
     api.registerSocketListener('done', (response) => {
+      setTrainingResources(null)
       setTrainingStatus(false)
       setTrainingFinished(true)
       setTrainingID(response.fittingID)
@@ -104,6 +118,8 @@ export const TrainingProvider = ({ children }) => {
       setFinishedAccuracy(response.accuracy)
     })
     api.registerSocketListener('error', () => {
+      setQueuePosition(0)
+      setTrainingResources(null)
       setTrainingStopped(true)
       setTrainingStatus(false)
       setTrainingFailed(true)
@@ -158,6 +174,8 @@ export const TrainingProvider = ({ children }) => {
     setTrainingStopped(false)
     setTrainingFinished(false)
     setTrainingFailed(false)
+    setQueuePosition(0)
+    setTrainingResources(null)
     setTrainingID('0')
     dispatchTrainingData({ type: 'reset' })
   }
@@ -174,6 +192,7 @@ export const TrainingProvider = ({ children }) => {
 
   function stopTraining() {
     api.stopTraining()
+    setQueuePosition(0)
     setTrainingStopped(true)
   }
 
@@ -184,6 +203,8 @@ export const TrainingProvider = ({ children }) => {
         trainingStopped,
         trainingFinished,
         trainingFailed,
+        queuePosition,
+        trainingResources,
         setTrainingFinished,
         trainingID,
         selectedModel,
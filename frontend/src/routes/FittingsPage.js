@@ -41,6 +41,8 @@ export default function FittingsPage() {
   const [chartData, setChartData] = React.useState({
     empty: [],
   })
+  const [histograms, setHistograms] = React.useState({})
+  const [analyzedFitting, setAnalyzedFitting] = React.useState({})
   const [helpAnchorEl, setHelpAnchorEl] = React.useState(null)
   const [helpPopperContent, setHelpPopperContent] = React.useState('')
   const help = React.useContext(HelpContext)
@@ -73,6 +75,7 @@ export default function FittingsPage() {
         .getHistograms(fitting.datasetID, fitting.labels)
         .then((hists) => {
           if (hists !== null) {
+            setAnalyzedFitting(fitting)
             createChart(hists, analysis)
             return true
           }
@@ -80,39 +83,76 @@ export default function FittingsPage() {
     }
   }
 
+  function histogramToChartData(hist) {
+    const newChartData = []
+    // create chart data from histogram
+    for (let i = 0; i < hist.buckets.length; i++) {
+      newChartData.push({
+        x: `[${hist.binEdges[i].toFixed(2)} , ${hist.binEdges[i + 1].toFixed(
+          2
+        )}]`,
+        y: hist.buckets[i],
+      })
+    }
+    return newChartData
+  }
+
+  function findHighlightedIndex(hist, value) {
+    // determine index of analysis in chart
+    let index = -1
+    for (
+      let i = 0;
+      i < hist.binEdges.length && value > hist.binEdges[i];
+      i++
+    ) {
+      index = i
+    }
+    return index
+  }
+
   function createChart(hists, analysis) {
     const newCharts = {}
     const newIndices = {}
     Object.entries(hists).forEach(([label, hist]) => {
-      const newChartData = []
-      // create chart data from histogram
-      for (let i = 0; i < hist.buckets.length; i++) {
-        newChartData.push({
-          x: `[${hist.binEdges[i].toFixed(2)} , ${hist.binEdges[i + 1].toFixed(
-            2
-          )}]`,
-          y: hist.buckets[i],
-        })
-      }
-      newCharts[label] = newChartData
-
-      // determine index of analysis in chart
-      newIndices[label] = -1
-      for (
-        let i = 0;
-        i < hist.binEdges.length && analysis[label] > hist.binEdges[i];
-        i++
-      ) {
-        newIndices[label] = i
-      }
+      newCharts[label] = histogramToChartData(hist)
+      newIndices[label] = findHighlightedIndex(hist, analysis[label])
     })
 
+    setHistograms(hists)
     setChartData(newCharts)
     setAnalysis(analysis)
     setHighlightedIndices(newIndices)
     setOpenDialog(true)
   }
 
+  /**
+   * Requests the histogram of a label between the edges of the selected columns,
+   * or the whole histogram if the zoom was reset (first is null)
+   */
+  async function handleZoom(label, first, last) {
+    const hist = histograms[label]
+    const range =
+      first === null
+        ? undefined
+        : [hist.binEdges[first], hist.binEdges[last + 1]]
+    return api
+      .getHistograms(analyzedFitting.datasetID, [label], undefined, range)
+      .then((hists) => {
+        const newHist = hists?.[label]
+        if (newHist) {
+          setHistograms((old) => ({ ...old, [label]: newHist }))
+          setChartData((old) => ({
+            ...old,
+            [label]: histogramToChartData(newHist),
+          }))
+          setHighlightedIndices((old) => ({
+            ...old,
+            [label]: findHighlightedIndex(newHist, analysis[label]),
+          }))
+        }
+      })
+  }
+
   const handleCloseDialog = () => {
     setChartData({ empty: [] })
     setAnalysis({})
@@ -223,6 +263,7 @@ export default function FittingsPage() {
                       <Histogram
                         data={data}
                         highlightedIndex={highlightedIndices[label]}
+                        onZoom={(first, last) => handleZoom(label, first, last)}
                         title={`${camelToNaturalString(label)}: ${
                           analysis[label]
                         }`}
@@ -128,6 +128,7 @@ export default function ModelConfigPage({ addFunc }) {
             depth: parameters.depth,
             embeddingDimension: parameters.embeddingDimension,
             readoutSize: parameters.readoutSize,
+            inputType: parameters.inputType,
           }}
           updateFunc={updateParameters}
           errorSignal={setIsInvalidConfig}
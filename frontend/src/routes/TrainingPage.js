@@ -42,16 +42,22 @@ export default function TrainingPage() {
     React.useState(false)
   const theme = useTheme()
   const navigate = useNavigate()
+  // topology graphs are built from SMILES codes, datasets converted from the old pickle format have none
+  const missingSmiles =
+    training.selectedModel.parameters.inputType === 'topology' &&
+    !training.selectedDataset.hasSmiles
 
   React.useEffect(() => {
     if (training.trainingStatus) {
       setLoadTraining(false)
       setStartStopButton('Stop')
+    } else if (training.queuePosition) {
+      setStartStopButton(`Queued (#${training.queuePosition})`)
     } else {
       setShowDialog(false)
       setStartStopButton('Start')
     }
-  }, [training.trainingStatus])
+  }, [training.trainingStatus, training.queuePosition])
 
   React.useEffect(() => {
     if (training.trainingFailed) {
@@ -60,7 +66,7 @@ export default function TrainingPage() {
   }, [training.trainingFailed])
 
   const handleStartStop = () => {
-    if (training.trainingStatus) {
+    if (training.trainingStatus || training.queuePosition) {
       setShowDialog(true)
     } else {
       training.softResetContext()
@@ -97,6 +103,8 @@ export default function TrainingPage() {
   }, [training.trainingFinished])
 
   const abortTraining = () => {
+    // a queued training is removed from the queue and never sends a "started" message
+    setLoadTraining(false)
     training.stopTraining()
     handleCloseDialog()
   }
@@ -193,7 +201,7 @@ export default function TrainingPage() {
             <Button
               size="large"
               variant="contained"
-              disabled={parameterError}
+              disabled={parameterError || missingSmiles}
               sx={{
                 m: 2,
                 animation:
@@ -208,6 +216,22 @@ export default function TrainingPage() {
                 <CircularProgress size="16px" color="inherit" sx={{ ml: 1 }} />
               )}
             </Button>
+            {!missingSmiles ? null : (
+              <Typography
+                variant="caption"
+                sx={{ ml: 2, color: theme.palette.error.main }}
+              >
+                This dataset has no SMILES codes to build topology graphs from
+              </Typography>
+            )}
+            {!training.trainingStatus || !training.trainingResources ? null : (
+              <Typography
+                variant="caption"
+                sx={{ ml: 2, color: theme.palette.text.secondary }}
+              >
+                {`${training.trainingResources.threads} threads on ${training.trainingResources.cpus.length} CPUs`}
+              </Typography>
+            )}
             <Dialog open={showDialog} onClose={handleCloseDialog}>
               <DialogTitle>{'Abort current training?'}</DialogTitle>
               <DialogActions>